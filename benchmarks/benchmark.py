@@ -0,0 +1,474 @@
+"""Benchmarks the copy and move operations on synthetic file trees.
+
+Each tree is generated under every root (such as a tmpfs and a disk folder),
+each operation is run in a fresh process, so the peak RSS is its own.
+The enumeration is timed after the operation in another fresh process,
+so it does not warm the caches for the operation.
+The results are written as JSON and compared with a stored baseline.
+
+Usage:
+   python -m benchmarks.benchmark [--trees=...] [--roots=NAME=PATH ...] [--operations=...] [--engines=...]
+                                  [--threads=...] [--executor=...] [--scale=...] [--huge-size=...] [--repeat=...]
+                                  [--output=...] [--baseline=...] [--tolerance=...]
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import (
+    Callable,
+    Dict,
+    Final,
+    List,
+    Optional,
+    Tuple,
+    NamedTuple,
+)
+
+from files_operations_console_utility import main
+
+
+class TreeSpec(NamedTuple):
+    """A synthetic tree: every folder holds files_per_folder files of file_size bytes
+    and width subfolders, down to the specified depth."""
+    width: int
+    depth: int
+    files_per_folder: int
+    file_size: int
+
+
+trees: Final[Dict[str, TreeSpec]] = {
+    # 10100 files of 4 KiB in 100 folders.
+    'small': TreeSpec(width=100, depth=1, files_per_folder=100, file_size=4 * 2 ** 10),
+    # 4 files of --huge-size bytes.
+    'huge': TreeSpec(width=0, depth=0, files_per_folder=4, file_size=0),
+    # 33 nested folders of 32 files of 16 KiB.
+    'deep': TreeSpec(width=1, depth=32, files_per_folder=32, file_size=16 * 2 ** 10),
+    # 20000 files of 1 KiB in one folder.
+    'wide': TreeSpec(width=0, depth=0, files_per_folder=20000, file_size=2 ** 10),
+}
+
+# The default huge file size.
+DEFAULT_HUGE_SIZE: Final[int] = 256 * 2 ** 20
+
+# The size of the blocks the files are written by.
+WRITE_BLOCK_SIZE: Final[int] = 2 ** 20
+
+# The results are regressions if they are slower than the baseline by more than this fraction.
+DEFAULT_TOLERANCE: Final[float] = 0.1
+
+# The fields identifying a result in the baseline.
+RESULT_KEY_FIELDS: Final[Tuple[str, ...]] = ('tree', 'root', 'operation', 'engine', 'threads', 'executor')
+
+
+def generate_tree(path: Path, spec: TreeSpec, scale: float, huge_size: int) -> Tuple[int, int]:
+    """Generates the tree of the specification in the path.
+
+    The number of files per folder is multiplied by scale (at least 1 file).
+    Returns the number of files and their total size.
+    """
+    files_per_folder: int = max(1, round(spec.files_per_folder * scale))
+    file_size: int = spec.file_size or huge_size
+    block: bytes = os.urandom(min(file_size, WRITE_BLOCK_SIZE))
+    files: int = 0
+    folders: List[Tuple[Path, int]] = [(path, 0)]
+
+    while folders:
+        folder, depth = folders.pop()
+        folder.mkdir(parents=True, exist_ok=True)
+
+        for file_number in range(files_per_folder):
+            with open(folder / f'file_{file_number}.bin', 'wb') as file:
+                for _ in range(file_size // len(block)):
+                    file.write(block)
+
+                file.write(block[:file_size % len(block)])
+
+        files += files_per_folder
+
+        if depth < spec.depth:
+            folders.extend((folder / f'folder_{folder_number}', depth + 1) for folder_number in range(spec.width))
+
+    return files, files * file_size
+
+
+def measure(source: Path, destination: Path, operation: str, engine: str, threads: int, executor: str) -> Dict[str, object]:
+    """Runs the operation as the utility does and returns its measurements."""
+    logging.basicConfig(level=logging.WARNING)
+
+    stats_path: Path = destination.parent / f'{destination.name}.stats.json'
+    destination.mkdir()
+
+    start: float = time.perf_counter()
+    main.run_operation_in_threads(
+        source=source,
+        operation_name=operation,
+        source_and_destination_paths=main.create_source_and_destination_paths(
+            source=source,
+            source_paths=main.create_source_paths(source=source, mask=None),
+            destination=destination
+        ),
+        threads=threads,
+        mask=None,
+        copy_engine=engine,
+        destination=destination,
+        executor_name=executor,
+        stats=stats_path
+    )
+    seconds: float = time.perf_counter() - start
+
+    stats: Dict[str, object] = json.loads(stats_path.read_text(encoding='utf-8'))
+    stats_path.unlink()
+
+    return {
+        'errors': stats['error_files'],
+        'seconds': seconds,
+        # Kilobytes on Linux, bytes on macOS.
+        'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if sys.platform == 'darwin' else 1),
+    }
+
+
+def measure_enumeration(path: Path) -> Dict[str, object]:
+    """Walks the tree as the utility does and returns the number of files and the time of the walk."""
+    start: float = time.perf_counter()
+    found_files: int = sum(1 for _ in main.create_source_paths(source=path, mask=None))
+
+    return {
+        'found_files': found_files,
+        'enumeration_seconds': time.perf_counter() - start,
+    }
+
+
+def measure_in_process(function: Callable[..., Dict[str, object]], **kwargs) -> Dict[str, object]:
+    """Runs the measuring function in a fresh process."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(function, **kwargs).result()
+
+
+def run_benchmarks(
+        tree_names: List[str],
+        roots: List[Tuple[str, Path]],
+        operations: List[str],
+        engines: List[str],
+        threads: List[int],
+        executor: str = 'thread',
+        scale: float = 1.0,
+        huge_size: int = DEFAULT_HUGE_SIZE,
+        repeat: int = 1
+) -> List[Dict[str, object]]:
+    """Runs every combination and returns the fastest of the repeated results.
+
+    The engines are only varied for the copy operation,
+    a move on the same device renames the files.
+    """
+    results: List[Dict[str, object]] = []
+
+    for root_name, root in roots:
+        work_folder: Path = Path(tempfile.mkdtemp(prefix='files_operations_benchmark_', dir=root))
+
+        try:
+            for tree_name in tree_names:
+                tree_path: Path = work_folder / tree_name
+                destination: Path = work_folder / f'{tree_name}_destination'
+                files, size = generate_tree(path=tree_path, spec=trees[tree_name], scale=scale, huge_size=huge_size)
+
+                for operation in operations:
+                    for engine in engines if operation == 'copy' else ['auto']:
+                        for thread_count in threads:
+                            best: Optional[Dict[str, object]] = None
+
+                            for _ in range(repeat):
+                                measurement: Dict[str, object] = measure_in_process(
+                                    function=measure,
+                                    source=tree_path,
+                                    destination=destination,
+                                    operation=operation,
+                                    engine=engine,
+                                    threads=thread_count,
+                                    executor=executor
+                                )
+                                # The moved tree is walked at its destination.
+                                measurement.update(measure_in_process(
+                                    function=measure_enumeration,
+                                    path=destination if operation == 'move' else tree_path
+                                ))
+
+                                if operation == 'move':
+                                    # Regenerate the moved tree for the next run.
+                                    shutil.rmtree(tree_path, ignore_errors=True)
+                                    shutil.rmtree(destination)
+                                    generate_tree(path=tree_path, spec=trees[tree_name], scale=scale, huge_size=huge_size)
+                                else:
+                                    shutil.rmtree(destination)
+
+                                if (best is None) or (measurement['seconds'] < best['seconds']):
+                                    best = measurement
+
+                            seconds: float = max(best['seconds'], 1e-9)
+                            results.append({
+                                'tree': tree_name,
+                                'root': root_name,
+                                'operation': operation,
+                                'engine': engine,
+                                'threads': thread_count,
+                                'executor': executor,
+                                'files': files,
+                                'bytes': size,
+                                'errors': best['errors'],
+                                'seconds': best['seconds'],
+                                'files_per_second': files / seconds,
+                                'mb_per_second': size / seconds / 2 ** 20,
+                                'peak_rss_kib': best['peak_rss_kib'],
+                                'enumeration_seconds': best['enumeration_seconds'],
+                            })
+                            logging.info(msg=format_result(result=results[-1]))
+
+                shutil.rmtree(tree_path)
+        finally:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    return results
+
+
+def get_result_key(result: Dict[str, object]) -> Tuple[object, ...]:
+    return tuple(result[key_field] for key_field in RESULT_KEY_FIELDS)
+
+
+def format_result(result: Dict[str, object]) -> str:
+    return (
+        f'{result["tree"]} {result["root"]} {result["operation"]} {result["engine"]} '
+        f'{result["executor"]} x{result["threads"]}: '
+        f'{result["files_per_second"]:.0f} files/s, {result["mb_per_second"]:.1f} MB/s, '
+        f'enumeration {result["enumeration_seconds"]:.3f}s, peak RSS {result["peak_rss_kib"]} KiB'
+    )
+
+
+def compare_with_baseline(
+        results: List[Dict[str, object]],
+        baseline: List[Dict[str, object]],
+        tolerance: float = DEFAULT_TOLERANCE
+) -> List[Dict[str, object]]:
+    """Returns the comparisons of the results with the baseline results of the same runs:
+    the result and the files/s and MB/s ratios to the baseline.
+
+    A result is a regression if either ratio is lower than 1 - tolerance.
+    """
+    baseline_results: Dict[Tuple[object, ...], Dict[str, object]] = \
+        {get_result_key(result=result): result for result in baseline}
+    comparisons: List[Dict[str, object]] = []
+
+    for result in results:
+        baseline_result: Optional[Dict[str, object]] = baseline_results.get(get_result_key(result=result))
+
+        if baseline_result is None:
+            continue
+
+        files_ratio: float = result['files_per_second'] / max(baseline_result['files_per_second'], 1e-9)
+        bytes_ratio: float = result['mb_per_second'] / max(baseline_result['mb_per_second'], 1e-9)
+        comparisons.append({
+            'result': result,
+            'files_per_second_ratio': files_ratio,
+            'mb_per_second_ratio': bytes_ratio,
+            'regression': min(files_ratio, bytes_ratio) < 1 - tolerance,
+        })
+
+    return comparisons
+
+
+def get_environment() -> Dict[str, object]:
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def comma_separated(value: str) -> List[str]:
+    return [item for item in value.split(',') if item]
+
+
+def root_path(value: str) -> Tuple[str, Path]:
+    name, separator, path = value.partition('=')
+
+    if (not separator) or (not name) or (not path):
+        raise argparse.ArgumentTypeError(f'{value} is not NAME=PATH.')
+
+    return name, Path(path)
+
+
+def get_default_roots() -> List[Tuple[str, Path]]:
+    roots: List[Tuple[str, Path]] = []
+
+    if Path('/dev/shm').is_dir():
+        roots.append(('tmpfs', Path('/dev/shm')))
+
+    roots.append(('disk', Path(tempfile.gettempdir())))
+
+    return roots
+
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser: argparse.ArgumentParser = \
+        argparse.ArgumentParser(
+            description='Benchmarks the copy and move operations on synthetic file trees.',
+            formatter_class=argparse.RawTextHelpFormatter
+        )
+    parser.add_argument(
+        '--trees',
+        type=comma_separated,
+        default=list(trees.keys()),
+        help=f'The comma-separated trees: {", ".join(trees.keys())}.\n'
+             'Default - all trees.'
+    )
+    parser.add_argument(
+        '--roots',
+        type=root_path,
+        action='append',
+        default=None,
+        help='NAME=PATH of a folder the trees are generated in, can be repeated.\n'
+             'Default - tmpfs=/dev/shm (if any) and disk=the temporary folder.'
+    )
+    parser.add_argument(
+        '--operations',
+        type=comma_separated,
+        default=['copy', 'move'],
+        help='The comma-separated operations. Default - copy,move.'
+    )
+    parser.add_argument(
+        '--engines',
+        type=comma_separated,
+        default=['auto'],
+        help=f'The comma-separated copy engines: auto, {", ".join(main.copy_engines.keys())}.\n'
+             'Default - auto.'
+    )
+    parser.add_argument(
+        '--threads',
+        type=lambda value: [int(item) for item in comma_separated(value)],
+        default=[1, 4, 16],
+        help='The comma-separated numbers of threads. Default - 1,4,16.'
+    )
+    parser.add_argument(
+        '--executor',
+        type=str,
+        default='thread',
+        choices=main.executors.keys(),
+        help='The executor of the operations. Default - thread.'
+    )
+    parser.add_argument(
+        '--scale',
+        type=float,
+        default=1.0,
+        help='The factor of the number of files per folder. Default - 1.'
+    )
+    parser.add_argument(
+        '--huge-size',
+        type=int,
+        default=DEFAULT_HUGE_SIZE,
+        help=f'The size of the files of the huge tree in bytes. Default - {DEFAULT_HUGE_SIZE}.'
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=1,
+        help='The number of runs of each combination, the fastest one is kept. Default - 1.'
+    )
+    parser.add_argument(
+        '--output',
+        type=Path,
+        default=None,
+        help='The path to the JSON file the results are written to.'
+    )
+    parser.add_argument(
+        '--baseline',
+        type=Path,
+        default=None,
+        help='The path to the JSON results of an earlier run to compare with.\n'
+             'The exit code is 1 if any result is a regression.'
+    )
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help='The fraction of the baseline throughput a result can lose\n'
+             f'without being a regression. Default - {DEFAULT_TOLERANCE}.'
+    )
+    parsed_args: argparse.Namespace = parser.parse_args(args=args)
+
+    for tree_name in parsed_args.trees:
+        if tree_name not in trees:
+            parser.error(f'unknown tree {tree_name}')
+
+    for operation in parsed_args.operations:
+        if operation not in ('copy', 'move'):
+            parser.error(f'unknown operation {operation}')
+
+    for engine in parsed_args.engines:
+        if (engine != 'auto') and (engine not in main.copy_engines):
+            parser.error(f'unknown copy engine {engine}')
+
+    if (not parsed_args.threads) or (min(parsed_args.threads) < 1):
+        parser.error('the numbers of threads must be at least 1')
+
+    if parsed_args.roots is None:
+        parsed_args.roots = get_default_roots()
+
+    return parsed_args
+
+
+def run(args: List[str]) -> int:
+    """Runs the benchmarks, returns the exit code."""
+    parsed_args: argparse.Namespace = parse_args(args=args)
+
+    results: List[Dict[str, object]] = run_benchmarks(
+        tree_names=parsed_args.trees,
+        roots=parsed_args.roots,
+        operations=parsed_args.operations,
+        engines=parsed_args.engines,
+        threads=parsed_args.threads,
+        executor=parsed_args.executor,
+        scale=parsed_args.scale,
+        huge_size=parsed_args.huge_size,
+        repeat=parsed_args.repeat
+    )
+
+    if parsed_args.output is not None:
+        parsed_args.output.write_text(
+            json.dumps({'environment': get_environment(), 'results': results}, indent=2),
+            encoding='utf-8'
+        )
+
+    if parsed_args.baseline is None:
+        return 0
+
+    baseline: List[Dict[str, object]] = \
+        json.loads(parsed_args.baseline.read_text(encoding='utf-8'))['results']
+    regressions: int = 0
+
+    for comparison in compare_with_baseline(results=results, baseline=baseline, tolerance=parsed_args.tolerance):
+        regressions += comparison['regression']
+        logging.info(
+            msg=f'{"REGRESSION " if comparison["regression"] else ""}'
+                f'{format_result(result=comparison["result"])} - '
+                f'x{comparison["files_per_second_ratio"]:.2f} files/s, '
+                f'x{comparison["mb_per_second_ratio"]:.2f} MB/s of the baseline'
+        )
+
+    logging.info(msg=f'{regressions} regressions')
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    sys.exit(run(args=sys.argv[1:]))
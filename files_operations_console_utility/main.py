@@ -1,189 +1,4092 @@
 import argparse
+import atexit
+import bisect
+import collections
+import contextlib
+import cProfile
+import datetime
+import errno
+import fnmatch
+import functools
+import hashlib
+import io
+import itertools
+import json
 import logging
 import logging.config
+import logging.handlers
+import multiprocessing
 import os
+import pstats
+import queue
+import re
 import shutil
+import sqlite3
+import stat
 import sys
+import tarfile
+import threading
+import time
+import tracemalloc
+from dataclasses import dataclass, field
 from concurrent.futures import (
+    Executor,
+    ProcessPoolExecutor,
     ThreadPoolExecutor,
     Future,
-    as_completed,
+    FIRST_COMPLETED,
+    wait,
 )
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 from typing import (
     Dict,
     Final,
     Callable,
+    ContextManager,
     Tuple,
     Optional,
     List,
     Set,
+    Iterable,
+    Iterator,
+    TypeVar,
+    Union,
+    Deque,
+    NamedTuple,
+    BinaryIO,
 )
 
 import yaml
 
+try:
+    import fcntl
+except ImportError:
+    # Reflinks are not available on this platform.
+    fcntl = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+T = TypeVar('T')
+
+# The number of pending source files buffered per thread
+# between the enumeration and the workers.
+QUEUE_SIZE_PER_THREAD: Final[int] = 64
+
+# The number of folders of found files buffered per thread of the parallel walk.
+WALK_QUEUE_SIZE_PER_THREAD: Final[int] = 16
+# An idle thread of the parallel walk looks for folders to steal every this number of seconds.
+WALK_IDLE_TIMEOUT: Final[float] = 0.01
+
+# The number of threads creating the destination folders.
+FOLDER_CREATION_THREADS: Final[int] = 8
+# The maximum number of files held back until their destination folders are created.
+FOLDER_CREATION_WINDOW: Final[int] = 1024
+# The number of bytes read from the list of the source files at once (--files-from).
+FILE_LIST_READ_SIZE: Final[int] = 64 * 1024
+
+# The maximum number of submitted but not yet completed operations per thread.
+IN_FLIGHT_TASKS_PER_THREAD: Final[int] = 4
+
+# The ioctl request cloning a whole file on btrfs and XFS (linux/fs.h).
+FICLONE: Final[int] = 0x40049409
+
+# The maximum number of bytes copied by a single kernel-side call.
+COPY_CHUNK_SIZE: Final[int] = 2 ** 30
+
+# The buffer size used by the userspace copy loop.
+COPY_BUFFER_SIZE: Final[int] = 2 ** 20
+
+# Files smaller than this size are packed into batches run as one operation.
+DEFAULT_SMALL_FILE_SIZE: Final[int] = 64 * 2 ** 10
+
+# The maximum number of small files run as one operation.
+SMALL_FILE_BATCH_SIZE: Final[int] = 32
+
+# The number of files per thread reordered largest first before they are submitted.
+SCHEDULE_WINDOW_PER_THREAD: Final[int] = 16
+
+# The index of the synced files kept in the destination folder.
+SYNC_INDEX_NAME: Final[str] = '.files_operations_sync.sqlite'
+# The number of synced files written to the index at once.
+SYNC_INDEX_BATCH_SIZE: Final[int] = 1024
+
+# The journal of the files copied to the destination folder.
+JOURNAL_NAME: Final[str] = '.files_operations_journal'
+# The number of journal records synced to the disk at once.
+JOURNAL_BATCH_SIZE: Final[int] = 1024
+
+# The manifest of the digests of the files copied to the destination folder.
+MANIFEST_NAME_FORMAT: Final[str] = '.files_operations_manifest.{algorithm}'
+
+# The archive path standing for the standard output or input.
+STANDARD_STREAM: Final[str] = '-'
+# The suffixes of the tar archive paths: uncompressed, gzip and zstd.
+ARCHIVE_SUFFIXES: Final[Tuple[str, ...]] = ('.tar', '.tar.gz', '.tar.zst')
+# Files up to this size are read by the archive workers,
+# larger files are streamed by the archive writer or reader itself.
+ARCHIVE_READ_SIZE: Final[int] = 2 ** 20
+# The permission bits of the extracted files, without the setuid, setgid and sticky bits.
+EXTRACTED_MODE_MASK: Final[int] = 0o777
+
+# The successes are summarized every this number of seconds.
+SUMMARY_INTERVAL: Final[float] = 5.0
+# The number of lines of the report written at once.
+REPORT_BATCH_SIZE: Final[int] = 1024
+
+# The progress line and the stats files are refreshed every this number of seconds.
+METRICS_INTERVAL: Final[float] = 1.0
+# The upper bounds of the size buckets of the operation latencies.
+METRICS_SIZE_BUCKETS: Final[Tuple[int, ...]] = (2 ** 12, 2 ** 16, 2 ** 20, 2 ** 24, 2 ** 28)
+# The upper bounds of the latency histogram buckets in seconds.
+METRICS_LATENCY_BUCKETS: Final[Tuple[float, ...]] = (0.001, 0.01, 0.1, 1.0, 10.0, 100.0)
+
+# The stacks of the threads are sampled every this number of seconds by the sample profiler.
+PROFILE_SAMPLE_INTERVAL: Final[float] = 0.01
+# The number of frames of the allocation tracebacks traced by the tracemalloc profiler,
+# tracing each frame slows down every allocation.
+PROFILE_TRACEMALLOC_FRAMES: Final[int] = 8
+# The traced memory is checked for a new peak every this number of seconds.
+PROFILE_SNAPSHOT_INTERVAL: Final[float] = 1.0
+
+# The default number of worker processes of the process and hybrid executors.
+DEFAULT_PROCESSES: Final[int] = os.cpu_count() or 1
+
+# The --threads value tuning the number of threads during the run.
+AUTO_THREADS: Final[str] = 'auto'
+# The maximum number of threads tried by the autotuning.
+AUTOTUNE_MAX_THREADS: Final[int] = 64
+# The throughput is measured over windows of this number of seconds.
+AUTOTUNE_WINDOW: Final[float] = 1.0
+# The throughput improves if it grows by more than this fraction.
+AUTOTUNE_TOLERANCE: Final[float] = 0.05
+# The settled number of threads is tuned again when the throughput changes by more than this fraction.
+AUTOTUNE_CHANGE: Final[float] = 0.25
+
+# A throttled submission waits for the token buckets in steps of at most this number of seconds,
+# outputting the completed operations in between.
+THROTTLE_WAIT_STEP: Final[float] = 0.1
+# The throttle file is checked for new limits every this number of seconds.
+THROTTLE_RELOAD_INTERVAL: Final[float] = 1.0
+# A copy limited by --max-bandwidth takes the bandwidth of at most this number of bytes at once,
+# a buffer of the userspace copy loop.
+THROTTLED_COPY_SIZE: Final[int] = COPY_BUFFER_SIZE
+# The multipliers of the size suffixes of --max-bandwidth and the throttle file.
+SIZE_UNITS: Final[Dict[str, int]] = {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+# Files of at least this size are copied by chunks in several threads.
+DEFAULT_CHUNK_THRESHOLD: Final[int] = 256 * 2 ** 20
+
+# The size of a byte range copied by one thread.
+DEFAULT_CHUNK_SIZE: Final[int] = 64 * 2 ** 20
+
+# The number of moved source files unlinked at once in the background.
+UNLINK_BATCH_SIZE: Final[int] = 256
+
+# Errors meaning that a copy engine is not supported
+# by the source and destination filesystems.
+UNSUPPORTED_ENGINE_ERRNOS: Final[Set[int]] = {
+    errno.ENOSYS,
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOTTY,
+    errno.EBADF,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+}
+
+# The errors of a link to a duplicate file copied instead.
+UNSUPPORTED_LINK_ERRNOS: Final[Set[int]] = {
+    *UNSUPPORTED_ENGINE_ERRNOS,
+    errno.EMLINK,
+    errno.EPERM,
+}
+
+# The size in bytes of the head of a file hashed to find its duplicates.
+DEDUPE_PARTIAL_SIZE: Final[int] = 64 * 2 ** 10
+# The number of files hashed at once by the threads finding the duplicates.
+DEDUPE_WINDOW_SIZE: Final[int] = 256
+
+# The listener running the handlers of the root logger in a background thread.
+log_listener: Optional[logging.handlers.QueueListener] = None
+
+
+@atexit.register
+def stop_logging() -> None:
+    """Handle the records left in the queue and stop the listener."""
+    global log_listener
+
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
 
 def setup_logging(config_file_path: str = '../logging.yaml'):
-    """Setup logging from yaml file."""
+    """Setup logging from yaml file.
+
+    The handlers listed in queue_handlers are run by a listener
+    in a background thread, the root logger only puts the records to a queue.
+    """
+    global log_listener
+
     with open(config_file_path, 'r') as file:
         config = yaml.safe_load(file)
 
-    logging.config.dictConfig(config)
+    queue_handlers: List[str] = config.pop('queue_handlers', [])
+
+    stop_logging()
+    logging.config.dictConfig(config)
+
+    root: logging.Logger = logging.getLogger()
+    handlers: List[logging.Handler] = [handler for handler in root.handlers if handler.name in queue_handlers]
+
+    if not handlers:
+        return
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+
+    for handler in handlers:
+        root.removeHandler(handler)
+
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+
+
+def check_paths_exists(source: Path, destination: Path) -> bool:
+    """Check that source and destination paths exist."""
+    def check_path_exists(path: Path) -> bool:
+        if not path.exists():
+            logging.error(msg=f'{path.name} does not exists.')
+
+        return path.exists()
+
+    return check_path_exists(path=source) and check_path_exists(path=destination)
+
+
+def extract_path_and_mask(path: str) -> Tuple[Path, Optional[str]]:
+    """Extract path and mask (if any) from the specified path."""
+    elements: Tuple[str, str, str] = path.partition('*')
+
+    new_path: Path = Path(elements[0])
+    mask: Optional[str] = None
+
+    if elements[1] != '':
+        mask = f'{elements[1]}{elements[2]}'
+
+    return new_path, mask
+
+
+# The bandwidth limit shared by the copies of all workers, see Throttle.
+worker_bandwidth: Optional['TokenBucket'] = None
+
+
+def set_worker_bandwidth(bucket: Optional['TokenBucket']) -> None:
+    """Sets the bandwidth limit of the copies of the workers (of the worker process)."""
+    global worker_bandwidth
+
+    worker_bandwidth = bucket
+
+
+def take_bandwidth(size: int) -> int:
+    """Waits until the bandwidth limit (if any) allows copying the next bytes
+    and returns the number of bytes of at most the specified size to copy now."""
+    bucket: Optional[TokenBucket] = worker_bandwidth
+
+    if (bucket is None) or (bucket.rate is None):
+        return size
+
+    size = min(size, THROTTLED_COPY_SIZE)
+    bucket.acquire(tokens=size)
+
+    return size
+
+
+def copy_reflink(source_fd: int, destination_fd: int, size: int) -> None:
+    """Clone the file data with a copy-on-write reflink."""
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, 'Reflinks are not supported')
+
+    fcntl.ioctl(destination_fd, FICLONE, source_fd)
+
+
+def copy_range(source_fd: int, destination_fd: int, size: int) -> None:
+    """Copy the file data inside the kernel with os.copy_file_range."""
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'copy_file_range is not supported')
+
+    offset: int = 0
+
+    while offset < size:
+        copied: int = os.copy_file_range(
+            source_fd,
+            destination_fd,
+            take_bandwidth(size=min(size - offset, COPY_CHUNK_SIZE)),
+            offset,
+            offset
+        )
+
+        # The source file has been truncated during the copy.
+        if copied == 0:
+            break
+
+        offset += copied
+
+
+def copy_sendfile(source_fd: int, destination_fd: int, size: int) -> None:
+    """Copy the file data inside the kernel with os.sendfile."""
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.ENOSYS, 'sendfile to a file is not supported')
+
+    offset: int = 0
+
+    while offset < size:
+        sent: int = os.sendfile(
+            destination_fd,
+            source_fd,
+            offset,
+            take_bandwidth(size=min(size - offset, COPY_CHUNK_SIZE))
+        )
+
+        # The source file has been truncated during the copy.
+        if sent == 0:
+            break
+
+        offset += sent
+
+
+def copy_buffered(source_fd: int, destination_fd: int, size: int, hasher: Optional['hashlib._Hash'] = None) -> None:
+    """Copy the file data through a userspace buffer up to the end of the file,
+    feeding the data to the hasher (if any)."""
+    while True:
+        data: bytes = os.read(source_fd, COPY_BUFFER_SIZE)
+
+        if not data:
+            break
+
+        if hasher is not None:
+            hasher.update(data)
+
+        # The size is unknown, the data read is taken.
+        take_bandwidth(size=len(data))
+
+        view: memoryview = memoryview(data)
+
+        while view:
+            view = view[os.write(destination_fd, view):]
+
+
+# Copy engines from the fastest to the most portable one.
+copy_engines: Final[Dict[str, Callable[[int, int, int], None]]] = {
+    'reflink': copy_reflink,
+    'copy_file_range': copy_range,
+    'sendfile': copy_sendfile,
+    'buffered': copy_buffered,
+}
+
+# The first supported copy engine
+# for each pair of source and destination devices.
+device_copy_engines: Dict[Tuple[int, int], str] = {}
+
+
+def copy_file_data(
+        source: Path,
+        destination: Path,
+        engine: str = 'auto',
+        hasher: Optional['hashlib._Hash'] = None
+) -> str:
+    """Copy the file data to the destination file.
+
+    Copy engines are tried starting from the specified one ('auto' - the fastest one),
+    an engine not supported by the filesystems falls back to the next one.
+    The first supported engine is cached per source and destination devices.
+    The data copied by the buffered engine is fed to the hasher (if any).
+    Returns the name of the engine that copied the data.
+    """
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        raise shutil.SameFileError(f'{source} and {destination} are the same file')
+
+    engine_names: List[str] = list(copy_engines.keys())
+
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        source_fd: int = source_file.fileno()
+        destination_fd: int = destination_file.fileno()
+        source_stat: os.stat_result = os.fstat(source_fd)
+        devices: Tuple[int, int] = (source_stat.st_dev, os.fstat(destination_fd).st_dev)
+
+        start: int = 0 if engine == 'auto' else engine_names.index(engine)
+        start = max(start, engine_names.index(device_copy_engines.get(devices, engine_names[0])))
+
+        # Files reporting no size (such as in /proc) are read up to the end.
+        if source_stat.st_size == 0:
+            start = len(engine_names) - 1
+
+        for engine_name in engine_names[start:]:
+            try:
+                if (engine_name == 'buffered') and (hasher is not None):
+                    copy_buffered(source_fd, destination_fd, source_stat.st_size, hasher=hasher)
+                else:
+                    copy_engines[engine_name](source_fd, destination_fd, source_stat.st_size)
+            except OSError as exception:
+                if (exception.errno not in UNSUPPORTED_ENGINE_ERRNOS) or \
+                   (engine_name == engine_names[-1]):
+                    raise
+
+                # Start the next engine from scratch.
+                os.ftruncate(destination_fd, 0)
+                os.lseek(destination_fd, 0, os.SEEK_SET)
+                os.lseek(source_fd, 0, os.SEEK_SET)
+
+                continue
+
+            if source_stat.st_size != 0:
+                device_copy_engines[devices] = engine_name
+
+            return engine_name
+
+
+def copy(source: Path, destination: Path, engine: str = 'auto') -> None:
+    """Copy the file data and metadata to the destination."""
+    if os.path.isdir(destination):
+        destination = Path(destination) / Path(source).name
+
+    copy_file_data(source=source, destination=destination, engine=engine)
+    shutil.copystat(src=source, dst=destination)
+
+
+class VerificationError(Exception):
+    """The data of the copied file differs from the source file."""
+
+
+# The hash algorithms used to verify the copied files.
+hash_algorithms: Final[Dict[str, Callable[[], 'hashlib._Hash']]] = {
+    'blake2': hashlib.blake2b,
+    'sha256': hashlib.sha256,
+}
+
+if xxhash is not None:
+    hash_algorithms['xxhash'] = xxhash.xxh3_128
+
+
+def hash_file(path: Path, algorithm: str) -> str:
+    """Returns the hex digest of the file data."""
+    hasher = hash_algorithms[algorithm]()
+
+    with open(path, 'rb') as file:
+        for data in iter(functools.partial(file.read, COPY_BUFFER_SIZE), b''):
+            hasher.update(data)
+
+    return hasher.hexdigest()
+
+
+def hash_range(file: BinaryIO, offset: int, length: int, hashers: List['hashlib._Hash']) -> None:
+    """Feeds the byte range of the open file to the hashers."""
+    file.seek(offset)
+
+    while length > 0:
+        data: bytes = file.read(min(length, COPY_BUFFER_SIZE))
+
+        if not data:
+            break
+
+        for hasher in hashers:
+            hasher.update(data)
+
+        length -= len(data)
+
+
+def verify_copy(source: Path, destination: Path, algorithm: str = 'sha256', digest: Optional[str] = None) -> str:
+    """Hash the copied destination file and compare its digest with the digest of the source,
+    computed while it was copied, the source is hashed again if it is not specified.
+
+    Returns the digest of the file.
+    """
+    if digest is None:
+        digest = hash_file(path=source, algorithm=algorithm)
+
+    destination_digest: str = hash_file(path=destination, algorithm=algorithm)
+
+    if destination_digest != digest:
+        raise VerificationError(f'{destination} digest {destination_digest} differs from {digest}')
+
+    return digest
+
+
+def verify_chunks(
+        source: Path,
+        destination: Path,
+        algorithm: str,
+        chunk_size: int,
+        chunk_digests: Dict[int, Optional[str]]
+) -> str:
+    """Hash the file copied by chunks and compare the digest of each destination chunk
+    with the digest of the source chunk (by its offset) computed while it was copied.
+
+    The source chunks without digests (copied inside the kernel, by a reflink
+    or by an interrupted run) are hashed again.
+    Returns the digest of the file.
+    """
+    hasher = hash_algorithms[algorithm]()
+    size: int = os.path.getsize(destination)
+    offsets: range = range(0, size, chunk_size)
+    rehashed: bool = any(chunk_digests.get(offset) is None for offset in offsets)
+
+    with open(destination, 'rb') as destination_file, \
+            open(source, 'rb') if rehashed else contextlib.nullcontext() as source_file:
+        for offset in offsets:
+            length: int = min(chunk_size, size - offset)
+            chunk_hasher = hash_algorithms[algorithm]()
+            hash_range(file=destination_file, offset=offset, length=length, hashers=[hasher, chunk_hasher])
+            digest: Optional[str] = chunk_digests.get(offset)
+
+            if digest is None:
+                source_hasher = hash_algorithms[algorithm]()
+                hash_range(file=source_file, offset=offset, length=length, hashers=[source_hasher])
+                digest = source_hasher.hexdigest()
+
+            if chunk_hasher.hexdigest() != digest:
+                raise VerificationError(f'{destination} chunk at {offset} differs from the source')
+
+    return hasher.hexdigest()
+
+
+def copy_verified(source: Path, destination: Path, engine: str = 'auto', algorithm: str = 'sha256') -> str:
+    """Copy the file data and metadata to the destination by the copy engine,
+    hashing the source data while it is copied, then verify the copied file, see verify_copy.
+
+    The reflink, copy_file_range and sendfile engines copy the data
+    without reading it into userspace, so the source is read again to hash it.
+    Returns the digest of the file.
+    """
+    if os.path.isdir(destination):
+        destination = Path(destination) / Path(source).name
+
+    hasher = hash_algorithms[algorithm]()
+    engine_name: str = copy_file_data(source=source, destination=destination, engine=engine, hasher=hasher)
+    shutil.copystat(src=source, dst=destination)
+
+    return verify_copy(
+        source=source,
+        destination=destination,
+        algorithm=algorithm,
+        digest=hasher.hexdigest() if engine_name == 'buffered' else None
+    )
+
+
+def link_duplicate(
+        source: Path,
+        destination: Path,
+        original: Path,
+        method: str = 'hardlink',
+        engine: str = 'auto'
+) -> None:
+    """Create the destination of the source file from the destination
+    of the original file with the same data: a hard link to it ('hardlink')
+    or its copy-on-write clone with the metadata of the source file ('reflink').
+
+    The source file is copied if the link is not supported.
+    """
+    try:
+        if method == 'hardlink':
+            if os.path.lexists(destination):
+                os.unlink(destination)
+
+            os.link(original, destination)
+
+            return
+
+        with open(original, 'rb') as original_file, open(destination, 'wb') as destination_file:
+            copy_reflink(
+                source_fd=original_file.fileno(),
+                destination_fd=destination_file.fileno(),
+                size=os.fstat(original_file.fileno()).st_size
+            )
+
+        shutil.copystat(src=source, dst=destination)
+    except OSError as exception:
+        if exception.errno not in UNSUPPORTED_LINK_ERRNOS:
+            raise
+
+        copy(source=source, destination=destination, engine=engine)
+
+
+def move(source: Path, destination: Path, engine: str = 'auto') -> None:
+    """Move the file to the destination."""
+    shutil.move(
+        src=source,
+        dst=destination,
+        copy_function=functools.partial(copy, engine=engine)
+    )
+
+
+def rename_tree(source: Path, destination: Path, engine: str = 'auto') -> List[Path]:
+    """Move the file or folder to the destination path with a rename.
+
+    A folder is merged into the existing destination folder
+    by renaming its entries, folder by folder.
+    Returns the source paths of the renamed entries, a renamed folder is not walked.
+    """
+    source_folder: bool = os.path.isdir(source) and not os.path.islink(source)
+
+    if source_folder and os.path.isdir(destination) and not os.path.islink(destination):
+        with os.scandir(source) as entries:
+            names: List[str] = [entry.name for entry in entries]
+
+        renamed_entries: List[Path] = []
+
+        for name in names:
+            renamed_entries.extend(rename_tree(source=source / name, destination=destination / name, engine=engine))
+
+        return renamed_entries
+
+    move(source=source, destination=destination, engine=engine)
+
+    return [source]
+
+
+def is_same_device(source: Path, destination: Path) -> bool:
+    """Check that source and destination paths are on the same device."""
+    return os.stat(source).st_dev == os.stat(destination).st_dev
+
+
+def is_tree_rename(operation_name: str, source: Path, destination: Optional[Path], whole_folder: bool) -> bool:
+    """Returns whether the move renames the top-level entries of the source folder
+    instead of moving the files one by one, see create_rename_paths."""
+    return (operation_name == 'move') and (destination is not None) and whole_folder and \
+        source.is_dir() and is_same_device(source=source, destination=destination)
+
+
+def create_rename_paths(source: Path, destination: Path) -> Iterator[Tuple[Path, Path]]:
+    """Yields pairs of
+    the path to the top-level entry of the source folder
+    and the destination path of the entry.
+    """
+    with os.scandir(source) as entries:
+        for entry in entries:
+            yield Path(entry.path), destination / entry.name
+
+
+def preallocate_file(
+        source: Path,
+        destination: Path,
+        size: int,
+        engine: str = 'auto',
+        keep_data: bool = False
+) -> Optional[str]:
+    """Create the destination file of the specified size for a chunked copy.
+
+    If keep_data is set, the data of the existing destination file is kept,
+    so an interrupted chunked copy can be resumed.
+    Returns the engine to copy the chunks with,
+    or None when the whole file has already been cloned with a reflink.
+    """
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        raise shutil.SameFileError(f'{source} and {destination} are the same file')
+
+    engine_names: List[str] = list(copy_engines.keys())
+
+    with open(source, 'rb') as source_file, open(destination, 'r+b' if keep_data else 'wb') as destination_file:
+        source_fd: int = source_file.fileno()
+        destination_fd: int = destination_file.fileno()
+        devices: Tuple[int, int] = (os.fstat(source_fd).st_dev, os.fstat(destination_fd).st_dev)
+
+        start: int = 0 if engine == 'auto' else engine_names.index(engine)
+        start = max(start, engine_names.index(device_copy_engines.get(devices, engine_names[0])))
+
+        if engine_names[start] == 'reflink':
+            try:
+                copy_reflink(source_fd=source_fd, destination_fd=destination_fd, size=size)
+                device_copy_engines[devices] = 'reflink'
+
+                return None
+            except OSError as exception:
+                if exception.errno not in UNSUPPORTED_ENGINE_ERRNOS:
+                    raise
+
+            start += 1
+
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(destination_fd, 0, size)
+            except OSError as exception:
+                if exception.errno not in UNSUPPORTED_ENGINE_ERRNOS:
+                    raise
+
+        os.ftruncate(destination_fd, size)
+
+    return 'copy_file_range' if engine_names[start] == 'copy_file_range' else 'buffered'
+
+
+def copy_chunk(
+        source: Path,
+        destination: Path,
+        offset: int,
+        length: int,
+        engine: str,
+        algorithm: Optional[str] = None
+) -> Optional[str]:
+    """Copy the byte range of the file data into the preallocated destination file.
+
+    If algorithm is set, returns the digest of the range hashed while it is copied
+    through a userspace buffer, None when it has been copied inside the kernel.
+    """
+    with open(source, 'rb') as source_file, open(destination, 'r+b') as destination_file:
+        end: int = offset + length
+
+        if (engine == 'copy_file_range') and hasattr(os, 'copy_file_range'):
+            try:
+                while offset < end:
+                    copied: int = os.copy_file_range(
+                        source_file.fileno(),
+                        destination_file.fileno(),
+                        take_bandwidth(size=end - offset),
+                        offset,
+                        offset
+                    )
+
+                    # The source file has been truncated during the copy.
+                    if copied == 0:
+                        return None
+
+                    offset += copied
+
+                return None
+            except OSError as exception:
+                if exception.errno not in UNSUPPORTED_ENGINE_ERRNOS:
+                    raise
+
+        source_file.seek(offset)
+        destination_file.seek(offset)
+        hasher = hash_algorithms[algorithm]() if algorithm is not None else None
+
+        while offset < end:
+            data: bytes = source_file.read(take_bandwidth(size=min(end - offset, COPY_BUFFER_SIZE)))
+
+            if not data:
+                break
+
+            if hasher is not None:
+                hasher.update(data)
+
+            destination_file.write(data)
+            offset += len(data)
+
+    return hasher.hexdigest() if hasher is not None else None
+
+
+operations: Final[Dict[str, Callable[[Path, Path, str], None]]] = {
+    'copy': copy,
+    'move': move,
+    # Copies only the files changed since the last sync, see SyncIndex.
+    'sync': copy
+}
+
+
+# Matches a single path component of a mask.
+# None stands for the recursive '**' component.
+ComponentMatcher = Optional[Callable[[str], object]]
+
+
+def compile_mask(mask: str) -> List[ComponentMatcher]:
+    """Compiles the mask into a list of path component matchers.
+
+    The mask follows the Path.glob syntax, so the walk selects
+    exactly the same files as Path.glob would.
+    """
+    parts: Tuple[str, ...] = Path(mask).parts
+
+    if Path(mask).anchor != '':
+        raise NotImplementedError('Non-relative patterns are unsupported')
+
+    if len(parts) == 0:
+        raise ValueError(f'Unacceptable pattern: {mask!r}')
+
+    flags: int = re.IGNORECASE if os.name == 'nt' else 0
+    matchers: List[ComponentMatcher] = []
+
+    for part in parts:
+        if part == '**':
+            # Consecutive '**' components select the same directories as one.
+            if (len(matchers) == 0) or (matchers[-1] is not None):
+                matchers.append(None)
+        elif '**' in part:
+            raise ValueError(
+                "Invalid pattern: '**' can only be an entire path component"
+            )
+        elif part == '*':
+            matchers.append(bool)
+        else:
+            matchers.append(re.compile(fnmatch.translate(part), flags).fullmatch)
+
+    return matchers
+
+
+def compile_patterns(patterns: Iterable[str]) -> Tuple[ComponentMatcher, ComponentMatcher]:
+    """Compiles the patterns into one matcher of the names
+    (the patterns without '/') and one matcher of the relative paths
+    (the patterns with '/'), None if there are no such patterns."""
+    flags: int = re.IGNORECASE if os.name == 'nt' else 0
+    name_patterns: List[str] = []
+    path_patterns: List[str] = []
+
+    for pattern in patterns:
+        if '/' in pattern:
+            path_patterns.append(fnmatch.translate(pattern.lstrip('/')))
+        else:
+            name_patterns.append(fnmatch.translate(pattern))
+
+    return tuple(
+        re.compile('|'.join(translated_patterns), flags).match if translated_patterns else None
+        for translated_patterns in (name_patterns, path_patterns)
+    )
+
+
+class PathFilter:
+    """Selects the files by include and exclude patterns, size and modification time.
+
+    A pattern without '/' matches the name of a file or folder at any depth,
+    a pattern with '/' matches its path relative to the root
+    ('*' also matches '/' there). An exclude pattern ending with '/'
+    matches folders only. The excluded folders are not walked.
+    If there are include patterns, only the files matching any of them are selected.
+    All patterns are compiled into a few combined regular expressions.
+    """
+
+    def __init__(
+            self,
+            root: Path,
+            include: Iterable[str] = (),
+            exclude: Iterable[str] = (),
+            min_size: Optional[int] = None,
+            max_size: Optional[int] = None,
+            modified_after: Optional[float] = None,
+            modified_before: Optional[float] = None
+    ):
+        exclude = list(exclude)
+        include = list(include)
+
+        self.root_length: int = len(os.path.join(str(root), ''))
+        self.include: bool = len(include) > 0
+        self.include_name, self.include_path = compile_patterns(patterns=include)
+        self.exclude_name, self.exclude_path = \
+            compile_patterns(patterns=[pattern for pattern in exclude if not pattern.endswith('/')])
+        self.exclude_folder_name, self.exclude_folder_path = \
+            compile_patterns(patterns=[pattern.rstrip('/') for pattern in exclude if pattern.endswith('/')])
+        self.min_size: Optional[int] = min_size
+        self.max_size: Optional[int] = max_size
+        self.modified_after: Optional[float] = modified_after
+        self.modified_before: Optional[float] = modified_before
+        self.with_stats: bool = any(
+            limit is not None for limit in (min_size, max_size, modified_after, modified_before)
+        )
+
+    def get_relative_path(self, path: str) -> str:
+        relative_path: str = path[self.root_length:]
+
+        return relative_path.replace(os.sep, '/') if os.sep != '/' else relative_path
+
+    @staticmethod
+    def matches(name_matcher: ComponentMatcher, path_matcher: ComponentMatcher, name: str, path: str) -> bool:
+        return ((name_matcher is not None) and (name_matcher(name) is not None)) or \
+               ((path_matcher is not None) and (path_matcher(path) is not None))
+
+    def excludes_folder(self, entry: os.DirEntry) -> bool:
+        relative_path: str = self.get_relative_path(path=entry.path)
+
+        return self.matches(self.exclude_name, self.exclude_path, entry.name, relative_path) or \
+            self.matches(self.exclude_folder_name, self.exclude_folder_path, entry.name, relative_path)
+
+    def selects_file(self, entry: Union[os.DirEntry, Path]) -> bool:
+        relative_path: str = self.get_relative_path(path=os.fspath(entry))
+
+        if self.matches(self.exclude_name, self.exclude_path, entry.name, relative_path):
+            return False
+
+        if self.include and not self.matches(self.include_name, self.include_path, entry.name, relative_path):
+            return False
+
+        if not self.with_stats:
+            return True
+
+        stat: os.stat_result = entry.stat()
+
+        return ((self.min_size is None) or (stat.st_size >= self.min_size)) and \
+               ((self.max_size is None) or (stat.st_size <= self.max_size)) and \
+               ((self.modified_after is None) or (stat.st_mtime >= self.modified_after)) and \
+               ((self.modified_before is None) or (stat.st_mtime < self.modified_before))
+
+
+def scan_directory(
+        path: str,
+        index: int,
+        matchers: List[ComponentMatcher],
+        path_filter: Optional[PathFilter] = None,
+        with_folders: bool = False
+) -> Tuple[List[Tuple[str, int]], List[os.DirEntry]]:
+    """Scans the directory reached by the first index matchers of the compiled mask.
+
+    Returns the subdirectories to scan with the indexes of their matchers
+    and the file entries matching the mask (and the folder entries if with_folders is set).
+    The entry type is taken from the cached DirEntry information,
+    so no extra stat call is made for regular entries.
+    Symbolic links to directories are not followed by '**'.
+    Directories that cannot be read or excluded by the filter (if any) are skipped.
+    """
+    recursive: bool = matchers[index] is None
+
+    if recursive:
+        index += 1
+
+    matcher: Callable[[str], object] = matchers[index]
+    last_index: int = len(matchers) - 1
+    subdirectories: List[Tuple[str, int]] = []
+    files: List[os.DirEntry] = []
+
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if recursive and entry.is_dir(follow_symlinks=False):
+                    if (path_filter is None) or not path_filter.excludes_folder(entry=entry):
+                        subdirectories.append((entry.path, index - 1))
+
+                if not matcher(entry.name):
+                    continue
+
+                if index < last_index:
+                    if entry.is_dir() and ((path_filter is None) or not path_filter.excludes_folder(entry=entry)):
+                        subdirectories.append((entry.path, index + 1))
+                elif entry.is_file():
+                    if (path_filter is None) or path_filter.selects_file(entry=entry):
+                        files.append(entry)
+                elif with_folders and entry.is_dir(follow_symlinks=False):
+                    if (path_filter is None) or not path_filter.excludes_folder(entry=entry):
+                        files.append(entry)
+    except PermissionError:
+        pass
+
+    return subdirectories, files
+
+
+class ParallelWalker:
+    """Walks the directory tree with several threads stealing work from each other.
+
+    Each thread scans the directories of its own deque, newest first,
+    and pushes the subdirectories it finds to it.
+    An idle thread steals the oldest directory (the root of the largest
+    known subtree) from the deques of the other threads.
+    The file entries found in each directory are put to the shared queue
+    as one batch, each thread puts None when the walk is over.
+    """
+
+    def __init__(
+            self,
+            directory: str,
+            matchers: List[ComponentMatcher],
+            threads: int,
+            path_filter: Optional[PathFilter] = None,
+            with_folders: bool = False
+    ):
+        self.matchers: List[ComponentMatcher] = matchers
+        self.path_filter: Optional[PathFilter] = path_filter
+        self.with_folders: bool = with_folders
+        self.deques: List[Deque[Tuple[str, int]]] = [collections.deque() for _ in range(threads)]
+        self.deques[0].append((directory, 0))
+        # The number of directories not scanned yet, including those being scanned.
+        self.pending: int = 1
+        self.condition: threading.Condition = threading.Condition()
+        self.output: queue.Queue = queue.Queue(maxsize=threads * WALK_QUEUE_SIZE_PER_THREAD)
+        # The walk is stopped by an error or by the consumer,
+        # nothing is put to the queue once the consumer is closed.
+        self.stopped: threading.Event = threading.Event()
+        self.closed: threading.Event = threading.Event()
+        self.errors: List[BaseException] = []
+        self.threads: List[threading.Thread] = [
+            threading.Thread(target=self.walk, args=(number,), name=f'walker-{number}', daemon=True)
+            for number in range(threads)
+        ]
+
+    def start(self) -> None:
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+        with self.condition:
+            self.condition.notify_all()
+
+    def close(self) -> None:
+        self.closed.set()
+        self.stop()
+
+    def put(self, item: Optional[List[os.DirEntry]]) -> None:
+        while not self.closed.is_set():
+            try:
+                self.output.put(item, timeout=0.1)
+
+                return
+            except queue.Full:
+                pass
+
+    def get_directory(self, number: int) -> Optional[Tuple[str, int]]:
+        """Returns the next directory to scan by the thread,
+        None when all directories have been scanned."""
+        while not self.stopped.is_set():
+            try:
+                return self.deques[number].pop()
+            except IndexError:
+                pass
+
+            for other_number in itertools.chain(range(number + 1, len(self.deques)), range(number)):
+                try:
+                    return self.deques[other_number].popleft()
+                except IndexError:
+                    pass
+
+            with self.condition:
+                if self.pending == 0:
+                    return None
+
+                self.condition.wait(timeout=WALK_IDLE_TIMEOUT)
+
+        return None
+
+    def walk(self, number: int) -> None:
+        try:
+            while True:
+                directory: Optional[Tuple[str, int]] = self.get_directory(number=number)
+
+                if directory is None:
+                    break
+
+                subdirectories, files = scan_directory(
+                    path=directory[0],
+                    index=directory[1],
+                    matchers=self.matchers,
+                    path_filter=self.path_filter,
+                    with_folders=self.with_folders
+                )
+
+                # The subdirectories are counted before they can be stolen
+                # and before put blocks, so the other walkers do not see the walk finished.
+                with self.condition:
+                    self.pending += len(subdirectories)
+                    self.deques[number].extend(subdirectories)
+
+                    if subdirectories:
+                        self.condition.notify(len(subdirectories))
+
+                if files:
+                    self.put(item=files)
+
+                with self.condition:
+                    self.pending -= 1
+
+                    if self.pending == 0:
+                        self.condition.notify_all()
+        except BaseException as exception:
+            self.errors.append(exception)
+            self.stop()
+
+        self.put(item=None)
+
+
+def scan_files(
+        directory: str,
+        matchers: List[ComponentMatcher],
+        walkers: int = 1,
+        path_filter: Optional[PathFilter] = None,
+        with_folders: bool = False
+) -> Iterator[os.DirEntry]:
+    """Walks the directory with os.scandir
+    and yields the file entries (and the folder entries if with_folders is set)
+    matching the compiled mask and selected by the filter (if any), see scan_directory.
+
+    With several walkers, the directory tree is walked
+    by a pool of threads stealing work from each other, see ParallelWalker,
+    which hides the latency of the network filesystems.
+    The files are then yielded in no particular order.
+    """
+    # A trailing '**' selects directories only.
+    if matchers[-1] is None:
+        return
+
+    # Only several '**' components can select the same file twice.
+    yielded: Optional[Set[str]] = \
+        set() if matchers.count(None) > 1 else None
+
+    def select(files: List[os.DirEntry]) -> Iterator[os.DirEntry]:
+        for entry in files:
+            if yielded is not None:
+                if entry.path in yielded:
+                    continue
+
+                yielded.add(entry.path)
+
+            yield entry
+
+    if walkers <= 1:
+        stack: List[Tuple[str, int]] = [(directory, 0)]
+
+        while stack:
+            path, index = stack.pop()
+            subdirectories, files = scan_directory(
+                path=path,
+                index=index,
+                matchers=matchers,
+                path_filter=path_filter,
+                with_folders=with_folders
+            )
+            stack.extend(subdirectories)
+
+            yield from select(files=files)
+
+        return
+
+    walker: ParallelWalker = ParallelWalker(
+        directory=directory,
+        matchers=matchers,
+        threads=walkers,
+        path_filter=path_filter,
+        with_folders=with_folders
+    )
+    walker.start()
+
+    try:
+        finished: int = 0
+
+        while finished < walkers:
+            files: Optional[List[os.DirEntry]] = walker.output.get()
+
+            if files is None:
+                finished += 1
+            else:
+                yield from select(files=files)
+
+        if walker.errors:
+            raise walker.errors[0]
+    finally:
+        # Stop the walk when the consumer stops early.
+        walker.close()
+
+
+def list_files(
+        source: Path,
+        mask: Optional[str],
+        walkers: int = 1,
+        path_filter: Optional[PathFilter] = None,
+        with_folders: bool = False
+) -> Iterator[Path]:
+    """Returns an iterator over all files (and folders if with_folders is set) in the source
+    with using a mask (if any) and a filter (if any).
+
+    The mask is validated immediately, the files are yielded lazily.
+    The source is walked by the specified number of threads, see scan_files.
+    """
+    if mask is None:
+        mask = '**/*'
+
+    matchers: List[ComponentMatcher] = compile_mask(mask=mask)
+
+    return (
+        Path(entry.path)
+        for entry in scan_files(
+            directory=str(source),
+            matchers=matchers,
+            walkers=walkers,
+            path_filter=path_filter,
+            with_folders=with_folders
+        )
+    )
+
+
+def create_source_paths(
+        source: Path,
+        mask: Optional[str],
+        walkers: int = 1,
+        path_filter: Optional[PathFilter] = None,
+        with_folders: bool = False
+) -> Iterator[Path]:
+    """Returns an iterator over the paths to source files (and folders if with_folders is set)."""
+    if source.is_file():
+        return iter([source] if (path_filter is None) or path_filter.selects_file(entry=source) else [])
+
+    try:
+        return list_files(
+            source=source,
+            mask=mask,
+            walkers=walkers,
+            path_filter=path_filter,
+            with_folders=with_folders
+        )
+    except Exception:
+        logging.exception(msg=f'Invalid search pattern in {source} path.')
+        raise
+
+
+class FileList:
+    """The source files listed in a file or the standard input ('-').
+
+    The entries are separated by newlines or by NUL characters (if null is set),
+    as written by find -print0. If with_sizes is set, each entry is SIZE<TAB>PATH,
+    as written by find -printf '%s\\t%p\\n'.
+
+    Iterating yields the paths lazily while the list is being read,
+    so the operation starts before the whole list has been written.
+    Relative paths are relative to the source folder, the entries outside it
+    and the invalid entries are logged as errors and skipped.
+
+    The sizes of the yielded files not consumed yet are kept in sizes,
+    see add_file_stats.
+    """
+    def __init__(self, path: Path, source: Path, null: bool = False, with_sizes: bool = False):
+        self.path: Path = path
+        self.source: Path = source
+        self.separator: bytes = b'\0' if null else b'\n'
+        self.with_sizes: bool = with_sizes
+        self.sizes: Dict[Path, int] = {}
+        self.error_count: int = 0
+
+    def read_entries(self, stream: io.BufferedIOBase) -> Iterator[bytes]:
+        """Yields the non-empty entries of the stream as soon as they are read."""
+        rest: bytes = b''
+
+        while True:
+            data: bytes = stream.read1(FILE_LIST_READ_SIZE)
+
+            if not data:
+                break
+
+            entries: List[bytes] = (rest + data).split(self.separator)
+            rest = entries.pop()
+
+            yield from (entry for entry in entries if entry)
+
+        if rest:
+            yield rest
+
+    def parse_entry(self, entry: bytes) -> Optional[Tuple[Path, Optional[int]]]:
+        """Returns the path and the size (if listed) of the entry, None if it is invalid."""
+        size: Optional[int] = None
+
+        if self.with_sizes:
+            size_field, tab, path_field = entry.partition(b'\t')
+
+            if (not tab) or (not size_field.isdigit()):
+                logging.error(msg=f'error: invalid entry {os.fsdecode(entry)} in {self.path}, '
+                                  'expected SIZE<TAB>PATH.')
+
+                return None
+
+            size = int(size_field)
+            entry = path_field
+
+        if (self.separator == b'\n') and entry.endswith(b'\r'):
+            entry = entry[:-1]
+
+        # Resolve '..' so that the destination paths stay in the destination folder.
+        path: Path = Path(os.path.normpath(self.source / os.fsdecode(entry)))
+
+        if self.source not in path.parents:
+            logging.error(msg=f'error: {path} is not in the source folder {self.source}.')
+
+            return None
+
+        return path, size
+
+    def __iter__(self) -> Iterator[Path]:
+        standard_stream: bool = str(self.path) == STANDARD_STREAM
+
+        with contextlib.nullcontext(sys.stdin.buffer) if standard_stream else open(self.path, 'rb') as stream:
+            for entry in self.read_entries(stream=stream):
+                path_and_size: Optional[Tuple[Path, Optional[int]]] = self.parse_entry(entry=entry)
+
+                if path_and_size is None:
+                    self.error_count += 1
+
+                    continue
+
+                path, size = path_and_size
+
+                if size is not None:
+                    self.sizes[path] = size
+
+                yield path
+
+
+class FolderCreator:
+    """Creates the destination folders in a pool of threads.
+
+    Each folder is created once, after its parent:
+    the creation of a folder is submitted when the creation of its parent is done,
+    so the folders of different subtrees are created in parallel.
+    The folders known to exist (the destination and the folders created before)
+    are not created again, nor are their ancestors visited.
+    """
+
+    def __init__(self, destination: Path, threads: int = FOLDER_CREATION_THREADS):
+        self.executor: ThreadPoolExecutor = \
+            ThreadPoolExecutor(max_workers=threads, thread_name_prefix='folders')
+        self.created: Future = Future()
+        self.created.set_result(None)
+        # The destination and the folders outside of it exist.
+        self.depth: int = len(destination.parts)
+        self.folders: Dict[Path, Future] = {destination: self.created}
+
+    def create(self, folder: Path) -> Future:
+        """Returns the future of the creation of the folder and its missing ancestors."""
+        future: Optional[Future] = self.folders.get(folder)
+
+        if future is not None:
+            return future
+
+        # The ancestors not known to exist, nearest first.
+        missing: List[Path] = []
+
+        while (folder not in self.folders) and (len(folder.parts) > self.depth):
+            missing.append(folder)
+            folder = folder.parent
+
+        parent_future: Future = self.folders.get(folder, self.created)
+
+        for folder in reversed(missing):
+            future = Future()
+            self.folders[folder] = future
+            parent_future.add_done_callback(functools.partial(self.start, folder, future))
+            parent_future = future
+
+        return parent_future
+
+    def start(self, folder: Path, future: Future, parent_future: Future) -> None:
+        """Submits the creation of the folder once its parent has been created."""
+        exception: Optional[BaseException] = parent_future.exception()
+
+        if exception is not None:
+            future.set_exception(exception)
+
+            return
+
+        try:
+            self.executor.submit(self.make_folder, folder, future)
+        except RuntimeError as error:
+            # The creator has been closed.
+            future.set_exception(error)
+
+    @staticmethod
+    def make_folder(folder: Path, future: Future) -> None:
+        try:
+            os.mkdir(folder)
+        except FileExistsError as exception:
+            if not os.path.isdir(folder):
+                future.set_exception(exception)
+
+                return
+        except BaseException as exception:
+            future.set_exception(exception)
+
+            return
+
+        future.set_result(None)
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+
+
+def create_source_and_destination_paths(
+        source: Path,
+        source_paths: Iterable[Path],
+        destination: Path,
+        create_folders: bool = True
+) -> Iterator[Tuple[Path, Path]]:
+    """Yields pairs of
+    the path to the source file
+    and the destination path, including subfolders and the file name.
+
+    Also creates subfolders in the destination path (if create_folders is set)
+    in the background, see FolderCreator. The files are yielded in order
+    once their subfolders have been created, at most FOLDER_CREATION_WINDOW
+    files are held back waiting for them.
+
+    Example:
+        /home/user/projects/ - source
+        /home/user/projects/subfolder/file.txt - the path to the source file
+        /root/ - destination
+        /root/subfolder/file.txt - the destination path
+    """
+    if not create_folders:
+        for source_path in source_paths:
+            yield source_path, destination / source_path.relative_to(source)
+
+        return
+
+    creator: FolderCreator = FolderCreator(destination=destination)
+    # The files waiting for their subfolders.
+    waiting: Deque[Tuple[Future, Tuple[Path, Path]]] = collections.deque()
+
+    try:
+        for source_path in source_paths:
+            destination_path: Path = destination / source_path.relative_to(source)
+
+            # Create subfolders in the destination path.
+            waiting.append((creator.create(folder=destination_path.parent), (source_path, destination_path)))
+
+            while waiting and (waiting[0][0].done() or (len(waiting) >= FOLDER_CREATION_WINDOW)):
+                future, source_and_destination_path = waiting.popleft()
+                future.result()
+
+                yield source_and_destination_path
+
+        while waiting:
+            future, source_and_destination_path = waiting.popleft()
+            future.result()
+
+            yield source_and_destination_path
+    finally:
+        creator.close()
+
+
+def iterate_in_background(items: Iterable[T], maxsize: int) -> Iterator[T]:
+    """Consumes the items in a background thread
+    and yields them through a bounded queue as soon as they are produced.
+
+    An exception raised by the items is re-raised in the consumer.
+    """
+    buffer: queue.Queue = queue.Queue(maxsize=maxsize)
+    stopped: threading.Event = threading.Event()
+    end: object = object()
+    errors: List[BaseException] = []
+
+    def put(item: object) -> bool:
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def produce() -> None:
+        try:
+            for item in items:
+                if not put(item=item):
+                    return
+        except BaseException as exception:
+            errors.append(exception)
+
+        put(item=end)
+
+    producer: threading.Thread = threading.Thread(
+        target=produce,
+        name='producer',
+        daemon=True
+    )
+    producer.start()
+
+    try:
+        while True:
+            item = buffer.get()
+
+            if item is end:
+                break
+
+            yield item
+    finally:
+        stopped.set()
+
+    if errors:
+        raise errors[0]
+
+
+class SourceRemover:
+    """Unlinks the moved source files in background batches.
+
+    When remove_folders is set, the folders of the unlinked files
+    are removed bottom-up, up to the root folder, as soon as they become empty.
+    """
+
+    def __init__(self, root: Path, remove_folders: bool, batch_size: int = UNLINK_BATCH_SIZE):
+        self.root: Path = root
+        self.remove_folders: bool = remove_folders
+        self.batch_size: int = batch_size
+        self.batch: List[Path] = []
+        self.errors: List[Tuple[Path, OSError]] = []
+        self.batches: queue.Queue = queue.Queue()
+        self.thread: threading.Thread = threading.Thread(
+            target=self.run,
+            name='source-remover',
+            daemon=True
+        )
+        self.thread.start()
+
+    def add(self, path: Path) -> None:
+        """Schedule the source file to be unlinked."""
+        self.batch.append(path)
+
+        if len(self.batch) >= self.batch_size:
+            self.batches.put(self.batch)
+            self.batch = []
+
+    def close(self) -> List[Tuple[Path, OSError]]:
+        """Unlink the remaining files and return the files that could not be unlinked."""
+        self.batches.put(self.batch)
+        self.batches.put(None)
+        self.thread.join()
+
+        return self.errors
+
+    def run(self) -> None:
+        for batch in iter(self.batches.get, None):
+            folders: Set[Path] = set()
+
+            for path in batch:
+                try:
+                    os.unlink(path)
+                except OSError as exception:
+                    self.errors.append((path, exception))
+                else:
+                    folders.add(path.parent)
+
+            if not self.remove_folders:
+                continue
+
+            # Remove the deepest folders first, so their parents can become empty.
+            for folder in sorted(folders, key=lambda path: len(path.parts), reverse=True):
+                while self.root in folder.parents:
+                    try:
+                        os.rmdir(folder)
+                    except OSError:
+                        break
+
+                    folder = folder.parent
+
+
+class ResultLog:
+    """Counts and logs the results of the operations on the files.
+
+    The errors are logged one by one, while the successes are logged
+    at the DEBUG level only and summarized every interval seconds.
+    All results are written to the report file (if specified)
+    in batches of REPORT_BATCH_SIZE lines by a background thread:
+    'success<TAB>path' or 'error<TAB>path<TAB>error' per line.
+    """
+
+    def __init__(self, report_path: Optional[Path] = None, interval: float = SUMMARY_INTERVAL):
+        self.success_count: int = 0
+        self.error_count: int = 0
+        self.interval: float = interval
+        self.start: float = time.monotonic()
+        self.last_summary: float = self.start
+        self.batch: List[str] = []
+        self.batches: Optional[queue.Queue] = None
+        self.thread: Optional[threading.Thread] = None
+
+        if report_path is not None:
+            self.batches = queue.Queue()
+            self.thread = threading.Thread(
+                target=self.write_report,
+                args=(report_path,),
+                name='result-report',
+                daemon=True
+            )
+            self.thread.start()
+
+    def add_line(self, line: str) -> None:
+        if self.batches is None:
+            return
+
+        self.batch.append(line)
+
+        if len(self.batch) >= REPORT_BATCH_SIZE:
+            self.batches.put(self.batch)
+            self.batch = []
+
+    def success(self, file: object, status: str = 'success') -> None:
+        self.success_count += 1
+
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug(msg=f'{status}: {file}')
+
+        self.add_line(line=f'{status}\t{file}\n')
+        self.summarize()
+
+    def error(self, file: object, exception: BaseException) -> None:
+        self.error_count += 1
+
+        logging.error(msg=f'error: {file} - {str(exception)}')
+        self.add_line(line=f'error\t{file}\t{str(exception)}\n')
+        self.summarize()
+
+    def summarize(self) -> None:
+        """Logs the number of files done so far once per interval."""
+        now: float = time.monotonic()
+
+        if now - self.last_summary < self.interval:
+            return
+
+        self.last_summary = now
+        logging.info(
+            msg=f'{self.success_count} success, {self.error_count} error files, '
+                f'{(self.success_count + self.error_count) / (now - self.start):.0f} files/s'
+        )
+
+    def close(self) -> None:
+        """Writes the rest of the report and logs the totals."""
+        if self.batches is not None:
+            self.batches.put(self.batch)
+            self.batches.put(None)
+            self.thread.join()
+            self.batches = None
+
+        logging.info(f'\nSuccess {self.success_count} files')
+        logging.info(f'Error {self.error_count} files')
+
+    def write_report(self, path: Path) -> None:
+        with open(path, 'w', encoding='utf-8') as report_file:
+            for batch in iter(self.batches.get, None):
+                report_file.writelines(batch)
+
+
+# The source and destination devices of a file.
+Devices = Tuple[int, int]
+
+
+class SourceFile(NamedTuple):
+    """The source file to perform the operation on."""
+    source: Path
+    destination: Path
+    size: int
+    devices: Devices
+    mtime_ns: int = 0
+    # The file with the same data, see Deduplicator.
+    original: Optional['SourceFile'] = None
+
+
+def add_file_stats(
+        source_and_destination_paths: Iterable[Tuple[Path, Path]],
+        with_stats: bool,
+        known_sizes: Optional[Dict[Path, int]] = None,
+        stat_known: bool = False
+) -> Iterator[SourceFile]:
+    """Yields the source files with the size and modification time
+    of the source file and the devices of the source file and the destination folder.
+
+    The stats are collected only if with_stats is set, otherwise they are 0.
+    The stats of a file that cannot be accessed are 0,
+    the error is reported by the operation itself.
+
+    The files with a size in known_sizes (source path -> size, see FileList)
+    are not stat-ed unless stat_known is set, only the size is set.
+    The sizes are removed from known_sizes as the files are yielded.
+    """
+    folder_devices: Dict[Path, int] = {}
+
+    for source_path, destination_path in source_and_destination_paths:
+        known_size: Optional[int] = known_sizes.pop(source_path, None) if known_sizes is not None else None
+
+        if (known_size is not None) and (not stat_known):
+            yield SourceFile(source_path, destination_path, known_size, (0, 0))
+
+            continue
+
+        if not with_stats:
+            yield SourceFile(source_path, destination_path, 0, (0, 0))
+
+            continue
+
+        try:
+            source_stat: os.stat_result = os.stat(source_path)
+        except OSError:
+            yield SourceFile(source_path, destination_path, 0, (0, 0))
+
+            continue
+
+        folder: Path = destination_path.parent
+        destination_device: Optional[int] = folder_devices.get(folder)
+
+        if destination_device is None:
+            try:
+                destination_device = os.stat(folder).st_dev
+            except OSError:
+                destination_device = 0
+
+            folder_devices[folder] = destination_device
+
+        yield SourceFile(
+            source_path,
+            destination_path,
+            source_stat.st_size,
+            (source_stat.st_dev, destination_device),
+            source_stat.st_mtime_ns
+        )
+
+
+class SyncIndex:
+    """The index of the files synced to the destination folder.
+
+    Keeps the size and modification time the source files had
+    when they were copied, so the files unchanged since then
+    are skipped without accessing the destination.
+    A file missing from the index is skipped
+    if the destination file has the same size and modification time.
+    Delete the index file to compare all files with the destination again.
+    """
+
+    def __init__(self, destination: Path, batch_size: int = SYNC_INDEX_BATCH_SIZE):
+        self.destination: Path = destination
+        self.path: Path = destination / SYNC_INDEX_NAME
+        self.batch_size: int = batch_size
+        self.skipped_count: int = 0
+        # The files being copied by their source paths.
+        self.pending: Dict[Path, Tuple[str, int, int]] = {}
+        # The synced files to write to the index.
+        self.rows: Deque[Tuple[str, int, int]] = collections.deque()
+        self.connection: sqlite3.Connection = sqlite3.connect(self.path)
+
+        # The files are looked up while the synced files are written.
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS files '
+            '(path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL)'
+        )
+        self.connection.commit()
+
+    def filter(self, files: Iterable[SourceFile]) -> Iterator[SourceFile]:
+        """Yields the files changed since they were synced."""
+        connection: sqlite3.Connection = sqlite3.connect(self.path, check_same_thread=False)
+
+        try:
+            for file in files:
+                destination_path: Path = file.destination
+
+                # A single source file is copied into the destination folder.
+                if destination_path == self.destination:
+                    destination_path = destination_path / file.source.name
+
+                key: str = destination_path.relative_to(self.destination).as_posix()
+
+                # The index itself and its journal files.
+                if key.startswith(SYNC_INDEX_NAME):
+                    continue
+
+                state: Tuple[int, int] = (file.size, file.mtime_ns)
+                row: Optional[Tuple[int, int]] = connection.execute(
+                    'SELECT size, mtime_ns FROM files WHERE path = ?',
+                    (key,)
+                ).fetchone()
+
+                if row is None:
+                    try:
+                        destination_stat: os.stat_result = os.stat(destination_path)
+
+                        if (destination_stat.st_size, destination_stat.st_mtime_ns) == state:
+                            self.rows.append((key, *state))
+                            row = state
+                    except OSError:
+                        pass
+
+                if tuple(row or ()) == state:
+                    self.skipped_count += 1
+
+                    continue
+
+                self.pending[file.source] = (key, *state)
+
+                yield file
+        finally:
+            connection.close()
+
+    def record(self, path: Path, success: bool) -> None:
+        """Records the result of copying the source file."""
+        row: Optional[Tuple[str, int, int]] = self.pending.pop(path, None)
+
+        if success and (row is not None):
+            self.rows.append(row)
+
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes the synced files to the index."""
+        rows: List[Tuple[str, int, int]] = [self.rows.popleft() for _ in range(len(self.rows))]
+
+        self.connection.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', rows)
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.flush()
+        self.connection.close()
+
+
+class Deduplicator:
+    """Finds the source files with the same data as the files before them.
+
+    The originals are looked up by their size and the hash
+    of their first DEDUPE_PARTIAL_SIZE bytes, then by the hash of their data.
+    A hash is computed only when another file of the same size
+    (then with the same head) is found.
+    The files are hashed by windows of DEDUPE_WINDOW_SIZE files in parallel threads.
+    """
+
+    def __init__(self, threads: int = 1):
+        self.threads: int = threads
+        self.duplicate_count: int = 0
+        # The first files of their sizes and heads, hashed once another file with them is found.
+        self.sizes: Dict[int, Optional[SourceFile]] = {}
+        self.heads: Dict[Tuple[int, bytes], Optional[SourceFile]] = {}
+        # The files with distinct data by their sizes and head hashes, then by their data hashes.
+        self.originals: Dict[Tuple[int, bytes], Dict[bytes, SourceFile]] = {}
+
+    @staticmethod
+    def hash(path: Path, size: int) -> Optional[bytes]:
+        """Returns the hash of the first size bytes of the file, None if it cannot be read."""
+        hasher = hashlib.blake2b(digest_size=32)
+
+        try:
+            with open(path, 'rb') as file:
+                while size > 0:
+                    data: bytes = file.read(min(size, COPY_BUFFER_SIZE))
+
+                    if not data:
+                        break
+
+                    hasher.update(data)
+                    size -= len(data)
+        except OSError:
+            # The error is reported by the operation itself.
+            return None
+
+        return hasher.digest()
+
+    def hash_files(
+            self,
+            executor: ThreadPoolExecutor,
+            files: Iterable[SourceFile],
+            head: bool
+    ) -> Dict[Path, Optional[bytes]]:
+        """Returns the hashes of the heads or of the data of the files by their source paths."""
+        paths: List[Path] = [file.source for file in files]
+        sizes: List[int] = [DEDUPE_PARTIAL_SIZE if head else file.size for file in files]
+
+        return dict(zip(paths, executor.map(self.hash, paths, sizes)))
+
+    def find_originals(self, executor: ThreadPoolExecutor, window: List[SourceFile]) -> Iterator[SourceFile]:
+        """Yields the files of the window, setting the original of the duplicate files."""
+        # The files to hash, starting with the first files of their sizes found before.
+        hashed_heads: Dict[Path, SourceFile] = {}
+        hashed_data: Dict[Path, SourceFile] = {}
+
+        for file in window:
+            # Empty files and files that cannot be accessed are not compared.
+            if file.size == 0:
+                continue
+
+            first: Optional[SourceFile] = self.sizes.setdefault(file.size, file)
+
+            if first is file:
+                continue
+
+            if first is not None:
+                hashed_heads[first.source] = first
+                self.sizes[file.size] = None
+
+            hashed_heads[file.source] = file
+
+        head_hashes: Dict[Path, Optional[bytes]] = \
+            self.hash_files(executor=executor, files=hashed_heads.values(), head=True)
+        # The sizes and the head hashes of the hashed files.
+        keys: Dict[Path, Tuple[int, bytes]] = {}
+
+        for file in hashed_heads.values():
+            head_hash: Optional[bytes] = head_hashes[file.source]
+
+            if head_hash is None:
+                continue
+
+            key: Tuple[int, bytes] = (file.size, head_hash)
+            keys[file.source] = key
+
+            # The head of a small file is the whole file.
+            if file.size <= DEDUPE_PARTIAL_SIZE:
+                continue
+
+            first = self.heads.setdefault(key, file)
+
+            if first is file:
+                continue
+
+            if first is not None:
+                hashed_data[first.source] = first
+                keys[first.source] = key
+                self.heads[key] = None
+
+            hashed_data[file.source] = file
+
+        data_hashes: Dict[Path, Optional[bytes]] = \
+            self.hash_files(executor=executor, files=hashed_data.values(), head=False)
+        window_paths: Set[Path] = {file.source for file in window}
+
+        # The first files of the windows before are the originals of the files of this one.
+        for file in itertools.chain(hashed_heads.values(), hashed_data.values()):
+            if file.source not in window_paths:
+                self.find_original(file=file, keys=keys, data_hashes=data_hashes)
+
+        for file in window:
+            original: Optional[SourceFile] = \
+                self.find_original(file=file, keys=keys, data_hashes=data_hashes)
+
+            if original is None:
+                yield file
+
+                continue
+
+            self.duplicate_count += 1
+
+            yield file._replace(original=original)
+
+    def find_original(
+            self,
+            file: SourceFile,
+            keys: Dict[Path, Tuple[int, bytes]],
+            data_hashes: Dict[Path, Optional[bytes]]
+    ) -> Optional[SourceFile]:
+        """Returns the file with the same data found before, if any,
+        otherwise adds the hashed file to the originals."""
+        key: Optional[Tuple[int, bytes]] = keys.get(file.source)
+
+        # The only file of its size or head, or a file that cannot be read.
+        if key is None:
+            return None
+
+        data_hash: Optional[bytes] = \
+            key[1] if file.size <= DEDUPE_PARTIAL_SIZE else data_hashes.get(file.source)
+
+        if data_hash is None:
+            return None
+
+        original: SourceFile = self.originals.setdefault(key, {}).setdefault(data_hash, file)
+
+        return original if original is not file else None
+
+    def filter(self, files: Iterable[SourceFile]) -> Iterator[SourceFile]:
+        """Yields the files, setting the original of the duplicate files."""
+        iterator: Iterator[SourceFile] = iter(files)
+
+        with ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='dedupe') as executor:
+            while True:
+                window: List[SourceFile] = list(itertools.islice(iterator, DEDUPE_WINDOW_SIZE))
+
+                if not window:
+                    return
+
+                yield from self.find_originals(executor=executor, window=window)
+
+
+class Journal:
+    """The append-only journal of the files copied to the destination folder.
+
+    Each line is a JSON record of a copied file
+    [source, destination, size, mtime_ns]
+    or of a copied chunk of a large file
+    [source, destination, size, mtime_ns, offset, length].
+    The records are appended and synced to the disk in batches,
+    a line torn by a crash is ignored on replay.
+
+    On resume, the journal is replayed and the files copied
+    with the same size and modification time are not copied again,
+    the copied chunks of the large files are kept.
+    """
+
+    def __init__(self, path: Path, resume: bool, batch_size: int = JOURNAL_BATCH_SIZE):
+        self.path: Path = path
+        self.batch_size: int = batch_size
+        self.resumed_count: int = 0
+        # The copied files and chunks by their source paths.
+        self.files: Dict[str, Tuple[str, int, int]] = {}
+        self.chunks: Dict[str, Tuple[Tuple[str, int, int], Set[Tuple[int, int]]]] = {}
+        self.records: int = 0
+        torn: bool = False
+
+        if resume and path.exists():
+            torn = self.replay()
+
+        self.file = open(path, 'a' if resume else 'w', encoding='utf-8')
+
+        # Do not append the records to a torn line.
+        if torn:
+            self.file.write('\n')
+
+    def replay(self) -> bool:
+        """Loads the records of the journal, returns whether its last line is torn."""
+        line: str = ''
+
+        with open(self.path, encoding='utf-8') as journal_file:
+            for line in journal_file:
+                try:
+                    source, destination, size, mtime_ns, *chunk = json.loads(line)
+                except (ValueError, TypeError):
+                    continue
+
+                state: Tuple[str, int, int] = (destination, size, mtime_ns)
+
+                if not chunk:
+                    self.files[source] = state
+                    self.chunks.pop(source, None)
+
+                    continue
+
+                chunks: Tuple[Tuple[str, int, int], Set[Tuple[int, int]]] = \
+                    self.chunks.get(source, (state, set()))
+
+                # The file has been changed since the other chunks were copied.
+                if chunks[0] != state:
+                    chunks = (state, set())
+
+                chunks[1].add((chunk[0], chunk[1]))
+                self.chunks[source] = chunks
+
+        return (line != '') and (not line.endswith('\n'))
+
+    @staticmethod
+    def get_state(file: SourceFile) -> Tuple[str, int, int]:
+        return str(file.destination), file.size, file.mtime_ns
+
+    def is_copied(self, file: SourceFile) -> bool:
+        """Returns whether the unchanged file has been copied."""
+        if self.files.get(str(file.source)) != self.get_state(file=file):
+            return False
+
+        self.resumed_count += 1
+
+        return True
+
+    def get_copied_chunks(self, file: SourceFile) -> Set[Tuple[int, int]]:
+        """Returns the offsets and lengths of the copied chunks of the unchanged file."""
+        state, chunks = self.chunks.get(str(file.source), (None, set()))
+
+        return chunks if state == self.get_state(file=file) else set()
+
+    def record(self, file: SourceFile, *chunk: int) -> None:
+        """Records the copied file or its chunk (offset and length)."""
+        self.file.write(json.dumps([str(file.source), *self.get_state(file=file), *chunk]) + '\n')
+        self.records += 1
+
+        if self.records >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Syncs the records to the disk."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.records = 0
+
+    def close(self, remove: bool) -> None:
+        """Closes the journal, removing it if remove is set."""
+        self.flush()
+        self.file.close()
+
+        if remove:
+            os.remove(self.path)
+
+
+class Manifest:
+    """The digests of the files copied to the destination folder
+    in the format of the sha256sum, b2sum and xxh128sum tools:
+    a line '<digest>  <path relative to the destination folder>' per file.
+
+    The digests of the files copied by the earlier runs are kept.
+    The line of a file is appended as soon as it has been copied,
+    so an interrupted run keeps the digests of its copied files,
+    the manifest is rewritten without the replaced digests when closed.
+    """
+
+    def __init__(self, destination: Path, algorithm: str):
+        self.destination: Path = destination
+        self.path: Path = destination / MANIFEST_NAME_FORMAT.format(algorithm=algorithm)
+        self.digests: Dict[str, str] = {}
+        torn: bool = False
+
+        if self.path.exists():
+            with open(self.path, encoding='utf-8') as manifest_file:
+                for line in manifest_file:
+                    digest, separator, path = line.rstrip('\n').partition('  ')
+                    # The last line of an interrupted run can be torn.
+                    torn = not line.endswith('\n')
+
+                    if separator and not torn:
+                        self.digests[path] = digest
+
+        # Line buffered, so every line is written as soon as it is recorded.
+        self.file = open(self.path, 'a', encoding='utf-8', buffering=1)
+
+        if torn:
+            self.file.write('\n')
+
+    def record(self, file: SourceFile, digest: str) -> None:
+        destination_path: Path = file.destination
+
+        # A single source file is copied into the destination folder.
+        if destination_path == self.destination:
+            destination_path = destination_path / file.source.name
+
+        path: str = destination_path.relative_to(self.destination).as_posix()
+
+        self.digests[path] = digest
+        self.file.write(f'{digest}  {path}\n')
+
+    def close(self) -> None:
+        """Rewrites the manifest with the last digest of every file, replacing it at once."""
+        self.file.close()
+
+        temporary_path: Path = self.path.with_name(f'{self.path.name}.tmp')
+
+        with open(temporary_path, 'w', encoding='utf-8') as manifest_file:
+            for path, digest in self.digests.items():
+                manifest_file.write(f'{digest}  {path}\n')
+
+        os.replace(temporary_path, self.path)
+
+
+@dataclass
+class ChunkedFile:
+    """A large file copied by byte ranges in several threads."""
+    source: Path
+    destination: Path
+    remaining_chunks: int
+    error: Optional[BaseException] = None
+    # The digests of the verified chunks by their offsets, see copy_chunk.
+    digests: Dict[int, Optional[str]] = field(default_factory=dict)
+
+
+def run_file(
+        operation: Callable[[Path, Path, str], Optional[str]],
+        engine: str,
+        source_and_destination_path: Tuple[Path, Path]
+) -> Union[Exception, str, None]:
+    """Runs the operation on the file.
+
+    Returns the error, or the result of the operation:
+    the digest of the verified file, None for the other operations.
+    """
+    try:
+        return operation(source_and_destination_path[0], source_and_destination_path[1], engine)
+    except Exception as exception:
+        return exception
+
+
+class TaskResult(NamedTuple):
+    """The result of an operation run by a worker, see run_task."""
+    worker: str
+    busy: float
+    result: object
+    exception: Optional[BaseException]
+    # The CPU time of the worker thread and the name of the operation.
+    cpu: float = 0.0
+    operation: str = ''
+
+
+def run_task(function: Callable, kwargs: dict) -> TaskResult:
+    """Runs the operation, measuring the time the worker is busy with it."""
+    worker: str = f'{os.getpid()}/{threading.current_thread().name}'
+    operation: str = getattr(function, 'func', function).__name__
+    start: float = time.perf_counter()
+    cpu_start: float = time.thread_time()
+    result: object = None
+    exception: Optional[BaseException] = None
+
+    try:
+        result = function(**kwargs)
+    except Exception as error:
+        exception = error
+
+    return TaskResult(
+        worker=worker,
+        busy=time.perf_counter() - start,
+        result=result,
+        exception=exception,
+        cpu=time.thread_time() - cpu_start,
+        operation=operation
+    )
+
+
+def run_batch(
+        operation: Callable[[Path, Path, str], None],
+        source_and_destination_paths: List[Tuple[Path, Path]],
+        engine: str
+) -> List[Union[Exception, str, None]]:
+    """Runs the operation on each file of the batch.
+
+    Returns the error or the result of each file, see run_file.
+    """
+    return [
+        run_file(operation, engine, source_and_destination_path)
+        for source_and_destination_path in source_and_destination_paths
+    ]
+
+
+# The thread pool of a worker process of the hybrid executor.
+worker_threads: Optional[ThreadPoolExecutor] = None
+
+
+def start_worker_threads(threads: int, bandwidth: Optional['TokenBucket'] = None) -> None:
+    """Starts the thread pool of the worker process."""
+    global worker_threads
+
+    worker_threads = ThreadPoolExecutor(max_workers=threads)
+    set_worker_bandwidth(bucket=bandwidth)
+
+
+def run_shard(
+        operation: Callable[[Path, Path, str], None],
+        source_and_destination_paths: List[Tuple[Path, Path]],
+        engine: str
+) -> List[Union[Exception, str, None]]:
+    """Runs the operation on each file of the shard
+    using the thread pool of the worker process.
+
+    Returns the error or the result of each file, see run_file.
+    """
+    return list(worker_threads.map(
+        functools.partial(run_file, operation, engine),
+        source_and_destination_paths
+    ))
+
+
+def get_process_context() -> multiprocessing.context.BaseContext:
+    """Returns a process start method that is safe while other threads are running."""
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+
+    return multiprocessing.get_context('spawn')
+
+
+def create_thread_executor(threads: int, processes: int) -> Executor:
+    """Creates a pool of threads."""
+    return ThreadPoolExecutor(max_workers=threads)
+
+
+def create_process_executor(threads: int, processes: int) -> Executor:
+    """Creates a pool of single-threaded processes."""
+    return ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=get_process_context(),
+        initializer=set_worker_bandwidth,
+        initargs=(worker_bandwidth,)
+    )
+
+
+def create_hybrid_executor(threads: int, processes: int) -> Executor:
+    """Creates a pool of processes, each running its own pool of threads."""
+    return ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=get_process_context(),
+        initializer=start_worker_threads,
+        initargs=(threads, worker_bandwidth)
+    )
+
+
+executors: Final[Dict[str, Callable[[int, int], Executor]]] = {
+    'thread': create_thread_executor,
+    'process': create_process_executor,
+    'hybrid': create_hybrid_executor,
+}
+
+
+class ThreadTuner:
+    """Tunes the number of active threads by hill climbing on the throughput.
+
+    The bytes and files per second are measured over windows
+    of at least window seconds. Starting from 1 thread,
+    the number of threads doubles while the throughput improves
+    by more than tolerance, then the step is halved around
+    the best number of threads until it gets to 0 and the number settles.
+
+    The throughput is still measured once settled. When it falls by more than change
+    (such as when a disk starts thrashing), the number of threads is halved,
+    when it rises by more than change, more threads are tried again,
+    and the search starts over from there.
+    """
+
+    def __init__(
+            self,
+            max_threads: int,
+            window: float = AUTOTUNE_WINDOW,
+            tolerance: float = AUTOTUNE_TOLERANCE,
+            change: float = AUTOTUNE_CHANGE
+    ):
+        self.max_threads: int = max_threads
+        self.window: float = window
+        self.tolerance: float = tolerance
+        self.change: float = change
+        self.start_search(threads=1)
+        self.settled: bool = max_threads == 1
+        # The throughput of the settled number of threads.
+        self.settled_rates: Optional[Tuple[float, float]] = None
+        self.window_start: float = time.monotonic()
+        self.window_files: int = 0
+        self.window_bytes: int = 0
+
+    def start_search(self, threads: int) -> None:
+        self.threads: int = threads
+        self.best_threads: int = threads
+        self.best_rates: Optional[Tuple[float, float]] = None
+        self.step: int = threads
+        self.growing: bool = True
+        self.settled = False
+
+    def add(self, files: int, size: int) -> bool:
+        """Adds the completed files of size bytes,
+        returns whether the number of threads has changed."""
+        if self.max_threads == 1:
+            return False
+
+        self.window_files += files
+        self.window_bytes += size
+        now: float = time.monotonic()
+        elapsed: float = now - self.window_start
+
+        if elapsed < self.window:
+            return False
+
+        rates: Tuple[float, float] = (self.window_bytes / elapsed, self.window_files / elapsed)
+        self.window_start = now
+        self.window_files = 0
+        self.window_bytes = 0
+
+        if self.settled:
+            return self.track(rates=rates)
+
+        if (self.best_rates is None) or any(
+                rate > best_rate * (1 + self.tolerance)
+                for rate, best_rate in zip(rates, self.best_rates)
+        ):
+            self.best_threads = self.threads
+            self.best_rates = rates
+
+            if self.growing:
+                self.step = self.threads
+        else:
+            self.growing = False
+
+        if not self.growing:
+            self.step //= 2
+
+        threads: int = min(self.best_threads + self.step, self.max_threads)
+
+        if threads == self.best_threads:
+            changed: bool = self.threads != self.best_threads
+            self.threads = self.best_threads
+            self.settled = True
+            self.settled_rates = self.best_rates
+
+            logging.info(msg=f'Autotuned threads: {self.threads}')
+
+            return changed
+
+        logging.debug(msg=f'Autotuning threads: {self.threads} -> {threads}')
+        self.threads = threads
+
+        return True
+
+    def track(self, rates: Tuple[float, float]) -> bool:
+        """Starts the search over when the throughput of the settled number of threads changes."""
+        # Only the rates measured when settling are compared, such as no files of chunked copies.
+        changes: List[float] = [
+            rate / settled_rate - 1
+            for rate, settled_rate in zip(rates, self.settled_rates)
+            if settled_rate > 0
+        ]
+
+        if changes and all(change < -self.change for change in changes):
+            threads: int = max(self.threads // 2, 1)
+
+            logging.info(msg=f'Autotuning threads: the throughput fell, {self.threads} -> {threads}')
+        elif any(change > self.change for change in changes):
+            threads = self.threads
+
+            logging.info(msg=f'Autotuning threads: the throughput rose, trying more than {threads}')
+        else:
+            return False
+
+        changed: bool = threads != self.threads
+        self.start_search(threads=threads)
+
+        return changed
+
+    def finish(self) -> None:
+        """Logs the best number of threads if the run ended before settling."""
+        if not self.settled:
+            logging.info(msg=f'Autotuned threads (not settled): {self.best_threads}')
+
+
+class TokenBucket:
+    """A token bucket refilled at rate tokens per second (None - unlimited),
+    holding at most one second of tokens.
+
+    Taking more tokens than there are goes into debt,
+    which has to be paid back before the next take,
+    so a large file is not held back until a whole second of its bytes is available.
+
+    The bucket is shared by the threads taking from it with acquire,
+    and by the worker processes if shared is set: its state is then kept in shared memory.
+    """
+
+    def __init__(self, rate: Optional[float], shared: bool = False):
+        # The rate (0 - unlimited), the tokens and the time they were refilled.
+        state: List[float] = [rate or 0.0, rate or 0.0, time.monotonic()]
+        self.state = get_process_context().Array('d', state) if shared else state
+        self.lock = self.state.get_lock() if shared else threading.Lock()
+
+    @property
+    def rate(self) -> Optional[float]:
+        return self.state[0] or None
+
+    @rate.setter
+    def rate(self, rate: Optional[float]) -> None:
+        self.state[0] = rate or 0.0
+
+    @property
+    def tokens(self) -> float:
+        return self.state[1]
+
+    @tokens.setter
+    def tokens(self, tokens: float) -> None:
+        self.state[1] = tokens
+
+    @property
+    def updated(self) -> float:
+        return self.state[2]
+
+    @updated.setter
+    def updated(self, updated: float) -> None:
+        self.state[2] = updated
+
+    def refill(self, now: float) -> None:
+        if self.rate is not None:
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+
+        self.updated = now
+
+    def set_rate(self, rate: Optional[float], now: float) -> None:
+        with self.lock:
+            self.refill(now=now)
+            self.rate = rate
+            # The debt is kept, the burst is limited to the new rate.
+            self.tokens = min(self.tokens, rate) if rate is not None else 0.0
+
+    def get_delay(self, now: float) -> float:
+        """Returns the number of seconds until the tokens can be taken."""
+        self.refill(now=now)
+
+        return 0.0 if (self.rate is None) or (self.tokens >= 0) else -self.tokens / self.rate
+
+    def take(self, tokens: float) -> None:
+        if self.rate is not None:
+            self.tokens -= tokens
+
+    def acquire(self, tokens: float) -> None:
+        """Waits until the debt has been paid back, then takes the tokens."""
+        while True:
+            with self.lock:
+                delay: float = self.get_delay(now=time.monotonic())
+
+                if delay <= 0:
+                    self.take(tokens=tokens)
+
+                    return
+
+            time.sleep(min(delay, THROTTLE_WAIT_STEP))
+
+
+class Throttle:
+    """Limits the bytes per second copied by all workers
+    and the files per second of the operations submitted to them with token buckets.
+
+    The bytes are taken by the copies of the workers as they go, see take_bandwidth,
+    the bucket is in shared memory for the worker processes if shared is set.
+
+    The limits are adjustable during the run through the throttle file (if specified),
+    which is checked every THROTTLE_RELOAD_INTERVAL seconds.
+    Each line of the file is max-bandwidth=SIZE or max-files-per-sec=NUMBER,
+    0 removes the limit, a limit missing from the file (or a missing file)
+    is the one specified at the start. Lines starting with '#' are ignored.
+    """
+
+    def __init__(
+            self,
+            max_bandwidth: Optional[int] = None,
+            max_files_per_sec: Optional[float] = None,
+            path: Optional[Path] = None,
+            shared: bool = False
+    ):
+        self.default_limits: Dict[str, Optional[float]] = {
+            'max-bandwidth': max_bandwidth or None,
+            'max-files-per-sec': max_files_per_sec or None,
+        }
+        self.limits: Dict[str, Optional[float]] = dict(self.default_limits)
+        self.path: Optional[Path] = path
+        self.bytes: TokenBucket = TokenBucket(rate=self.limits['max-bandwidth'], shared=shared)
+        self.files: TokenBucket = TokenBucket(rate=self.limits['max-files-per-sec'])
+        self.checked: float = 0.0
+        # The modification time of the loaded throttle file, None if there is no file.
+        self.mtime_ns: Optional[int] = None
+
+    def read_limits(self) -> Dict[str, Optional[float]]:
+        """Returns the limits of the throttle file."""
+        limits: Dict[str, Optional[float]] = dict(self.default_limits)
+
+        for line in self.path.read_text(encoding='utf-8').splitlines():
+            line = line.strip()
+
+            if (not line) or line.startswith('#'):
+                continue
+
+            name, _, value = line.partition('=')
+            name, value = name.strip().lstrip('-'), value.strip()
+
+            if name == 'max-bandwidth':
+                limits[name] = parse_size(value=value) or None
+            elif name == 'max-files-per-sec':
+                limits[name] = float(value) or None
+            else:
+                raise ValueError(f'unknown limit {name}')
+
+            if (limits[name] is not None) and (limits[name] < 0):
+                raise ValueError(f'negative limit {name}')
+
+        return limits
+
+    def reload(self, now: float) -> None:
+        """Applies the limits of the throttle file if it has changed."""
+        if (self.path is None) or (now - self.checked < THROTTLE_RELOAD_INTERVAL):
+            return
+
+        self.checked = now
+
+        try:
+            mtime_ns: Optional[int] = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime_ns = None
+
+        if mtime_ns == self.mtime_ns:
+            return
+
+        self.mtime_ns = mtime_ns
+
+        try:
+            limits: Dict[str, Optional[float]] = \
+                self.read_limits() if mtime_ns is not None else dict(self.default_limits)
+        except (OSError, ValueError) as error:
+            logging.error(msg=f'error: invalid throttle file {self.path}: {error}, the limits are not changed.')
+
+            return
+
+        if limits != self.limits:
+            self.limits = limits
+            self.bytes.set_rate(rate=limits['max-bandwidth'], now=now)
+            self.files.set_rate(rate=limits['max-files-per-sec'], now=now)
+
+            logging.info(msg=f'throttle: {self.format_limits()}')
+
+    def format_limits(self) -> str:
+        bandwidth: Optional[float] = self.limits['max-bandwidth']
+        files_per_sec: Optional[float] = self.limits['max-files-per-sec']
+        bandwidth_limit: str = f'{format_size(size=int(bandwidth))}/s' if bandwidth is not None else 'unlimited'
+        files_limit: str = f'{files_per_sec:g}/s' if files_per_sec is not None else 'unlimited'
+
+        return f'bandwidth {bandwidth_limit}, files {files_limit}'
+
+    def get_delay(self) -> float:
+        """Returns the number of seconds until the next operation can be submitted."""
+        now: float = time.monotonic()
+        self.reload(now=now)
+
+        return self.files.get_delay(now=now)
+
+    def take(self, files: int) -> None:
+        self.files.take(tokens=files)
+
+
+@dataclass
+class DevicePool:
+    """The executor performing the operations of one pair of devices."""
+    executor: Executor
+    threads: int
+    max_in_flight: int
+    # The number of pending operations blocking the enumeration.
+    max_backlog: int
+    in_flight: int = 0
+    backlog: Deque[Tuple[object, int, Callable, dict]] = field(default_factory=collections.deque)
+
+
+def format_size(size: int) -> str:
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            return f'{size}{unit}'
+
+        size //= 1024
+
+    return f'{size}TiB'
+
+
+def write_atomically(path: Path, text: str) -> None:
+    """Writes the file, replacing the previous one at once."""
+    temporary_path: Path = path.with_name(f'{path.name}.tmp')
+    temporary_path.write_text(text, encoding='utf-8')
+    os.replace(temporary_path, path)
+
+
+class Metrics:
+    """Collects the throughput of the operations.
+
+    The counters are updated by the thread submitting the operations,
+    the busy time of the workers and the latencies of the operations
+    (a file, a chunk of a large file or a batch of small files)
+    per size bucket are measured by the workers, see run_task.
+
+    A background thread refreshes every interval seconds
+    the progress line on the standard error (if progress is set),
+    the JSON stats file and the Prometheus textfile (if specified).
+    """
+
+    def __init__(
+            self,
+            results: ResultLog,
+            progress: bool = False,
+            stats_path: Optional[Path] = None,
+            prometheus_path: Optional[Path] = None,
+            interval: float = METRICS_INTERVAL
+    ):
+        self.results: ResultLog = results
+        self.progress: bool = progress
+        self.stats_path: Optional[Path] = stats_path
+        self.prometheus_path: Optional[Path] = prometheus_path
+        self.interval: float = interval
+        self.start: float = time.monotonic()
+
+        # The files and bytes found by the enumeration so far.
+        self.found_files: int = 0
+        self.found_bytes: int = 0
+        self.enumerated: bool = False
+        self.done_bytes: int = 0
+        self.queued: int = 0
+        self.in_flight: int = 0
+        self.busy: Dict[str, float] = {}
+        # The latency histogram per size bucket: the bucket counts and the sum.
+        self.latency_counts: List[List[int]] = \
+            [[0] * (len(METRICS_LATENCY_BUCKETS) + 1) for _ in range(len(METRICS_SIZE_BUCKETS) + 1)]
+        self.latency_sums: List[float] = [0.0] * (len(METRICS_SIZE_BUCKETS) + 1)
+
+        self.stopped: threading.Event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def observe(self, task: TaskResult, size: int) -> None:
+        """Counts the operation of the specified number of bytes run by a worker."""
+        size_bucket: int = bisect.bisect_left(METRICS_SIZE_BUCKETS, size)
+
+        self.done_bytes += size
+        self.busy[task.worker] = self.busy.get(task.worker, 0.0) + task.busy
+        self.latency_counts[size_bucket][bisect.bisect_left(METRICS_LATENCY_BUCKETS, task.busy)] += 1
+        self.latency_sums[size_bucket] += task.busy
+
+    def get_stats(self) -> Dict[str, object]:
+        elapsed: float = max(time.monotonic() - self.start, 1e-9)
+        done_files: int = self.results.success_count + self.results.error_count
+        files_per_second: float = done_files / elapsed
+        bytes_per_second: float = self.done_bytes / elapsed
+        eta: Optional[float] = None
+
+        # The remaining work is known once all files have been found.
+        if self.enumerated and (bytes_per_second > 0):
+            eta = max(self.found_bytes - self.done_bytes, 0) / bytes_per_second
+        elif self.enumerated and (files_per_second > 0):
+            eta = max(self.found_files - done_files, 0) / files_per_second
+
+        size_bounds: List[str] = [str(bound) for bound in METRICS_SIZE_BUCKETS] + ['+Inf']
+        latency_bounds: List[str] = [str(bound) for bound in METRICS_LATENCY_BUCKETS] + ['+Inf']
+
+        return {
+            'elapsed_seconds': elapsed,
+            'found_files': self.found_files,
+            'found_bytes': self.found_bytes,
+            'enumerated': self.enumerated,
+            'success_files': self.results.success_count,
+            'error_files': self.results.error_count,
+            'done_bytes': self.done_bytes,
+            'files_per_second': files_per_second,
+            'bytes_per_second': bytes_per_second,
+            'eta_seconds': eta,
+            'queued': self.queued,
+            'in_flight': self.in_flight,
+            'worker_busy_seconds': dict(self.busy),
+            'latency_seconds': {
+                size_bound: {
+                    'buckets': dict(zip(latency_bounds, counts)),
+                    'count': sum(counts),
+                    'sum': latency_sum,
+                }
+                for size_bound, counts, latency_sum
+                in zip(size_bounds, self.latency_counts, self.latency_sums)
+            },
+        }
+
+    @staticmethod
+    def format_progress(stats: Dict[str, object]) -> str:
+        eta: Optional[float] = stats['eta_seconds']
+
+        return (
+            f'{stats["success_files"] + stats["error_files"]}/{stats["found_files"]} files '
+            f'({stats["error_files"]} errors), '
+            f'{format_size(stats["done_bytes"])}/{format_size(stats["found_bytes"])}, '
+            f'{stats["files_per_second"]:.0f} files/s, '
+            f'{format_size(int(stats["bytes_per_second"]))}/s, '
+            f'{stats["in_flight"]} in flight, {stats["queued"]} queued, '
+            f'ETA {"?" if eta is None else f"{eta:.0f}s"}'
+        )
+
+    @staticmethod
+    def format_prometheus(stats: Dict[str, object]) -> str:
+        """Formats the stats in the text format of the Prometheus node exporter textfile collector."""
+        prefix: str = 'files_operations'
+        lines: List[str] = [
+            f'# TYPE {prefix}_files_total counter',
+            f'{prefix}_files_total{{result="success"}} {stats["success_files"]}',
+            f'{prefix}_files_total{{result="error"}} {stats["error_files"]}',
+            f'# TYPE {prefix}_found_files gauge',
+            f'{prefix}_found_files {stats["found_files"]}',
+            f'# TYPE {prefix}_bytes_total counter',
+            f'{prefix}_bytes_total {stats["done_bytes"]}',
+            f'# TYPE {prefix}_found_bytes gauge',
+            f'{prefix}_found_bytes {stats["found_bytes"]}',
+            f'# TYPE {prefix}_queued gauge',
+            f'{prefix}_queued {stats["queued"]}',
+            f'# TYPE {prefix}_in_flight gauge',
+            f'{prefix}_in_flight {stats["in_flight"]}',
+            f'# TYPE {prefix}_worker_busy_seconds_total counter',
+        ]
+        lines.extend(
+            f'{prefix}_worker_busy_seconds_total{{worker="{worker}"}} {busy}'
+            for worker, busy in stats['worker_busy_seconds'].items()
+        )
+        lines.append(f'# TYPE {prefix}_latency_seconds histogram')
+
+        for size_bound, histogram in stats['latency_seconds'].items():
+            cumulative_count: int = 0
+
+            for latency_bound, count in histogram['buckets'].items():
+                cumulative_count += count
+                lines.append(
+                    f'{prefix}_latency_seconds_bucket{{size="{size_bound}",le="{latency_bound}"}} {cumulative_count}'
+                )
+
+            lines.append(f'{prefix}_latency_seconds_sum{{size="{size_bound}"}} {histogram["sum"]}')
+            lines.append(f'{prefix}_latency_seconds_count{{size="{size_bound}"}} {histogram["count"]}')
+
+        return '\n'.join(lines) + '\n'
+
+    def output(self, final: bool = False) -> None:
+        stats: Dict[str, object] = self.get_stats()
+
+        if self.progress:
+            # Refresh the line in place on a terminal.
+            ending: str = '\n' if final or not sys.stderr.isatty() else ''
+            sys.stderr.write(f'\r{self.format_progress(stats=stats)}{ending}')
+            sys.stderr.flush()
+
+        if self.stats_path is not None:
+            write_atomically(path=self.stats_path, text=json.dumps(stats, indent=2))
+
+        if self.prometheus_path is not None:
+            write_atomically(path=self.prometheus_path, text=self.format_prometheus(stats=stats))
+
+    def run(self) -> None:
+        while not self.stopped.wait(timeout=self.interval):
+            self.output()
+
+    def start_output(self) -> None:
+        if self.progress or (self.stats_path is not None) or (self.prometheus_path is not None):
+            self.thread = threading.Thread(target=self.run, name='metrics', daemon=True)
+            self.thread.start()
+
+    def close(self) -> None:
+        """Stops the background thread and outputs the final stats."""
+        if self.thread is None:
+            return
+
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        self.output(final=True)
+
+
+class Profiler:
+    """Measures the wall and CPU time of the phases of the run.
+
+    The time of a phase excludes the time of the phases nested in it
+    in the same thread. The phases of the workers are their operations.
+    The phases are written to the JSON file of the path and logged.
+
+    The run can also be profiled by one of the profilers:
+    sample - the stacks of all threads are sampled
+    every PROFILE_SAMPLE_INTERVAL seconds (the worker processes are not sampled),
+    cprofile - all threads are profiled by cProfile,
+    tracemalloc - the allocations are traced and the snapshot
+    of the traced memory at its peak is kept.
+    The sample and tracemalloc profiles are written as collapsed stacks
+    to the <path>.folded file (samples or bytes per stack),
+    which flamegraph.pl, inferno and speedscope render as flame graphs.
+    The cProfile stats are written to the <path>.pstats file.
+    """
+
+    def __init__(self, path: Path, profiler_name: Optional[str] = None):
+        self.path: Path = path
+        self.profiler_name: Optional[str] = profiler_name
+        # The number of calls, the wall and CPU time of the phases.
+        self.phases: Dict[str, List[float]] = {}
+        self.lock: threading.Lock = threading.Lock()
+        self.local: threading.local = threading.local()
+        self.start_wall: float = 0.0
+        self.start_cpu: float = 0.0
+
+        self.stopped: threading.Event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.profiles: List[cProfile.Profile] = []
+        self.stacks: Dict[str, int] = {}
+        self.peak_memory: int = 0
+        self.peak_snapshot: Optional[tracemalloc.Snapshot] = None
+
+    def add(self, name: str, wall: float, cpu: float, count: int = 1) -> None:
+        with self.lock:
+            phase: List[float] = self.phases.setdefault(name, [0, 0.0, 0.0])
+            phase[0] += count
+            phase[1] += wall
+            phase[2] += cpu
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        # The wall and CPU time of the nested phases of the thread.
+        stack: List[List[float]] = self.local.__dict__.setdefault('stack', [])
+        stack.append([0.0, 0.0])
+        wall: float = time.perf_counter()
+        cpu: float = time.thread_time()
+
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu
+            nested_wall, nested_cpu = stack.pop()
+
+            if stack:
+                stack[-1][0] += wall
+                stack[-1][1] += cpu
+
+            self.add(name=name, wall=wall - nested_wall, cpu=cpu - nested_cpu)
+
+    def time_iterator(self, name: str, items: Iterable[T]) -> Iterator[T]:
+        """Yields the items, measuring the time spent producing them as the phase."""
+        iterator: Iterator[T] = iter(items)
+
+        while True:
+            with self.phase(name=name):
+                try:
+                    item: T = next(iterator)
+                except StopIteration:
+                    return
+
+            yield item
+
+    def start_thread_profile(self, frame: object, event: str, arg: object) -> None:
+        """Profiles the new thread by its own cProfile profiler."""
+        sys.setprofile(None)
+        profile: cProfile.Profile = cProfile.Profile()
+
+        try:
+            profile.enable()
+        except ValueError:
+            # The profiler of the main thread profiles all threads (Python 3.12+).
+            return
+
+        self.profiles.append(profile)
+
+    def sample_stacks(self) -> None:
+        while not self.stopped.wait(timeout=PROFILE_SAMPLE_INTERVAL):
+            thread_names: Dict[int, str] = {thread.ident: thread.name for thread in threading.enumerate()}
+
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == threading.get_ident():
+                    continue
+
+                functions: List[str] = []
+
+                while frame is not None:
+                    code = frame.f_code
+                    functions.append(f'{code.co_name}@{os.path.basename(code.co_filename)}:{code.co_firstlineno}')
+                    frame = frame.f_back
+
+                functions.append(thread_names.get(thread_id, str(thread_id)).replace(' ', '_'))
+                stack: str = ';'.join(reversed(functions))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def check_peak_memory(self) -> None:
+        memory: int = tracemalloc.get_traced_memory()[0]
+
+        if memory > self.peak_memory:
+            self.peak_memory = memory
+            self.peak_snapshot = tracemalloc.take_snapshot()
+
+    def watch_memory(self) -> None:
+        while not self.stopped.wait(timeout=PROFILE_SNAPSHOT_INTERVAL):
+            self.check_peak_memory()
+
+    def start(self) -> None:
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+        if self.profiler_name == 'cprofile':
+            profile: cProfile.Profile = cProfile.Profile()
+            profile.enable()
+            self.profiles.append(profile)
+            threading.setprofile(self.start_thread_profile)
+        elif self.profiler_name == 'sample':
+            self.thread = threading.Thread(target=self.sample_stacks, name='profiler', daemon=True)
+            self.thread.start()
+        elif self.profiler_name == 'tracemalloc':
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+            self.thread = threading.Thread(target=self.watch_memory, name='profiler', daemon=True)
+            self.thread.start()
+
+    def stop(self) -> None:
+        """Stops the profilers and writes the profiles."""
+        wall: float = time.perf_counter() - self.start_wall
+        cpu: float = time.process_time() - self.start_cpu
+
+        self.stopped.set()
+
+        if self.thread is not None:
+            self.thread.join()
+
+        if self.profiler_name == 'cprofile':
+            threading.setprofile(None)
+
+            for profile in self.profiles:
+                profile.disable()
+
+            pstats.Stats(*self.profiles).dump_stats(self.path.with_name(f'{self.path.name}.pstats'))
+        elif self.profiler_name == 'sample':
+            self.write_folded(stacks=self.stacks.items())
+        elif self.profiler_name == 'tracemalloc':
+            self.check_peak_memory()
+            tracemalloc.stop()
+            logging.info(msg=f'profile: peak traced memory {format_size(self.peak_memory)}')
+
+            if self.peak_snapshot is not None:
+                self.write_folded(stacks=(
+                    (
+                        ';'.join(f'{os.path.basename(frame.filename)}:{frame.lineno}' for frame in statistic.traceback),
+                        statistic.size
+                    )
+                    for statistic in self.peak_snapshot.statistics('traceback')
+                ))
+
+        phases: Dict[str, Dict[str, float]] = {
+            name: {'count': count, 'wall_seconds': phase_wall, 'cpu_seconds': phase_cpu}
+            for name, (count, phase_wall, phase_cpu)
+            in sorted(self.phases.items(), key=lambda item: item[1][1], reverse=True)
+        }
+
+        write_atomically(
+            path=self.path,
+            text=json.dumps({'wall_seconds': wall, 'cpu_seconds': cpu, 'phases': phases}, indent=2)
+        )
+
+        logging.info(msg=f'profile: {wall:.3f}s wall, {cpu:.3f}s CPU')
+
+        for name, phase in phases.items():
+            logging.info(
+                msg=f'profile: {name} - {phase["count"]} calls, '
+                    f'{phase["wall_seconds"]:.3f}s wall, {phase["cpu_seconds"]:.3f}s CPU'
+            )
+
+    def write_folded(self, stacks: Iterable[Tuple[str, int]]) -> None:
+        with open(self.path.with_name(f'{self.path.name}.folded'), 'w', encoding='utf-8') as folded_file:
+            for stack, count in stacks:
+                folded_file.write(f'{stack} {count}\n')
+
+    def __enter__(self) -> 'Profiler':
+        self.start()
+
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def profile_phase(profiler: Optional[Profiler], name: str) -> ContextManager:
+    """Measures the phase by the profiler (if any)."""
+    return profiler.phase(name=name) if profiler is not None else contextlib.nullcontext()
+
+
+class OperationRunner:
+    """Submits the operations on the source files to the executors
+    and outputs their results.
+
+    The operations of each pair of source and destination devices
+    are performed by their own pool of threads,
+    so a slow device does not hold up the operations on the other ones.
+    If a tuner is set, it limits the number of operations run at once.
+    If a throttle is set, the operations are submitted
+    only as fast as its files per second allow,
+    the workers copy only as fast as its bytes per second allow.
+    """
+
+    def __init__(
+            self,
+            operation: Callable[[Path, Path, str], Optional[str]],
+            copy_engine: str,
+            threads: int,
+            processes: int,
+            executor_name: str,
+            chunking: bool,
+            chunk_threshold: int,
+            chunk_size: int,
+            small_file_size: int,
+            device_threads: Dict[int, int],
+            remover: Optional[SourceRemover],
+            tuner: Optional[ThreadTuner] = None,
+            index: Optional[SyncIndex] = None,
+            journal: Optional[Journal] = None,
+            manifest: Optional[Manifest] = None,
+            verify: Optional[str] = None,
+            dedupe: Optional[str] = None,
+            results: Optional[ResultLog] = None,
+            metrics: Optional[Metrics] = None,
+            profiler: Optional[Profiler] = None,
+            throttle: Optional[Throttle] = None
+    ):
+        self.operation: Callable[[Path, Path, str], Optional[str]] = operation
+        self.copy_engine: str = copy_engine
+        self.threads: int = threads
+        self.processes: int = processes
+        self.executor_name: str = executor_name
+        self.chunking: bool = chunking
+        self.chunk_threshold: int = chunk_threshold
+        self.chunk_size: int = chunk_size
+        self.small_file_size: int = small_file_size
+        self.device_threads: Dict[int, int] = device_threads
+        self.remover: Optional[SourceRemover] = remover
+        self.tuner: Optional[ThreadTuner] = tuner
+        self.index: Optional[SyncIndex] = index
+        self.journal: Optional[Journal] = journal
+        self.manifest: Optional[Manifest] = manifest
+        self.verify: Optional[str] = verify
+        self.dedupe: Optional[str] = dedupe
+        self.results: ResultLog = results if results is not None else ResultLog()
+        self.metrics: Metrics = metrics if metrics is not None else Metrics(results=self.results)
+        self.profiler: Optional[Profiler] = profiler
+        self.throttle: Optional[Throttle] = throttle
+
+        # The number of tasks run at once by the executor of one pair of devices.
+        self.pool_size: int = threads if executor_name == 'thread' else processes
+
+        if tuner is not None:
+            self.pool_size = tuner.threads
+
+        self.workers: int = processes * threads if executor_name == 'hybrid' else self.pool_size
+        self.schedule_window: int = self.workers * SCHEDULE_WINDOW_PER_THREAD
+
+        self.pools: Dict[Devices, DevicePool] = {}
+        self.future_to_file: Dict[Future, Union[Path, ChunkedFile, List[Path]]] = {}
+        # The executor, the size and the chunk offset of the operation.
+        self.future_to_task: Dict[Future, Tuple[DevicePool, int, int]] = {}
+        self.completed: Deque[Future] = collections.deque()
+        # The files being performed by their source paths,
+        # kept for the journal and the manifest.
+        self.pending: Dict[Path, SourceFile] = {}
+        # Whether the source files have been copied, kept for their duplicates.
+        self.copied: Dict[Path, bool] = {}
+        # The duplicate files waiting for their originals to be copied.
+        self.waiting_duplicates: Dict[Path, List[SourceFile]] = {}
+        self.ready_duplicates: Deque[SourceFile] = collections.deque()
+
+    def output_file_result(
+            self,
+            file: Path,
+            exception: Optional[BaseException],
+            digest: Optional[str] = None
+    ) -> None:
+        source_file: Optional[SourceFile] = self.pending.pop(file, None)
+
+        if self.dedupe is not None:
+            self.output_original(file=file, copied=exception is None)
+
+        if self.index is not None:
+            self.index.record(path=file, success=exception is None)
+
+        if (exception is None) and (source_file is not None):
+            if self.journal is not None:
+                self.journal.record(file=source_file)
+
+            if (self.manifest is not None) and (digest is not None):
+                self.manifest.record(file=source_file, digest=digest)
+
+        if exception is None:
+            self.results.success(file=file)
+
+            if self.remover is not None:
+                self.remover.add(path=file)
+        else:
+            self.results.error(file=file, exception=exception)
+
+    def output_resumed_file(self, file: Path) -> None:
+        """Output the file copied before the run was interrupted."""
+        self.results.success(file=file, status='resumed')
+
+        if self.dedupe is not None:
+            self.output_original(file=file, copied=True)
+
+        if self.remover is not None:
+            self.remover.add(path=file)
+
+    def output_original(self, file: Path, copied: bool) -> None:
+        """Releases the duplicates waiting for the file to be copied."""
+        self.copied[file] = copied
+        self.ready_duplicates.extend(self.waiting_duplicates.pop(file, ()))
+
+    def output_result(self, future: Future) -> None:
+        file: Union[Path, ChunkedFile, List[Path], None] = self.future_to_file.pop(future, None)
+
+        # The result has already been output.
+        if file is None:
+            return
+
+        pool, size, offset = self.future_to_task.pop(future)
+        pool.in_flight -= 1
+        self.metrics.in_flight -= 1
+
+        if (self.tuner is not None) and self.tuner.add(
+                files=len(file) if isinstance(file, list) else 0 if isinstance(file, ChunkedFile) else 1,
+                size=size
+        ):
+            self.pool_size = self.tuner.threads
+
+            for tuned_pool in self.pools.values():
+                tuned_pool.max_in_flight = self.get_max_in_flight(threads=tuned_pool.threads)
+                tuned_pool.max_backlog = self.get_max_backlog(threads=tuned_pool.threads)
+                self.start_backlog(pool=tuned_pool)
+        else:
+            self.start_backlog(pool=pool)
+
+        exception: Optional[BaseException] = future.exception()
+        result: object = None
+
+        if exception is None:
+            task: TaskResult = future.result()
+            exception, result = task.exception, task.result
+            self.metrics.observe(task=task, size=size)
+
+            if self.profiler is not None:
+                self.profiler.add(name=f'operation {task.operation}', wall=task.busy, cpu=task.cpu)
+
+        if isinstance(file, list):
+            results: List[Union[BaseException, str, None]] = \
+                [exception] * len(file) if exception is not None else result
+
+            for batch_file, result in zip(file, results):
+                if isinstance(result, BaseException):
+                    self.output_file_result(file=batch_file, exception=result)
+                else:
+                    self.output_file_result(file=batch_file, exception=None, digest=result)
+
+            return
+
+        # The entries renamed into an existing folder, see rename_tree.
+        if isinstance(result, list) and (exception is None):
+            self.metrics.found_files += len(result) - 1
+
+            # The subtree has been counted as one file when submitted.
+            if self.throttle is not None:
+                self.throttle.take(files=len(result) - 1)
+
+            for moved_file in result:
+                self.output_file_result(file=moved_file, exception=None)
+
+            return
+
+        if isinstance(file, ChunkedFile):
+            file.remaining_chunks -= 1
+            file.error = file.error or exception
+
+            if (exception is None) and (self.journal is not None) and (file.source in self.pending):
+                self.journal.record(self.pending[file.source], offset, size)
+
+            if (exception is None) and (self.verify is not None):
+                file.digests[offset] = result
+
+            if file.remaining_chunks > 0:
+                return
+
+            exception = file.error
+
+            try:
+                if exception is None:
+                    shutil.copystat(src=file.source, dst=file.destination)
+
+                    if self.verify is not None:
+                        self.submit_verification(
+                            pool=pool,
+                            source=file.source,
+                            destination=file.destination,
+                            chunk_digests=file.digests
+                        )
+
+                        return
+                elif self.journal is None:
+                    # Do not leave a preallocated file with holes,
+                    # unless its copied chunks are journaled for --resume.
+                    os.remove(file.destination)
+            except OSError as error:
+                exception = exception or error
+
+            file = file.source
+
+        self.output_file_result(
+            file=file,
+            exception=exception,
+            digest=result if exception is None else None
+        )
+
+    def output_completed(self, block: bool) -> None:
+        """Output the results of the completed operations,
+        waiting for at least one of them if block is set."""
+        if block and not self.completed:
+            with profile_phase(profiler=self.profiler, name='wait'):
+                done, _ = wait(self.future_to_file, return_when=FIRST_COMPLETED)
+
+            with profile_phase(profiler=self.profiler, name='output'):
+                for done_future in done:
+                    self.output_result(future=done_future)
+
+        if not self.completed:
+            return
+
+        with profile_phase(profiler=self.profiler, name='output'):
+            while self.completed:
+                self.output_result(future=self.completed.popleft())
+
+    def get_pool(self, devices: Devices) -> DevicePool:
+        """Returns the executor of the pair of devices, creating it on first use."""
+        # Processes are shared by all devices.
+        if self.executor_name != 'thread':
+            devices = (0, 0)
+
+        pool: Optional[DevicePool] = self.pools.get(devices)
+
+        if pool is None:
+            threads: int = min(
+                self.device_threads.get(devices[0], self.threads),
+                self.device_threads.get(devices[1], self.threads)
+            )
+            pool = DevicePool(
+                executor=executors[self.executor_name](threads, self.processes),
+                threads=threads,
+                max_in_flight=self.get_max_in_flight(threads=threads),
+                max_backlog=self.get_max_backlog(threads=threads)
+            )
+            self.pools[devices] = pool
+
+            logging.debug(msg=f'{threads} threads for devices {devices[0]} -> {devices[1]}')
+
+        return pool
+
+    def get_max_in_flight(self, threads: int) -> int:
+        """Returns the number of operations submitted at once
+        to the executor running the specified number of threads."""
+        # Queued operations would be run by the idle threads of the executor.
+        if self.tuner is not None:
+            return min(self.tuner.threads, threads)
+
+        return (threads if self.executor_name == 'thread' else self.processes) * IN_FLIGHT_TASKS_PER_THREAD
+
+    def get_max_backlog(self, threads: int) -> int:
+        """Returns the number of pending operations of the executor
+        running the specified number of threads at which the enumeration waits."""
+        if self.tuner is not None:
+            threads = min(self.tuner.threads, threads)
+
+        return (threads if self.executor_name == 'thread' else self.processes) * IN_FLIGHT_TASKS_PER_THREAD
+
+    def start_backlog(self, pool: DevicePool) -> None:
+        """Submit the pending operations while the executor has free slots."""
+        while pool.backlog and (pool.in_flight < pool.max_in_flight):
+            file, size, function, kwargs = pool.backlog.popleft()
+            future: Future = pool.executor.submit(run_task, function, kwargs)
+
+            pool.in_flight += 1
+            self.metrics.queued -= 1
+            self.metrics.in_flight += 1
+            self.future_to_file.update({future: file})
+            self.future_to_task.update({future: (pool, size, kwargs.get('offset', 0))})
+            future.add_done_callback(self.completed.append)
+
+    def submit(
+            self,
+            file: Union[Path, ChunkedFile, List[Path]],
+            devices: Devices,
+            size: int,
+            function: Callable,
+            files: Optional[int] = None,
+            **kwargs
+    ) -> None:
+        """Submits the operation of the files (1 file, the files of a batch by default)."""
+        if self.throttle is not None:
+            self.wait_for_throttle()
+            self.throttle.take(files=files if files is not None else len(file) if isinstance(file, list) else 1)
+
+        pool: DevicePool = self.get_pool(devices=devices)
+
+        pool.backlog.append((file, size, function, kwargs))
+        self.metrics.queued += 1
+        self.start_backlog(pool=pool)
+
+        # Wait for free slots while too many operations are pending on the devices of the file,
+        # the other pools keep running their own backlogs.
+        while len(pool.backlog) >= pool.max_backlog:
+            self.output_completed(block=True)
+
+    def submit_verification(
+            self,
+            pool: DevicePool,
+            source: Path,
+            destination: Path,
+            chunk_digests: Optional[Dict[int, Optional[str]]] = None
+    ) -> None:
+        """Verify the large file copied by chunks (or cloned) in the executor of its devices
+        against the digests of its chunks (if any), its result is output once verified."""
+        # Its bytes have been counted by the chunks.
+        if chunk_digests is not None:
+            pool.backlog.append((source, 0, verify_chunks, {
+                'source': source,
+                'destination': destination,
+                'algorithm': self.verify,
+                'chunk_size': self.chunk_size,
+                'chunk_digests': chunk_digests
+            }))
+        else:
+            pool.backlog.append((source, 0, verify_copy, {
+                'source': source,
+                'destination': destination,
+                'algorithm': self.verify
+            }))
+
+        self.metrics.queued += 1
+        self.start_backlog(pool=pool)
+
+    def output_copied_file(self, source: Path, destination: Path, devices: Devices) -> None:
+        """Output the large file copied without its chunks, once verified if verify is set."""
+        if self.verify is not None:
+            self.submit_verification(pool=self.get_pool(devices=devices), source=source, destination=destination)
+        else:
+            self.output_file_result(file=source, exception=None)
+
+    def wait_for_throttle(self) -> None:
+        """Wait until the throttle allows the next operation,
+        outputting the results of the completed operations meanwhile."""
+        with profile_phase(profiler=self.profiler, name='throttle'):
+            delay: float = self.throttle.get_delay()
+
+            while delay > 0:
+                time.sleep(min(delay, THROTTLE_WAIT_STEP))
+                self.output_completed(block=False)
+                delay = self.throttle.get_delay()
+
+    def submit_file(self, file: SourceFile) -> None:
+        source_path, destination_path, size, devices = file.source, file.destination, file.size, file.devices
+
+        if (not self.chunking) or (size < self.chunk_threshold):
+            self.submit(
+                source_path,
+                devices,
+                size,
+                self.operation,
+                source=source_path,
+                destination=destination_path,
+                engine=self.copy_engine
+            )
+
+            return
+
+        # A single source file is copied into the destination folder.
+        if os.path.isdir(destination_path):
+            destination_path = destination_path / source_path.name
+
+        # The chunks copied before the copy was interrupted.
+        copied_chunks: Set[Tuple[int, int]] = \
+            self.journal.get_copied_chunks(file=file) if self.journal is not None else set()
+
+        if not os.path.exists(destination_path):
+            copied_chunks = set()
+
+        try:
+            chunk_engine: Optional[str] = preallocate_file(
+                source=source_path,
+                destination=destination_path,
+                size=size,
+                engine=self.copy_engine,
+                keep_data=len(copied_chunks) > 0
+            )
+
+            # The whole file has been cloned.
+            if chunk_engine is None:
+                shutil.copystat(src=source_path, dst=destination_path)
+        except Exception as exception:
+            self.output_file_result(file=source_path, exception=exception)
+
+            return
+
+        if chunk_engine is None:
+            self.output_copied_file(source=source_path, destination=destination_path, devices=devices)
+
+            return
+
+        chunks: List[Tuple[int, int]] = [
+            (offset, min(self.chunk_size, size - offset))
+            for offset in range(0, size, self.chunk_size)
+            if (offset, min(self.chunk_size, size - offset)) not in copied_chunks
+        ]
+
+        # All chunks have been copied, only the metadata is left.
+        if not chunks:
+            try:
+                shutil.copystat(src=source_path, dst=destination_path)
+            except OSError as exception:
+                self.output_file_result(file=source_path, exception=exception)
+            else:
+                self.output_copied_file(source=source_path, destination=destination_path, devices=devices)
+
+            return
+
+        chunked_file: ChunkedFile = ChunkedFile(
+            source=source_path,
+            destination=destination_path,
+            remaining_chunks=len(chunks)
+        )
+
+        for offset, length in chunks:
+            self.submit(
+                chunked_file,
+                devices,
+                length,
+                copy_chunk,
+                # The file is counted once, with its first chunk.
+                files=int(offset == chunks[0][0]),
+                source=source_path,
+                destination=destination_path,
+                offset=offset,
+                length=length,
+                engine=chunk_engine,
+                # The digests of the chunks are compared once the file has been copied.
+                **({'algorithm': self.verify} if self.verify is not None else {})
+            )
+
+    def submit_duplicate(self, file: SourceFile) -> None:
+        """Link the duplicate file to its original once the original has been copied."""
+        copied: Optional[bool] = self.copied.get(file.original.source)
+
+        if copied is None:
+            self.waiting_duplicates.setdefault(file.original.source, []).append(file)
+
+            return
+
+        # The original has not been copied, copy the duplicate itself.
+        if not copied:
+            self.submit_file(file=file._replace(original=None))
+
+            return
+
+        self.submit(
+            file.source,
+            file.devices,
+            0,
+            link_duplicate,
+            source=file.source,
+            destination=file.destination,
+            original=file.original.destination,
+            method=self.dedupe,
+            engine=self.copy_engine
+        )
+
+    def submit_ready_duplicates(self) -> None:
+        while self.ready_duplicates:
+            self.submit_duplicate(file=self.ready_duplicates.popleft())
+
+    def submit_batch(self, batch: List[SourceFile], function: Callable) -> None:
+        """Submit the files as one operation run by the function."""
+        if len(batch) == 1:
+            self.submit_file(file=batch[0])
+
+            return
+
+        self.submit(
+            [file.source for file in batch],
+            batch[0].devices,
+            sum(file.size for file in batch),
+            function,
+            operation=self.operation,
+            source_and_destination_paths=[(file.source, file.destination) for file in batch],
+            engine=self.copy_engine
+        )
+
+    def submit_window(self, window: List[SourceFile]) -> None:
+        # Largest files first, so no large file is left for the end.
+        window.sort(key=lambda file: file.size, reverse=True)
+
+        if self.executor_name == 'hybrid':
+            chunked: int = 0
+
+            # Only the chunked files are submitted one by one.
+            while self.chunking and (chunked < len(window)) and \
+                    (window[chunked].size >= self.chunk_threshold):
+                chunked += 1
+
+            for file in window[:chunked]:
+                self.submit_file(file=file)
+
+            # Files of the same folder go to the same worker process.
+            shards: List[SourceFile] = \
+                sorted(window[chunked:], key=lambda file: str(file.source.parent))
+            shard_size: int = self.threads * SMALL_FILE_BATCH_SIZE
+
+            for start in range(0, len(shards), shard_size):
+                self.submit_batch(batch=shards[start:start + shard_size], function=run_shard)
+
+            return
+
+        batches: Dict[Devices, List[SourceFile]] = {}
+
+        for file in window:
+            if file.size >= self.small_file_size:
+                self.submit_file(file=file)
+
+                continue
+
+            batch: List[SourceFile] = batches.setdefault(file.devices, [])
+            batch.append(file)
+
+            if len(batch) == SMALL_FILE_BATCH_SIZE:
+                self.submit_batch(batch=batch, function=run_batch)
+                batches[file.devices] = []
+
+        for batch in batches.values():
+            if batch:
+                self.submit_batch(batch=batch, function=run_batch)
+
+    def run(self, files: Iterable[SourceFile]) -> None:
+        """Performs the operation on the files."""
+        window: List[SourceFile] = []
+        enumerated_files: Iterator[SourceFile] = iterate_in_background(
+            items=files,
+            maxsize=self.workers * QUEUE_SIZE_PER_THREAD
+        )
+
+        if self.profiler is not None:
+            enumerated_files = self.profiler.time_iterator(name='wait for files', items=enumerated_files)
+
+        # The copies of the workers take the bytes of the throttle, see take_bandwidth.
+        set_worker_bandwidth(bucket=self.throttle.bytes if self.throttle is not None else None)
+
+        try:
+            # Submit operation.
+            for file in enumerated_files:
+                self.metrics.found_files += 1
+                self.metrics.found_bytes += file.size
+
+                if (self.journal is not None) and self.journal.is_copied(file=file):
+                    self.metrics.done_bytes += file.size
+                    self.output_resumed_file(file=file.source)
+
+                    continue
+
+                if (self.journal is not None) or (self.manifest is not None):
+                    self.pending[file.source] = file
+
+                if file.original is not None:
+                    self.submit_duplicate(file=file)
+                else:
+                    window.append(file)
+
+                self.output_completed(block=False)
+                self.submit_ready_duplicates()
 
+                # Submit at once while some workers are idle.
+                if (len(window) >= self.schedule_window) or \
+                   (len(self.future_to_file) < self.pool_size):
+                    self.submit_window(window=window)
+                    window = []
 
-def check_paths_exists(source: Path, destination: Path) -> bool:
-    """Check that source and destination paths exist."""
-    def check_path_exists(path: Path) -> bool:
-        if not path.exists():
-            logging.error(msg=f'{path.name} does not exists.')
+            self.metrics.enumerated = True
+            self.submit_window(window=window)
+            self.submit_ready_duplicates()
 
-        return path.exists()
+            # Output result.
+            while self.future_to_file:
+                self.output_completed(block=True)
+                self.submit_ready_duplicates()
+        finally:
+            for pool in self.pools.values():
+                pool.executor.shutdown(wait=True)
 
-    return check_path_exists(path=source) and check_path_exists(path=destination)
+            set_worker_bandwidth(bucket=None)
 
+            if self.tuner is not None:
+                self.tuner.finish()
 
-def extract_path_and_mask(path: str) -> Tuple[Path, Optional[str]]:
-    """Extract path and mask (if any) from the specified path."""
-    elements: Tuple[str, str, str] = path.partition('*')
+            # Sources copied before an error are unlinked too.
+            if self.remover is not None:
+                for file, exception in self.remover.close():
+                    self.results.success_count -= 1
+                    self.output_file_result(file=file, exception=exception)
 
-    new_path: Path = Path(elements[0])
-    mask: Optional[str] = None
 
-    if elements[1] != '':
-        mask = f'{elements[1]}{elements[2]}'
+def run_operation_in_threads(
+        source: Path,
+        operation_name: str,
+        source_and_destination_paths: Iterable[Tuple[Path, Path]],
+        threads: int,
+        mask: Optional[str],
+        copy_engine: str = 'auto',
+        chunk_threshold: int = DEFAULT_CHUNK_THRESHOLD,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        destination: Optional[Path] = None,
+        small_file_size: int = DEFAULT_SMALL_FILE_SIZE,
+        executor_name: str = 'thread',
+        processes: int = DEFAULT_PROCESSES,
+        device_threads: Optional[Dict[int, int]] = None,
+        autotune: bool = False,
+        journaled: bool = False,
+        resume: bool = False,
+        verify: Optional[str] = None,
+        dedupe: Optional[str] = None,
+        report: Optional[Path] = None,
+        progress: bool = False,
+        stats: Optional[Path] = None,
+        prometheus: Optional[Path] = None,
+        profiler: Optional[Profiler] = None,
+        filtered: bool = False,
+        known_sizes: Optional[Dict[Path, int]] = None,
+        max_bandwidth: Optional[int] = None,
+        max_files_per_sec: Optional[float] = None,
+        throttle_file: Optional[Path] = None
+) -> None:
+    """Runs the specified operation using the specified number of threads,
+    see OperationRunner and the help of the command line options for the other arguments."""
+    if device_threads is None:
+        device_threads = {}
 
-    return new_path, mask
+    operation: Callable[[Path, Path, str], None] = operations.get(operation_name)
+    remover: Optional[SourceRemover] = None
+    # Whether all files of the source folder are selected.
+    whole_folder: bool = ((mask is None) or (mask == '**/*')) and not filtered
+    same_device: bool = \
+        (destination is None) or is_same_device(source=source, destination=destination)
 
+    if operation_name == 'move':
+        if not same_device:
+            # Copy the files, then unlink the sources that have been copied.
+            operation = copy
+            remover = SourceRemover(
+                root=source,
+                remove_folders=whole_folder
+            )
+        elif is_tree_rename(
+                operation_name=operation_name,
+                source=source,
+                destination=destination,
+                whole_folder=whole_folder
+        ):
+            # Rename whole subtrees instead of moving file by file.
+            operation = rename_tree
+            source_and_destination_paths = create_rename_paths(
+                source=source,
+                destination=destination
+            )
+            # A top-level entry can be a large subtree.
+            small_file_size = 0
 
-def copy(source: Path, destination: Path) -> None:
-    """Copy the file data and metadata to the destination."""
-    shutil.copy2(src=source, dst=destination)
+    workers: int = processes * threads if executor_name == 'hybrid' else \
+        threads if executor_name == 'thread' else processes
+    copying: bool = operation is copy
 
+    if copying and (verify is not None):
+        operation = functools.partial(copy_verified, algorithm=verify)
 
-def move(source: Path, destination: Path) -> None:
-    """Move the file to the destination."""
-    shutil.move(src=source, dst=destination)
+    index: Optional[SyncIndex] = \
+        SyncIndex(destination=destination) \
+        if (operation_name == 'sync') and (destination is not None) else None
+    journal: Optional[Journal] = \
+        Journal(path=destination / JOURNAL_NAME, resume=resume) \
+        if copying and (destination is not None) and (journaled or resume) else None
+    manifest: Optional[Manifest] = \
+        Manifest(destination=destination, algorithm=verify) \
+        if copying and (verify is not None) and (destination is not None) else None
 
+    results: ResultLog = ResultLog(report_path=report)
+    metrics: Metrics = Metrics(
+        results=results,
+        progress=progress,
+        stats_path=stats,
+        prometheus_path=prometheus
+    )
+    runner: OperationRunner = OperationRunner(
+        operation=operation,
+        copy_engine=copy_engine,
+        threads=threads,
+        processes=processes,
+        executor_name=executor_name,
+        chunking=copying and (workers > 1) and (chunk_threshold > 0),
+        chunk_threshold=chunk_threshold,
+        chunk_size=chunk_size,
+        small_file_size=small_file_size,
+        device_threads=device_threads,
+        remover=remover,
+        tuner=ThreadTuner(max_threads=threads) if autotune and (executor_name == 'thread') else None,
+        index=index,
+        journal=journal,
+        manifest=manifest,
+        verify=verify,
+        dedupe=dedupe if copying else None,
+        results=results,
+        metrics=metrics,
+        profiler=profiler,
+        throttle=Throttle(
+            max_bandwidth=max_bandwidth,
+            max_files_per_sec=max_files_per_sec,
+            path=throttle_file,
+            # The worker processes take the bytes from the same bucket.
+            shared=executor_name != 'thread'
+        ) if max_bandwidth or max_files_per_sec or (throttle_file is not None) else None
+    )
 
-operations: Final[Dict[str, Callable[[Path, Path], None]]] = {
-    'copy': copy,
-    'move': move
-}
+    # The stats are collected in the enumeration thread,
+    # only copying the file data and the per-device limits depend on them.
+    files: Iterable[SourceFile] = add_file_stats(
+        source_and_destination_paths=source_and_destination_paths,
+        with_stats=copying or (len(device_threads) > 0),
+        known_sizes=known_sizes,
+        stat_known=(index is not None) or resume or (len(device_threads) > 0)
+    )
 
+    if profiler is not None:
+        files = profiler.time_iterator(name='file stats', items=files)
 
-def list_files(source: Path, mask: Optional[str]) -> List[Path]:
-    """Returns all files in the source with using a mask (if any)."""
-    files: List[Path] = []
+    if index is not None:
+        files = index.filter(files=files)
 
-    if mask is None:
-        mask = '**/*'
+    deduplicator: Optional[Deduplicator] = Deduplicator(threads=workers) if runner.dedupe is not None else None
 
-    for entry in source.glob(mask):
-        if entry.is_file():
-            files.append(entry)
+    if deduplicator is not None:
+        files = deduplicator.filter(files=files)
 
-    return files
+    completed: bool = False
+    metrics.start_output()
 
+    try:
+        with profile_phase(profiler=profiler, name='schedule'):
+            runner.run(files=files)
 
-def create_source_paths(source: Path, mask: Optional[str]) -> List[Path]:
-    """Returns a list of paths to source files."""
-    source_paths: List[Path] = []
+        completed = True
+    finally:
+        metrics.close()
 
-    if source.is_file():
-        source_paths.append(source)
-    else:
-        try:
-            source_paths = list_files(source=source, mask=mask)
-        except Exception:
-            logging.exception(msg=f'Invalid search pattern in {source} path.')
-            raise
+        if index is not None:
+            index.close()
 
-    return source_paths
+        if manifest is not None:
+            manifest.close()
 
+        # Keep the journal to resume the run until all files have been copied.
+        if journal is not None:
+            journal.close(remove=completed and (runner.results.error_count == 0))
 
-def create_source_and_destination_paths(
-        source: Path,
-        source_paths: List[Path],
-        destination: Path
-) -> Dict[Path, Path]:
-    """Returns a dictionary with
-    the key - the path to the source file
-    and value - the destination path, including subfolders and the file name.
+    # Delete the source folder
+    # when all files have been successfully moved out of it.
+    if (operation_name == 'move') and \
+       (runner.results.error_count == 0) and \
+       whole_folder and \
+       source.is_dir():
+        with profile_phase(profiler=profiler, name='remove source folder'):
+            shutil.rmtree(source)
 
-    Also creates subfolders in the destination path.
+    runner.results.close()
 
-    Example:
-        /home/user/projects/ - source
-        /home/user/projects/subfolder/file.txt - the path to the source file
-        /root/ - destination
-        /root/subfolder/file.txt - the destination path
+    if index is not None:
+        logging.info(f'Skipped {index.skipped_count} unchanged files')
+
+    if resume and (journal is not None):
+        logging.info(f'Resumed {journal.resumed_count} files')
+
+    if deduplicator is not None:
+        logging.info(f'Deduplicated {deduplicator.duplicate_count} files')
+
+
+def is_archive_path(path: Path) -> bool:
+    """Returns whether the path is a tar archive or the standard stream."""
+    return (str(path) == STANDARD_STREAM) or path.name.endswith(ARCHIVE_SUFFIXES)
+
+
+@contextlib.contextmanager
+def open_archive(path: Path, writing: bool) -> Iterator[tarfile.TarFile]:
+    """Opens the tar archive as a stream,
+    compressed according to the suffix of its path.
+
+    '-' stands for the uncompressed archive
+    on the standard output (writing) or input (reading).
     """
-    source_and_destination_paths: Dict[Path, Path] = {}
-    folders_to_create: Set[Path] = set()
+    standard_stream: bool = str(path) == STANDARD_STREAM
+    stream = (sys.stdout.buffer if writing else sys.stdin.buffer) if standard_stream else \
+        open(path, 'wb' if writing else 'rb')
 
-    for source_path in source_paths:
-        destination_path: Path = destination / source_path.relative_to(source)
+    try:
+        if path.name.endswith('.tar.zst'):
+            if zstandard is None:
+                raise ValueError('zstd archives require the zstandard package')
 
-        source_and_destination_paths.update({source_path: destination_path})
+            zstd_stream = \
+                zstandard.ZstdCompressor(threads=-1).stream_writer(stream, closefd=False) if writing else \
+                zstandard.ZstdDecompressor().stream_reader(stream, closefd=False)
 
-        if destination != destination_path.parent:
-            folders_to_create.add(destination_path.parent)
+            with zstd_stream, tarfile.open(fileobj=zstd_stream, mode='w|' if writing else 'r|') as archive:
+                yield archive
+        else:
+            compression: str = 'gz' if path.name.endswith('.tar.gz') else ''
 
-    # Create subfolders in the destination path.
-    for folder in folders_to_create:
-        os.makedirs(folder, exist_ok=True)
+            with tarfile.open(fileobj=stream, mode=f'w|{compression}' if writing else f'r|{compression}') as archive:
+                yield archive
+    finally:
+        if standard_stream:
+            stream.flush()
+        else:
+            stream.close()
 
-    return source_and_destination_paths
 
+class ArchiveFileReader:
+    """Reads the file streamed to the archive up to the size of its member.
 
-def run_operation_in_threads(
-        source: Path,
-        operation_name: str,
-        source_and_destination_paths: Dict[Path, Path],
+    If the file shrinks or cannot be read while it is archived,
+    the rest of the member is filled with zeros, so the archive stays readable,
+    and the error is kept.
+    """
+
+    def __init__(self, file: BinaryIO, size: int):
+        self.file: BinaryIO = file
+        self.remaining: int = size
+        self.error: Optional[BaseException] = None
+
+    def read(self, size: int = -1) -> bytes:
+        size = self.remaining if size < 0 else min(size, self.remaining)
+        data: bytes = b''
+
+        if self.error is None:
+            try:
+                data = self.file.read(size)
+            except OSError as exception:
+                self.error = exception
+
+            if (self.error is None) and (len(data) < size):
+                self.error = ValueError(
+                    f'the file shrank while archived, its last {self.remaining - len(data)} bytes are zeros'
+                )
+
+        self.remaining -= size
+
+        return data + bytes(size - len(data))
+
+
+def read_archive_member(source: Path, name: str) -> Tuple[tarfile.TarInfo, Optional[bytes]]:
+    """Returns the archive member of the file or the folder and its data,
+    None for the files larger than ARCHIVE_READ_SIZE."""
+    source_stat: os.stat_result = os.stat(source)
+    member: tarfile.TarInfo = tarfile.TarInfo(name=name)
+    member.mode = source_stat.st_mode & 0o7777
+    member.mtime = int(source_stat.st_mtime)
+
+    if stat.S_ISDIR(source_stat.st_mode):
+        member.type = tarfile.DIRTYPE
+
+        return member, b''
+
+    member.size = source_stat.st_size
+
+    if member.size > ARCHIVE_READ_SIZE:
+        return member, None
+
+    with open(source, 'rb') as source_file:
+        data: bytes = source_file.read()
+
+    # The file has been changed since it was accessed.
+    member.size = len(data)
+
+    return member, data
+
+
+def write_archive(
+        source_and_destination_paths: Iterable[Tuple[Path, Path]],
+        destination: Path,
         threads: int,
-        mask: Optional[str]
+        report: Optional[Path] = None
 ) -> None:
-    """Runs the specified operation using the specified number of threads."""
-    success_count: int = 0
-    error_count: int = 0
-
-    with ThreadPoolExecutor(max_workers=threads) as executor:
-        operation: Callable[[Path, Path], None] = operations.get(operation_name)
-        future_to_file: Dict[Future, Path] = {}
-
-        # Submit operation.
-        for source_path, destination_path in source_and_destination_paths.items():
-            future: Future = executor.submit(
-                operation,
-                source=source_path,
-                destination=destination_path
-            )
+    """Writes the files and folders to the tar archive at the destination path
+    under their destination paths, relative to the archive.
+
+    The files are read by the specified number of threads
+    and written by a single writer in the order they are enumerated.
+    The files larger than ARCHIVE_READ_SIZE are streamed by the writer,
+    see ArchiveFileReader.
+    """
+    results: ResultLog = ResultLog(report_path=report)
+    reads: Deque[Tuple[Path, Future]] = collections.deque()
+
+    def output_read(archive: tarfile.TarFile, source_path: Path, future: Future) -> None:
+        try:
+            member, data = future.result()
+            source_file = open(source_path, 'rb') if data is None else io.BytesIO(data)
+        except Exception as exception:
+            results.error(file=source_path, exception=exception)
+
+            return
+
+        reader: ArchiveFileReader = ArchiveFileReader(file=source_file, size=member.size)
+
+        with source_file:
+            archive.addfile(tarinfo=member, fileobj=reader)
+
+        if reader.error is not None:
+            results.error(file=source_path, exception=reader.error)
+        # Only the files are counted, as by extract_archive.
+        elif member.isfile():
+            results.success(file=source_path)
+
+    with open_archive(path=destination, writing=True) as archive, \
+            ThreadPoolExecutor(max_workers=threads) as executor:
+        for source_path, destination_path in iterate_in_background(
+                items=source_and_destination_paths,
+                maxsize=threads * QUEUE_SIZE_PER_THREAD
+        ):
+            # A single source file is written under its name.
+            name: str = source_path.name if destination_path == Path() else destination_path.as_posix()
+
+            reads.append((source_path, executor.submit(read_archive_member, source_path, name)))
+
+            while len(reads) > threads * IN_FLIGHT_TASKS_PER_THREAD:
+                output_read(archive, *reads.popleft())
+
+        while reads:
+            output_read(archive, *reads.popleft())
+
+    results.close()
+
+
+def write_extracted_file(path: Path, data: bytes, member: tarfile.TarInfo) -> None:
+    """Writes the file extracted from the archive."""
+    with open(path, 'wb') as file:
+        file.write(data)
+
+    os.chmod(path, member.mode & EXTRACTED_MODE_MASK)
+    os.utime(path, (member.mtime, member.mtime))
+
+
+def extract_archive(source: Path, destination: Path, threads: int, report: Optional[Path] = None) -> None:
+    """Extracts the files and folders of the tar archive
+    at the source path to the destination folder.
+
+    The archive is read by a single reader and the files are written
+    by the specified number of threads. The files larger than
+    ARCHIVE_READ_SIZE are written by the reader itself.
+    Members of other types or outside the destination folder are not extracted,
+    the setuid, setgid and sticky bits of the members are not applied.
+    """
+    results: ResultLog = ResultLog(report_path=report)
+    created_folders: Set[Path] = set()
+    writes: Deque[Tuple[str, Future]] = collections.deque()
 
-            future_to_file.update({future: source_path})
+    def output_result(name: str, exception: Optional[BaseException]) -> None:
+        if exception is None:
+            results.success(file=name)
+        else:
+            results.error(file=name, exception=exception)
 
-        # Output result.
-        for future in as_completed(future_to_file):
-            file: Path = future_to_file.get(future)
+    with open_archive(path=source, writing=False) as archive, \
+            ThreadPoolExecutor(max_workers=threads) as executor:
+        for member in archive:
+            member_path: PurePosixPath = PurePosixPath(member.name)
+
+            if member_path.is_absolute() or ('..' in member_path.parts):
+                output_result(name=member.name, exception=ValueError('the path is outside the destination folder'))
+
+                continue
+
+            path: Path = destination / member_path
 
             try:
-                future.result()
+                if member.isdir():
+                    os.makedirs(path, exist_ok=True)
+                    created_folders.add(path)
 
-                logging.info(msg=f'success: {file}')
+                    continue
 
-                success_count += 1
-            except Exception as exception:
-                logging.error(msg=f'error: {file} - {str(exception)}')
-                error_count += 1
+                if not member.isfile():
+                    raise ValueError('only files and folders are extracted')
+
+                if path.parent not in created_folders:
+                    os.makedirs(path.parent, exist_ok=True)
+                    created_folders.add(path.parent)
+
+                data: io.BufferedReader = archive.extractfile(member)
+
+                if member.size <= ARCHIVE_READ_SIZE:
+                    writes.append((member.name, executor.submit(write_extracted_file, path, data.read(), member)))
+                else:
+                    with open(path, 'wb') as file:
+                        shutil.copyfileobj(data, file, COPY_BUFFER_SIZE)
+
+                    os.chmod(path, member.mode & EXTRACTED_MODE_MASK)
+                    os.utime(path, (member.mtime, member.mtime))
+                    output_result(name=member.name, exception=None)
+            except (OSError, ValueError) as exception:
+                output_result(name=member.name, exception=exception)
+
+            while len(writes) > threads * IN_FLIGHT_TASKS_PER_THREAD:
+                name, future = writes.popleft()
+                output_result(name=name, exception=future.exception())
+
+        while writes:
+            name, future = writes.popleft()
+            output_result(name=name, exception=future.exception())
+
+    results.close()
+
+
+def int_or_auto(value: str) -> Union[int, str]:
+    """Parse an integer or the auto value."""
+    return value if value == AUTO_THREADS else int(value)
 
-    # Delete the source folder
-    # when all files have been successfully moved out of it.
-    if (operation_name == 'move') and \
-       (error_count == 0) and \
-       ((mask is None) or (mask == '**/*')):
-        shutil.rmtree(source)
 
-    logging.info(f'\nSuccess {success_count} files')
-    logging.info(f'Error {error_count} files')
+def parse_size(value: str) -> int:
+    """Parse a number of bytes with an optional K, M, G or T suffix (powers of 1024), such as 50M."""
+    match: Optional[re.Match] = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?', value.strip(), flags=re.IGNORECASE)
+
+    if match is None:
+        raise ValueError(f'invalid size {value}')
+
+    return int(float(match[1]) * SIZE_UNITS[match[2].upper()])
 
 
 def parse_args(args: List[str]) -> argparse.Namespace:
@@ -198,8 +4101,15 @@ def parse_args(args: List[str]) -> argparse.Namespace:
         '--operation',
         type=str,
         required=True,
-        choices=operations.keys(),
-        help='Operation to be performed on files.'
+        choices=[*operations.keys(), 'extract'],
+        help='Operation to be performed on files.\n'
+             'move - rename the files on the same device (the top-level entries\n'
+             'of a whole source folder, reported as renamed entries),\n'
+             'copy them to another device and remove the copied sources.\n'
+             'sync - copy only the files changed since the last sync,\n'
+             f'the synced files are indexed in the {SYNC_INDEX_NAME} file\n'
+             'of the destination folder.\n'
+             'extract - extract the tar archive (--from) to the destination folder.'
     )
     parser.add_argument(
         '--from',
@@ -218,59 +4128,549 @@ def parse_args(args: List[str]) -> argparse.Namespace:
         dest='destination',
         type=Path,
         required=True,
-        help='The destination folder path.'
+        help='The destination folder path.\n'
+             'The copied files can also be written to a tar archive:\n'
+             'out.tar, out.tar.gz, out.tar.zst (requires the zstandard package)\n'
+             'or - for the standard output.\n'
+             'The folders are archived too, unless a mask or a filter selects the files,\n'
+             'only the files are counted in the results.'
     )
     parser.add_argument(
         '--threads',
-        type=int,
+        type=int_or_auto,
         default=1,
         help='The number of threads used to perform operation on files.\n'
              'Default - 1 thread.\n'
              'The minimum number of threads is 1.\n'
-             'When the source is a file, 1 thread is used.'
+             'Large files are copied by chunks in several threads.\n'
+             f'auto - tune the number of threads (at most {AUTOTUNE_MAX_THREADS})\n'
+             'on the measured throughput, the chosen number is logged\n'
+             'and tuned again when the throughput changes during the run.'
+    )
+    parser.add_argument(
+        '--copy-engine',
+        type=str,
+        default='auto',
+        choices=['auto', *copy_engines.keys()],
+        help='The engine used to copy the file data.\n'
+             'Default - auto, the fastest engine supported by the filesystems.\n'
+             'An unsupported engine falls back to the next one:\n'
+             'reflink -> copy_file_range -> sendfile -> buffered.'
+    )
+    parser.add_argument(
+        '--chunk-threshold',
+        type=int,
+        default=DEFAULT_CHUNK_THRESHOLD,
+        help='Files of at least this size in bytes are copied\n'
+             'by chunks in several threads.\n'
+             f'Default - {DEFAULT_CHUNK_THRESHOLD} bytes (256 MiB).\n'
+             '0 - files are never split.'
+    )
+    parser.add_argument(
+        '--chunk-size',
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help='The size in bytes of a file chunk copied by one thread.\n'
+             f'Default - {DEFAULT_CHUNK_SIZE} bytes (64 MiB).'
+    )
+    parser.add_argument(
+        '--small-file-size',
+        type=int,
+        default=DEFAULT_SMALL_FILE_SIZE,
+        help='Files smaller than this size in bytes are packed\n'
+             'into batches performed by one thread.\n'
+             f'Default - {DEFAULT_SMALL_FILE_SIZE} bytes (64 KiB).\n'
+             '0 - files are never batched.'
+    )
+    parser.add_argument(
+        '--executor',
+        type=str,
+        default='thread',
+        choices=executors.keys(),
+        help='How operations are run:\n'
+             'thread - in --threads threads (default),\n'
+             'process - in --processes single-threaded processes,\n'
+             'hybrid - in --processes processes running --threads threads each,\n'
+             'files are sent to the processes in shards grouped by folder.'
+    )
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=DEFAULT_PROCESSES,
+        help='The number of worker processes of the process and hybrid executors.\n'
+             'Default - the number of CPUs.'
+    )
+    parser.add_argument(
+        '--include',
+        type=str,
+        action='append',
+        default=[],
+        help='Select only the files matching the pattern, can be repeated.\n'
+             "A pattern without '/' matches the file name at any depth,\n"
+             "a pattern with '/' matches the path relative to the source folder."
+    )
+    parser.add_argument(
+        '--exclude',
+        type=str,
+        action='append',
+        default=[],
+        help='Skip the files and folders matching the pattern, can be repeated.\n'
+             "A pattern ending with '/' matches folders only.\n"
+             'The excluded folders are not walked.'
+    )
+    parser.add_argument(
+        '--min-size',
+        type=int,
+        default=None,
+        help='Select only the files of at least this number of bytes.'
+    )
+    parser.add_argument(
+        '--max-size',
+        type=int,
+        default=None,
+        help='Select only the files of at most this number of bytes.'
+    )
+    parser.add_argument(
+        '--modified-after',
+        type=datetime.datetime.fromisoformat,
+        default=None,
+        help='Select only the files modified at or after the ISO date and time,\n'
+             'such as 2024-01-31 or 2024-01-31T12:00:00.'
+    )
+    parser.add_argument(
+        '--modified-before',
+        type=datetime.datetime.fromisoformat,
+        default=None,
+        help='Select only the files modified before the ISO date and time.'
+    )
+    parser.add_argument(
+        '--walkers',
+        type=int,
+        default=1,
+        help='The number of threads walking the source folder in parallel,\n'
+             'which hides the latency of network filesystems such as NFS.\n'
+             'Default - 1 thread.'
+    )
+    parser.add_argument(
+        '--files-from',
+        type=Path,
+        default=None,
+        help='The path to the list of the source files to use instead of walking\n'
+             f"the source folder, '{STANDARD_STREAM}' - the standard input.\n"
+             'One path per line, relative to the source folder or absolute,\n'
+             'the operation starts while the list is being read.'
+    )
+    parser.add_argument(
+        '--null',
+        action='store_true',
+        help='The paths of --files-from are separated by NUL characters\n'
+             'instead of newlines, as written by find -print0.'
+    )
+    parser.add_argument(
+        '--sizes',
+        action='store_true',
+        help='The entries of --files-from are SIZE<TAB>PATH,\n'
+             "as written by find -printf '%%s\\t%%p\\n'.\n"
+             'The listed sizes are used instead of the stats of the files\n'
+             'unless syncing, resuming or limiting the threads per device.'
+    )
+    parser.add_argument(
+        '--device-threads',
+        type=str,
+        action='append',
+        default=[],
+        metavar='PATH=THREADS',
+        help='The number of threads used for the device mounted at the path.\n'
+             'Can be repeated for several devices.\n'
+             'Each pair of source and destination devices gets its own threads,\n'
+             'the lowest limit of the two devices is used.\n'
+             'Default - --threads threads per pair of devices.\n'
+             'Only the thread executor runs per-device pools.\n'
+             'Example: --device-threads=/mnt/usb=2'
+    )
+
+    parser.add_argument(
+        '--verify',
+        type=str,
+        default=None,
+        choices=hash_algorithms.keys(),
+        help='Verify the copied files with the hash algorithm\n'
+             '(xxhash requires the xxhash package):\n'
+             'the source is hashed while it is copied (by chunks for large files),\n'
+             'then the destination is hashed and compared.\n'
+             'The reflink, copy_file_range and sendfile engines copy the data\n'
+             'inside the kernel, so the source is read again to hash it,\n'
+             'use --copy-engine=buffered to read it once.\n'
+             'The digests are written to the '
+             f'{MANIFEST_NAME_FORMAT.format(algorithm="<algorithm>")} file\n'
+             'of the destination folder, which can be checked later\n'
+             'with sha256sum -c, b2sum -c or xxh128sum -c.'
+    )
+    parser.add_argument(
+        '--dedupe',
+        type=str,
+        default=None,
+        choices=['hardlink', 'reflink'],
+        help='Copy the files with the same data once\n'
+             'and link the destinations of the others to the copy:\n'
+             'hardlink - with hard links sharing the metadata,\n'
+             'reflink - with copy-on-write clones keeping their own metadata.\n'
+             'The files of the same size are compared by hashes.\n'
+             'Files are copied when the links are not supported.'
+    )
+    parser.add_argument(
+        '--log-level',
+        type=str,
+        default='INFO',
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+        help='The lowest level of the logged messages.\n'
+             'Default - INFO: errors and periodic summaries,\n'
+             'DEBUG also logs every successful file.'
+    )
+    parser.add_argument(
+        '--quiet',
+        action='store_true',
+        help='Log only warnings and errors, the same as --log-level=WARNING.'
+    )
+    parser.add_argument(
+        '--report',
+        type=Path,
+        default=None,
+        help='The path to the report file with the result of every file:\n'
+             'success<TAB>path or error<TAB>path<TAB>error per line.'
+    )
+    parser.add_argument(
+        '--progress',
+        action='store_true',
+        help='Refresh a progress line with the files, bytes, throughput\n'
+             'and the estimated time left on the standard error.'
+    )
+    parser.add_argument(
+        '--stats',
+        type=Path,
+        default=None,
+        help='The path to the JSON file refreshed with the throughput,\n'
+             'the busy time of the workers and the latency histograms per file size.'
+    )
+    parser.add_argument(
+        '--prometheus',
+        type=Path,
+        default=None,
+        help='The path to the .prom file refreshed with the same metrics\n'
+             'for the textfile collector of the Prometheus node exporter.'
+    )
+    parser.add_argument(
+        '--profile',
+        type=Path,
+        default=None,
+        help='The path to the JSON file with the wall and CPU time\n'
+             'of each phase of the run and each operation.'
+    )
+    parser.add_argument(
+        '--profiler',
+        type=str,
+        default=None,
+        choices=['sample', 'cprofile', 'tracemalloc'],
+        help='Also profile the run (requires --profile):\n'
+             'sample - sample the stacks of all threads to the <profile>.folded file,\n'
+             'cprofile - profile all threads to the <profile>.pstats file,\n'
+             'tracemalloc - write the allocated bytes per stack\n'
+             'at the peak of the traced memory to the <profile>.folded file\n'
+             '(slows the run down many times).\n'
+             'The .folded files are rendered by flamegraph.pl, inferno or speedscope.'
+    )
+    parser.add_argument(
+        '--max-bandwidth',
+        type=parse_size,
+        default=None,
+        help='The maximum number of bytes per second copied by all workers together,\n'
+             'with an optional K, M, G or T suffix (powers of 1024), such as 50M.\n'
+             'Default - unlimited.'
+    )
+    parser.add_argument(
+        '--max-files-per-sec',
+        type=float,
+        default=None,
+        help='The maximum number of files per second processed by all workers together.\n'
+             'Default - unlimited.'
+    )
+    parser.add_argument(
+        '--throttle-file',
+        type=Path,
+        default=None,
+        help='The path to the file changing the limits during the run,\n'
+             f'checked every {THROTTLE_RELOAD_INTERVAL:g} second. Each line is max-bandwidth=SIZE\n'
+             'or max-files-per-sec=NUMBER, 0 removes the limit.\n'
+             'The limits missing from the file are those of the command line.'
+    )
+    parser.add_argument(
+        '--journal',
+        action='store_true',
+        help='Record the files and the chunks of large files copied to the destination folder\n'
+             f'in its {JOURNAL_NAME} file, so an interrupted copy can be resumed.\n'
+             'The journal is removed once all files have been copied.'
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Resume the interrupted copy to the destination folder:\n'
+             'the files and the chunks of large files copied before\n'
+             f'(recorded in the {JOURNAL_NAME} file of the destination folder)\n'
+             'are not copied again. Implies --journal.'
     )
 
     parsed_args: argparse.Namespace = parser.parse_args(args=args)
 
-    if parsed_args.threads <= 0:
+    if is_archive_path(path=parsed_args.destination) and (parsed_args.operation != 'copy'):
+        parser.error(message='tar archives are written only by the copy operation.')
+
+    if (parsed_args.operation == 'extract') and (not is_archive_path(path=parsed_args.source)):
+        parser.error(message='only tar archives are extracted.')
+
+    if (parsed_args.source.name.endswith('.tar.zst') or parsed_args.destination.name.endswith('.tar.zst')) and \
+       (zstandard is None):
+        parser.error(message='zstd archives require the zstandard package.')
+
+    if parsed_args.threads == AUTO_THREADS:
+        if parsed_args.executor != 'thread':
+            parser.error(message='the number of threads is tuned only by the thread executor.')
+    elif parsed_args.threads <= 0:
         parser.error(message='the minimum number of threads is 1.')
 
+    if (parsed_args.profiler is not None) and (parsed_args.profile is None):
+        parser.error(message='the profiler requires --profile.')
+
+    if parsed_args.chunk_threshold < 0:
+        parser.error(message='the minimum chunk threshold is 0.')
+
+    if parsed_args.chunk_size <= 0:
+        parser.error(message='the minimum chunk size is 1.')
+
+    if parsed_args.processes <= 0:
+        parser.error(message='the minimum number of processes is 1.')
+
+    if ((parsed_args.min_size is not None) and (parsed_args.min_size < 0)) or \
+       ((parsed_args.max_size is not None) and (parsed_args.max_size < 0)):
+        parser.error(message='the minimum file size is 0.')
+
+    if parsed_args.walkers <= 0:
+        parser.error(message='the minimum number of walkers is 1.')
+
+    if ((parsed_args.max_bandwidth is not None) and (parsed_args.max_bandwidth < 0)) or \
+       ((parsed_args.max_files_per_sec is not None) and (parsed_args.max_files_per_sec < 0)):
+        parser.error(message='the minimum limit is 0 (unlimited).')
+
+    if parsed_args.files_from is not None:
+        if parsed_args.operation == 'extract':
+            parser.error(message='the files of tar archives are not listed by --files-from.')
+
+        if parsed_args.include or parsed_args.exclude or any(
+                limit is not None
+                for limit in (
+                    parsed_args.min_size,
+                    parsed_args.max_size,
+                    parsed_args.modified_after,
+                    parsed_args.modified_before
+                )
+        ):
+            parser.error(message='the files listed by --files-from are not filtered.')
+
+        if parsed_args.sizes and is_archive_path(path=parsed_args.destination):
+            parser.error(message='the sizes listed by --sizes are not used by tar archives.')
+    elif parsed_args.null or parsed_args.sizes:
+        parser.error(message='--null and --sizes require --files-from.')
+
+    if parsed_args.small_file_size < 0:
+        parser.error(message='the minimum small file size is 0.')
+
+    device_threads: List[Tuple[Path, int]] = []
+
+    for device_limit in parsed_args.device_threads:
+        path, _, threads = device_limit.rpartition('=')
+
+        if (not path) or (not threads.isdigit()) or (int(threads) <= 0):
+            parser.error(message=f'invalid device threads {device_limit}, expected PATH=THREADS '
+                                 'with the minimum number of threads 1.')
+
+        device_threads.append((Path(path), int(threads)))
+
+    # The process and hybrid executors share one pool for all devices.
+    if device_threads and (parsed_args.executor != 'thread'):
+        parser.error(message='the threads per device are limited only by the thread executor.')
+
+    parsed_args.device_threads = device_threads
+
     return parsed_args
 
 
-def main():
-    args: argparse.Namespace = parse_args(args=sys.argv[1:])
+def get_device_threads(device_threads: List[Tuple[Path, int]]) -> Dict[int, int]:
+    """Returns the number of threads of the devices of the paths."""
+    return {os.stat(path).st_dev: threads for path, threads in device_threads}
+
+
+def create_path_filter(args: argparse.Namespace) -> Optional[PathFilter]:
+    """Returns the filter of the source files of the command line arguments,
+    None if no file is filtered out."""
+    if (not args.include) and (not args.exclude) and all(
+            limit is None
+            for limit in (args.min_size, args.max_size, args.modified_after, args.modified_before)
+    ):
+        return None
+
+    return PathFilter(
+        root=args.source,
+        include=args.include,
+        exclude=args.exclude,
+        min_size=args.min_size,
+        max_size=args.max_size,
+        modified_after=args.modified_after.timestamp() if args.modified_after is not None else None,
+        modified_before=args.modified_before.timestamp() if args.modified_before is not None else None
+    )
+
+
+def perform_operation(args: argparse.Namespace, profiler: Optional[Profiler]) -> None:
+    """Performs the operation of the command line arguments."""
     mask: Optional[str] = None
 
+    try:
+        device_threads: Dict[int, int] = get_device_threads(device_threads=args.device_threads)
+    except OSError as error:
+        logging.error(msg=f'error: {str(error)}')
+
+        return
+
+    threads: int = AUTOTUNE_MAX_THREADS if args.threads == AUTO_THREADS else args.threads
+
+    if args.operation == 'extract':
+        if check_paths_exists(
+                source=args.destination if str(args.source) == STANDARD_STREAM else args.source,
+                destination=args.destination
+        ):
+            logging.info(msg=f'extract {args.source} to {args.destination}\n')
+            extract_archive(source=args.source, destination=args.destination, threads=threads, report=args.report)
+
+        return
+
     args.source, mask = extract_path_and_mask(path=str(args.source.absolute()))
+    path_filter: Optional[PathFilter] = create_path_filter(args=args)
+    file_list: Optional[FileList] = None
 
-    if check_paths_exists(source=args.source, destination=args.destination):
-        if args.source.is_file():
-            args.threads = 1
+    if args.files_from is not None:
+        if mask is not None:
+            logging.error(msg='error: the files listed by --files-from require a source folder without a mask.')
 
-        source_paths: List[Path] = \
-            create_source_paths(
-                source=args.source,
-                mask=mask
+            return
+
+        file_list = FileList(path=args.files_from, source=args.source, null=args.null, with_sizes=args.sizes)
+
+    if is_archive_path(path=args.destination):
+        if check_paths_exists(source=args.source, destination=args.destination.parent):
+            # The destination paths are relative to the archive.
+            source_and_destination_paths: Iterator[Tuple[Path, Path]] = \
+                create_source_and_destination_paths(
+                    source=args.source,
+                    source_paths=file_list if file_list is not None else create_source_paths(
+                        source=args.source,
+                        mask=mask,
+                        walkers=args.walkers,
+                        path_filter=path_filter,
+                        # The empty folders of the whole source folder are kept.
+                        with_folders=(mask is None) and (path_filter is None)
+                    ),
+                    destination=Path(),
+                    create_folders=False
+                )
+
+            logging.info(msg=f'{args.operation} files to {args.destination}\n')
+            write_archive(
+                source_and_destination_paths=source_and_destination_paths,
+                destination=args.destination,
+                threads=threads,
+                report=args.report
             )
 
-        source_and_destination_paths: Dict[Path, Path] = \
-            create_source_and_destination_paths(
+        return
+
+    if check_paths_exists(source=args.source, destination=args.destination):
+        filtered: bool = (path_filter is not None) or (file_list is not None)
+
+        if is_tree_rename(
+                operation_name=args.operation,
                 source=args.source,
-                source_paths=source_paths,
-                destination=args.destination
-            )
+                destination=args.destination,
+                whole_folder=(mask in (None, '**/*')) and not filtered
+        ):
+            # The top-level entries are renamed by run_operation_in_threads,
+            # the files are not enumerated.
+            source_and_destination_paths: Iterator[Tuple[Path, Path]] = iter(())
+        else:
+            source_paths: Iterable[Path] = \
+                file_list if file_list is not None else create_source_paths(
+                    source=args.source,
+                    mask=mask,
+                    walkers=args.walkers,
+                    path_filter=path_filter
+                )
+
+            if profiler is not None:
+                source_paths = profiler.time_iterator(name='enumerate', items=source_paths)
+
+            source_and_destination_paths = \
+                create_source_and_destination_paths(
+                    source=args.source,
+                    source_paths=source_paths,
+                    destination=args.destination
+                )
+
+            if profiler is not None:
+                # Including the creation of the destination folders.
+                source_and_destination_paths = \
+                    profiler.time_iterator(name='destination paths', items=source_and_destination_paths)
 
         logging.info(msg=f'{args.operation} files to {args.destination}\n')
         run_operation_in_threads(
             source=args.source,
             operation_name=args.operation,
             source_and_destination_paths=source_and_destination_paths,
-            threads=args.threads,
-            mask=mask
+            threads=threads,
+            mask=mask,
+            copy_engine=args.copy_engine,
+            chunk_threshold=args.chunk_threshold,
+            chunk_size=args.chunk_size,
+            destination=args.destination,
+            small_file_size=args.small_file_size,
+            executor_name=args.executor,
+            processes=args.processes,
+            device_threads=device_threads,
+            autotune=args.threads == AUTO_THREADS,
+            journaled=args.journal,
+            resume=args.resume,
+            verify=args.verify,
+            dedupe=args.dedupe,
+            report=args.report,
+            progress=args.progress,
+            stats=args.stats,
+            prometheus=args.prometheus,
+            profiler=profiler,
+            filtered=filtered,
+            known_sizes=file_list.sizes if file_list is not None else None,
+            max_bandwidth=args.max_bandwidth,
+            max_files_per_sec=args.max_files_per_sec,
+            throttle_file=args.throttle_file
         )
 
 
+def main():
+    args: argparse.Namespace = parse_args(args=sys.argv[1:])
+    profiler: Optional[Profiler] = \
+        Profiler(path=args.profile, profiler_name=args.profiler) if args.profile is not None else None
+
+    logging.getLogger().setLevel(logging.WARNING if args.quiet else args.log_level)
+
+    with profiler if profiler is not None else contextlib.nullcontext():
+        perform_operation(args=args, profiler=profiler)
+
+
 if __name__ == '__main__':
     setup_logging()
     main()
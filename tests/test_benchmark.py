@@ -0,0 +1,90 @@
+from pathlib import Path
+from typing import (
+    Dict,
+    List,
+    Tuple,
+)
+
+import pytest
+
+from benchmarks import benchmark
+
+
+@pytest.mark.parametrize(
+    'spec, files, size',
+    [
+        (benchmark.TreeSpec(width=2, depth=2, files_per_folder=3, file_size=10), 21, 210),
+        (benchmark.TreeSpec(width=0, depth=0, files_per_folder=2, file_size=0), 2, 2 * 3000000),
+    ]
+)
+def test_generate_tree(tmp_output_dir: Path, spec: benchmark.TreeSpec, files: int, size: int):
+    assert benchmark.generate_tree(path=tmp_output_dir / 'tree', spec=spec, scale=1.0, huge_size=3000000) == \
+           (files, size)
+
+    tree_files: List[Path] = [path for path in (tmp_output_dir / 'tree').glob('**/*') if path.is_file()]
+
+    assert len(tree_files) == files
+    assert sum(path.stat().st_size for path in tree_files) == size
+
+
+def test_run_benchmarks(tmp_output_dir: Path):
+    results: List[Dict[str, object]] = benchmark.run_benchmarks(
+        tree_names=['deep'],
+        roots=[('disk', tmp_output_dir)],
+        operations=['copy', 'move'],
+        engines=['auto'],
+        threads=[2],
+        scale=0.1
+    )
+
+    assert [(result['operation'], result['files'], result['errors']) for result in results] == \
+           [('copy', 33 * 3, 0), ('move', 33 * 3, 0)]
+    assert all(result['peak_rss_kib'] > 0 for result in results)
+    # The moved tree is enumerated at its destination, after the move.
+    assert all(result['enumeration_seconds'] > 0 for result in results)
+    assert list(tmp_output_dir.iterdir()) == []
+
+
+def test_compare_with_baseline():
+    def get_result(threads: int, files_per_second: float, mb_per_second: float) -> Dict[str, object]:
+        return {
+            'tree': 'small',
+            'root': 'disk',
+            'operation': 'copy',
+            'engine': 'auto',
+            'threads': threads,
+            'executor': 'thread',
+            'files_per_second': files_per_second,
+            'mb_per_second': mb_per_second,
+        }
+
+    comparisons: List[Dict[str, object]] = benchmark.compare_with_baseline(
+        results=[get_result(1, 95, 10), get_result(4, 100, 8), get_result(16, 100, 10)],
+        baseline=[get_result(1, 100, 10), get_result(4, 100, 10)],
+        tolerance=0.1
+    )
+
+    assert [(comparison['result']['threads'], comparison['regression']) for comparison in comparisons] == \
+           [(1, False), (4, True)]
+
+
+@pytest.mark.parametrize(
+    'args',
+    [
+        ['--trees=small,tiny'],
+        ['--operations=sync'],
+        ['--engines=mmap'],
+        ['--threads=0'],
+        ['--roots=/dev/shm'],
+    ]
+)
+def test_parse_args_invalid(args: List[str]):
+    with pytest.raises(SystemExit):
+        benchmark.parse_args(args=args)
+
+
+def test_parse_args_roots():
+    roots: List[Tuple[str, Path]] = \
+        benchmark.parse_args(args=['--roots=tmpfs=/dev/shm', '--roots=ssd=/mnt/ssd']).roots
+
+    assert roots == [('tmpfs', Path('/dev/shm')), ('ssd', Path('/mnt/ssd'))]
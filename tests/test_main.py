@@ -1,6 +1,18 @@
 import argparse
+import errno
+import filecmp
+import hashlib
+import io
+import itertools
+import json
+import logging
+import logging.handlers
+import os
 import shutil
-from pathlib import Path
+import tarfile
+import threading
+import time
+from pathlib import Path, PurePosixPath
 from typing import (
     Final,
     Tuple,
@@ -8,6 +20,11 @@ from typing import (
     List,
     Dict,
     Set,
+    Callable,
+    Iterator,
+    Any,
+    IO,
+    Union,
 )
 
 import pytest
@@ -52,11 +69,43 @@ def get_source_and_destination_paths(
         )
 
     source_and_destination_paths: Dict[Path, Path] = \
-        main.create_source_and_destination_paths(
+        dict(main.create_source_and_destination_paths(
             source=source,
             source_paths=source_paths,
             destination=destination
+        ))
+
+    return source_and_destination_paths
+
+
+def run_operation_and_check(
+        source: Path,
+        output_dir: Path,
+        operation_name: str = 'copy',
+        **kwargs
+) -> Dict[Path, Path]:
+    """Performs the operation on all files of the source folder in output_dir
+    with the run_operation_in_threads arguments
+    and checks that the destination files have the data of the source files."""
+    source_and_destination_paths: Dict[Path, Path] = \
+        get_source_and_destination_paths(
+            source=source,
+            mask=None,
+            destination=output_dir
         )
+    files: Dict[Path, bytes] = \
+        {path: path.read_bytes() for path in source_and_destination_paths.keys()}
+
+    main.run_operation_in_threads(
+        source=source,
+        operation_name=operation_name,
+        source_and_destination_paths=source_and_destination_paths.items(),
+        mask=None,
+        **kwargs
+    )
+
+    for source_path, destination_path in source_and_destination_paths.items():
+        assert files[source_path] == destination_path.read_bytes()
 
     return source_and_destination_paths
 
@@ -177,6 +226,56 @@ def test_copy_valid(source: Path, tmp_output_dir: Path):
     assert copied_file_path.exists() and source.exists()
 
 
+@pytest.mark.parametrize(
+    'engine',
+    ['auto', 'reflink', 'copy_file_range', 'sendfile', 'buffered']
+)
+@pytest.mark.parametrize(
+    'source',
+    [
+        (files_test_folder() / '1.json'),
+        (files_test_folder() / '1MiB.bin'),
+        (files_test_folder() / '.hidden'),
+        (subfolder_1 / 'fc3.jpg'),
+    ]
+)
+def test_copy_engines(source: Path, engine: str, tmp_output_dir: Path):
+    main.copy(source=source, destination=tmp_output_dir, engine=engine)
+
+    copied_file_path: Path = tmp_output_dir / source.name
+
+    assert filecmp.cmp(source, copied_file_path, shallow=False)
+    assert source.stat().st_mtime == copied_file_path.stat().st_mtime
+
+
+def test_copy_engine_fallback(tmp_output_dir: Path, monkeypatch: pytest.MonkeyPatch):
+    source: Path = files_test_folder() / '1MiB.bin'
+    engines: List[str] = []
+
+    def unsupported_reflink(source_fd: int, destination_fd: int, size: int) -> None:
+        engines.append('reflink')
+        # A partial copy is discarded by the next engine.
+        os.write(destination_fd, b'partial')
+
+        raise OSError(errno.EOPNOTSUPP, 'reflink not supported')
+
+    def copy_range(source_fd: int, destination_fd: int, size: int) -> None:
+        engines.append('copy_file_range')
+        main.copy_range(source_fd=source_fd, destination_fd=destination_fd, size=size)
+
+    monkeypatch.setitem(main.copy_engines, 'reflink', unsupported_reflink)
+    monkeypatch.setitem(main.copy_engines, 'copy_file_range', copy_range)
+    monkeypatch.setattr(main, 'device_copy_engines', {})
+
+    main.copy(source=source, destination=tmp_output_dir, engine='reflink')
+    main.copy(source=source, destination=tmp_output_dir / 'again.bin', engine='reflink')
+
+    # The unsupported engine falls back once, then the working engine is cached for the devices.
+    assert engines == ['reflink', 'copy_file_range', 'copy_file_range']
+    assert list(main.device_copy_engines.values()) == ['copy_file_range']
+    assert filecmp.cmp(source, tmp_output_dir / source.name, shallow=False)
+
+
 @pytest.mark.parametrize(
     'source, destination, result',
     [
@@ -323,7 +422,220 @@ def test_move_invalid(source: Path, destination: Path, result: Exception):
     ]
 )
 def test_list_files_valid(source: Path, mask: Optional[str], result: int):
-    assert result == len(main.list_files(source=source, mask=mask))
+    assert result == len(list(main.list_files(source=source, mask=mask)))
+
+
+@pytest.mark.parametrize(
+    'source, mask',
+    [
+        (files_test_folder(), '*.md'),
+        (files_test_folder(), '.hidden'),
+        (files_and_subfolders_test_folder(), '**/*'),
+        (files_and_subfolders_test_folder(), '*/*.exe'),
+        (files_and_subfolders_test_folder(), subfolder_1_name + '/*'),
+        (files_folders_tree_test_folder(), '**/*'),
+        (files_folders_tree_test_folder(), '**/*.json'),
+        (files_folders_tree_test_folder(), '*/**/*.txt'),
+        (files_folders_tree_test_folder(), '**/subfolder_1/**/*'),
+        (files_folders_tree_test_folder(), '*/*/another_folder/*'),
+    ]
+)
+@pytest.mark.parametrize('walkers', [1, 4])
+def test_list_files_same_as_glob(source: Path, mask: str, walkers: int):
+    glob_files: Set[Path] = {entry for entry in source.glob(mask) if entry.is_file()}
+    files: List[Path] = list(main.list_files(source=source, mask=mask, walkers=walkers))
+
+    assert len(files) == len(glob_files)
+    assert set(files) == glob_files
+
+
+@pytest.mark.parametrize(
+    'filter_kwargs, selected',
+    [
+        ({'exclude': ['subfolder_1']}, lambda path, size: 'subfolder_1' not in path.parts),
+        ({'exclude': ['*.exe', 'folder_3/']},
+         lambda path, size: (path.suffix != '.exe') and ('folder_3' not in path.parts)),
+        ({'exclude': ['folder_1/subfolder_2/*']}, lambda path, size: path.parts[:2] != ('folder_1', 'subfolder_2')),
+        ({'include': ['*.json', 'folder_1/*.md']},
+         lambda path, size: (path.suffix == '.json') or (path.parts[0] == 'folder_1' and path.suffix == '.md')),
+        ({'include': ['*.json', '.hidden'], 'exclude': ['another_folder']},
+         lambda path, size: (path.name in ('.hidden', 'zzzz.json') or path.suffix == '.json') and
+                            ('another_folder' not in path.parts)),
+        ({'min_size': 1, 'max_size': 1024}, lambda path, size: 1 <= size <= 1024),
+    ]
+)
+@pytest.mark.parametrize('walkers', [1, 3])
+def test_list_files_filtered(filter_kwargs: Dict[str, object], selected: Callable, walkers: int):
+    source: Path = files_folders_tree_test_folder()
+    path_filter = main.PathFilter(root=source, **filter_kwargs)
+    expected: Set[Path] = {
+        path for path in source.glob('**/*')
+        if path.is_file() and selected(PurePosixPath(path.relative_to(source).as_posix()), path.stat().st_size)
+    }
+
+    assert set(main.list_files(source=source, mask=None, walkers=walkers, path_filter=path_filter)) == expected
+
+
+def test_list_files_filtered_prunes_folders(monkeypatch: pytest.MonkeyPatch):
+    scanned_paths: List[str] = []
+    scandir: Callable = main.os.scandir
+
+    def record_scandir(path: str):
+        scanned_paths.append(path)
+
+        return scandir(path)
+
+    monkeypatch.setattr(main.os, 'scandir', record_scandir)
+    source: Path = files_folders_tree_test_folder()
+    path_filter = main.PathFilter(root=source, exclude=['folder_3/', 'subfolder_2'])
+
+    assert len(list(main.list_files(source=source, mask=None, path_filter=path_filter))) > 0
+    assert scanned_paths
+    assert all(('folder_3' not in path) and ('subfolder_2' not in path) for path in scanned_paths)
+
+
+def test_path_filter_modified(tmp_output_dir: Path):
+    old_path: Path = tmp_output_dir / 'old.txt'
+    new_path: Path = tmp_output_dir / 'new.txt'
+    old_path.write_bytes(b'old')
+    new_path.write_bytes(b'new')
+    os.utime(old_path, (1000000000, 1000000000))
+
+    assert list(main.list_files(
+        source=tmp_output_dir,
+        mask=None,
+        path_filter=main.PathFilter(root=tmp_output_dir, modified_after=1500000000.0)
+    )) == [new_path]
+    assert list(main.create_source_paths(
+        source=old_path,
+        mask=None,
+        path_filter=main.PathFilter(root=old_path, modified_before=1500000000.0)
+    )) == [old_path]
+    assert list(main.create_source_paths(
+        source=new_path,
+        mask=None,
+        path_filter=main.PathFilter(root=new_path, modified_before=1500000000.0)
+    )) == []
+
+
+@pytest.mark.parametrize(
+    'tmp_input_dir',
+    [files_folders_tree_test_folder()],
+    indirect=['tmp_input_dir']
+)
+def test_run_operation_in_threads_move_filtered(tmp_input_dir: Path, tmp_output_dir: Path):
+    path_filter = main.PathFilter(root=tmp_input_dir, exclude=['*.json'])
+    source_and_destination_paths: Dict[Path, Path] = dict(main.create_source_and_destination_paths(
+        source=tmp_input_dir,
+        source_paths=main.create_source_paths(source=tmp_input_dir, mask=None, path_filter=path_filter),
+        destination=tmp_output_dir
+    ))
+
+    main.setup_logging()
+    main.run_operation_in_threads(
+        source=tmp_input_dir,
+        operation_name='move',
+        source_and_destination_paths=source_and_destination_paths.items(),
+        threads=2,
+        mask=None,
+        destination=tmp_output_dir,
+        filtered=True
+    )
+
+    # The excluded files are neither moved nor removed with the source folder.
+    assert sorted(path.name for path in tmp_input_dir.glob('**/*') if path.is_file()) == \
+           sorted(path.name for path in files_folders_tree_test_folder().glob('**/*.json'))
+    assert all(destination_path.is_file() for destination_path in source_and_destination_paths.values())
+
+
+@pytest.mark.parametrize(
+    'null, with_sizes',
+    [(False, False), (True, False), (False, True)]
+)
+def test_file_list(tmp_output_dir: Path, null: bool, with_sizes: bool):
+    source: Path = tmp_output_dir / 'source'
+    separator: bytes = b'\0' if null else b'\n'
+    entries: List[bytes] = [b'a.txt', b'folder/b.txt', str(source / 'c.txt').encode(), b'../outside.txt']
+
+    if with_sizes:
+        entries = [b'%d\t%s' % (size, entry) for size, entry in enumerate(entries)] + [b'invalid']
+
+    list_path: Path = tmp_output_dir / 'list'
+    list_path.write_bytes(separator.join(entries) + separator + separator)
+    file_list = main.FileList(path=list_path, source=source, null=null, with_sizes=with_sizes)
+
+    assert list(file_list) == [source / 'a.txt', source / 'folder' / 'b.txt', source / 'c.txt']
+    assert file_list.error_count == (2 if with_sizes else 1)
+    assert file_list.sizes == (
+        {source / 'a.txt': 0, source / 'folder' / 'b.txt': 1, source / 'c.txt': 2} if with_sizes else {}
+    )
+
+
+@pytest.mark.parametrize(
+    'tmp_input_dir',
+    [files_folders_tree_test_folder()],
+    indirect=['tmp_input_dir']
+)
+def test_run_operation_in_threads_file_list(tmp_input_dir: Path, tmp_output_dir: Path):
+    source_paths: List[Path] = sorted(path for path in tmp_input_dir.glob('**/*.md') if path.is_file())
+    list_path: Path = tmp_output_dir.parent / f'{tmp_output_dir.name}.list'
+    list_path.write_text(''.join(
+        f'{path.stat().st_size}\t{path.relative_to(tmp_input_dir)}\n' for path in source_paths
+    ))
+    file_list = main.FileList(path=list_path, source=tmp_input_dir, with_sizes=True)
+
+    try:
+        main.setup_logging()
+        main.run_operation_in_threads(
+            source=tmp_input_dir,
+            operation_name='move',
+            source_and_destination_paths=main.create_source_and_destination_paths(
+                source=tmp_input_dir,
+                source_paths=file_list,
+                destination=tmp_output_dir
+            ),
+            threads=2,
+            mask=None,
+            destination=tmp_output_dir,
+            filtered=True,
+            known_sizes=file_list.sizes
+        )
+    finally:
+        list_path.unlink()
+
+    # Only the listed files are moved, the sizes are used as the files are scheduled.
+    assert sorted(path for path in tmp_output_dir.glob('**/*') if path.is_file()) == \
+           sorted(tmp_output_dir / path.relative_to(tmp_input_dir) for path in source_paths)
+    assert not any(path.is_file() for path in tmp_input_dir.glob('**/*.md'))
+    assert any(path.is_file() for path in tmp_input_dir.glob('**/*'))
+    assert file_list.sizes == {}
+
+
+def test_list_files_parallel_stops_early():
+    files: Iterator[Path] = main.list_files(source=files_folders_tree_test_folder(), mask=None, walkers=4)
+    next(files)
+    files.close()
+
+    for thread in threading.enumerate():
+        if thread.name.startswith('walker-'):
+            thread.join(timeout=5)
+
+            assert not thread.is_alive()
+
+
+def test_list_files_parallel_error(monkeypatch: pytest.MonkeyPatch):
+    scan_directory: Callable = main.scan_directory
+
+    def fail_in_subfolder(path: str, index: int, matchers: List[main.ComponentMatcher], **kwargs):
+        if path != str(files_folders_tree_test_folder()):
+            raise OSError('failed')
+
+        return scan_directory(path=path, index=index, matchers=matchers, **kwargs)
+
+    monkeypatch.setattr(main, 'scan_directory', fail_in_subfolder)
+
+    with pytest.raises(OSError):
+        list(main.list_files(source=files_folders_tree_test_folder(), mask=None, walkers=3))
 
 
 @pytest.mark.parametrize(
@@ -354,7 +666,7 @@ def test_list_files_invalid(source: Path, mask: Optional[str], result: Exception
     ]
 )
 def test_create_source_paths_valid(source: Path, mask: Optional[str], result: List[Path]):
-    assert result == len(main.create_source_paths(source=source, mask=mask))
+    assert result == len(list(main.create_source_paths(source=source, mask=mask)))
 
 
 @pytest.mark.parametrize(
@@ -417,6 +729,71 @@ def test_create_source_and_destination_paths(
     assert result == source_and_destination_paths
 
 
+def test_folder_creator(tmp_output_dir: Path, monkeypatch: pytest.MonkeyPatch):
+    created_folders: List[Path] = []
+    mkdir: Callable = main.os.mkdir
+
+    def record_mkdir(path: Path) -> None:
+        created_folders.append(path)
+        mkdir(path)
+
+    monkeypatch.setattr(main.os, 'mkdir', record_mkdir)
+    (tmp_output_dir / 'file').write_bytes(b'')
+    creator = main.FolderCreator(destination=tmp_output_dir, threads=4)
+
+    try:
+        futures: List[main.Future] = [
+            creator.create(folder=tmp_output_dir / 'a' / 'b' / 'c'),
+            creator.create(folder=tmp_output_dir / 'a' / 'd'),
+            creator.create(folder=tmp_output_dir / 'a' / 'b' / 'c'),
+            creator.create(folder=tmp_output_dir),
+            creator.create(folder=tmp_output_dir / 'file' / 'e'),
+        ]
+
+        assert futures[0] is futures[2]
+
+        for future in futures[:4]:
+            future.result(timeout=5)
+
+        with pytest.raises(OSError):
+            futures[4].result(timeout=5)
+    finally:
+        creator.close()
+
+    assert (tmp_output_dir / 'a' / 'b' / 'c').is_dir() and (tmp_output_dir / 'a' / 'd').is_dir()
+    # Each folder is created once, after its parent.
+    assert sorted(created_folders) == [
+        tmp_output_dir / 'a',
+        tmp_output_dir / 'a' / 'b',
+        tmp_output_dir / 'a' / 'b' / 'c',
+        tmp_output_dir / 'a' / 'd',
+        tmp_output_dir / 'file',
+    ]
+    assert created_folders.index(tmp_output_dir / 'a') < created_folders.index(tmp_output_dir / 'a' / 'b') < \
+           created_folders.index(tmp_output_dir / 'a' / 'b' / 'c')
+
+
+@pytest.mark.parametrize(
+    'items, maxsize',
+    [
+        ([], 1),
+        (list(range(10)), 1),
+        (list(range(1000)), 16),
+    ]
+)
+def test_iterate_in_background_valid(items: List[int], maxsize: int):
+    assert items == list(main.iterate_in_background(items=iter(items), maxsize=maxsize))
+
+
+def test_iterate_in_background_invalid():
+    def items():
+        yield 1
+        raise OSError('enumeration failed')
+
+    with pytest.raises(OSError):
+        list(main.iterate_in_background(items=items(), maxsize=1))
+
+
 @pytest.mark.parametrize(
     'tmp_input_dir, mask, threads',
     [
@@ -493,7 +870,7 @@ def test_run_operation_in_threads(
     main.run_operation_in_threads(
         source=tmp_input_dir,
         operation_name=get_operation,
-        source_and_destination_paths=source_and_destination_paths,
+        source_and_destination_paths=source_and_destination_paths.items(),
         threads=threads,
         mask=mask
     )
@@ -511,69 +888,1892 @@ def test_run_operation_in_threads(
 
 
 @pytest.mark.parametrize(
-    'args, result',
+    'tmp_input_dir, existing_folders, threads',
     [
-        (['--operation=copy',
-          '--from=/home/user/projects/',
-          '--to=/root/',
-          '--threads=5'],
-         argparse.Namespace(
-             operation='copy',
-             source=Path('/home/user/projects/'),
-             destination=Path('/root/'),
-             threads=5)
-         ),
-        (['--operation=move',
-          '--from=/home/user/projects/*.md',
-          '--to=/root/some_folder'],
-         argparse.Namespace(
-             operation='move',
-             source=Path('/home/user/projects/*.md'),
-             destination=Path('/root/some_folder'),
-             threads=1)
-         ),
-        (['--operation=move',
-          '--from=sadsd',
-          '--to=123'],
-         argparse.Namespace(
-             operation='move',
-             source=Path('sadsd'),
-             destination=Path('123'),
-             threads=1)
-         ),
+        (files_test_folder(), [], 3),
+        (files_and_subfolders_test_folder(), [], 1),
+        (files_and_subfolders_test_folder(), [Path(subfolder_1_name)], 2),
+        (files_folders_tree_test_folder(), [], 4),
+        (files_folders_tree_test_folder(),
+         [Path('folder_1') / 'subfolder_2', Path('folder_3')],
+         4),
+    ],
+    indirect=['tmp_input_dir']
+)
+def test_run_operation_in_threads_rename(
+        tmp_input_dir: Path,
+        existing_folders: List[Path],
+        tmp_output_dir: Path,
+        threads: int
+):
+    relative_paths: Set[Path] = \
+        {path.relative_to(tmp_input_dir) for path in tmp_input_dir.glob('**/*')}
+
+    for folder in existing_folders:
+        (tmp_output_dir / folder).mkdir(parents=True)
+
+    main.setup_logging()
+    main.run_operation_in_threads(
+        source=tmp_input_dir,
+        operation_name='move',
+        source_and_destination_paths=[],
+        threads=threads,
+        mask=None,
+        destination=tmp_output_dir
+    )
+
+    assert not tmp_input_dir.exists()
+    assert relative_paths == \
+        {path.relative_to(tmp_output_dir) for path in tmp_output_dir.glob('**/*')}
+
+
+@pytest.mark.parametrize(
+    'tmp_input_dir',
+    [files_folders_tree_test_folder()],
+    indirect=['tmp_input_dir']
+)
+def test_perform_operation_rename_results(
+        tmp_input_dir: Path,
+        tmp_output_dir: Path,
+        monkeypatch: pytest.MonkeyPatch,
+        caplog: pytest.LogCaptureFixture
+):
+    entries: Set[Path] = set(tmp_input_dir.iterdir())
+    report: Path = tmp_output_dir.parent / f'{tmp_output_dir.name}.tsv'
+
+    # The files are not enumerated when whole subtrees are renamed.
+    monkeypatch.setattr(main, 'create_source_paths', None)
+    caplog.set_level(logging.INFO)
+
+    try:
+        main.perform_operation(
+            args=main.parse_args(args=[
+                '--operation=move',
+                f'--from={tmp_input_dir}',
+                f'--to={tmp_output_dir}',
+                '--threads=4',
+                f'--report={report}'
+            ]),
+            profiler=None
+        )
+        report_lines: List[str] = report.read_text().splitlines()
+    finally:
+        report.unlink(missing_ok=True)
+
+    # The renamed top-level entries are counted and reported, their subtrees are not walked.
+    assert f'Success {len(entries)} files' in caplog.text
+    assert sorted(report_lines) == sorted(f'success\t{path}' for path in entries)
+    assert not tmp_input_dir.exists()
+
+
+@pytest.mark.parametrize(
+    'tmp_input_dir, existing_folders',
+    [
+        (files_folders_tree_test_folder(), []),
+        (files_folders_tree_test_folder(), [Path('folder_1')]),
+    ],
+    indirect=['tmp_input_dir']
+)
+def test_run_operation_in_threads_rename_no_walk(
+        tmp_input_dir: Path,
+        existing_folders: List[Path],
+        tmp_output_dir: Path,
+        monkeypatch: pytest.MonkeyPatch
+):
+    for folder in existing_folders:
+        (tmp_output_dir / folder).mkdir(parents=True)
+
+    scanned_folders: List[Path] = []
+    scandir: Callable = os.scandir
+
+    def record_scandir(path: Union[Path, int]) -> Iterator[os.DirEntry]:
+        # The folders removed by shutil.rmtree are scanned by their descriptors.
+        if not isinstance(path, int):
+            scanned_folders.append(Path(path))
+
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', record_scandir)
+    main.run_operation_in_threads(
+        source=tmp_input_dir,
+        operation_name='move',
+        source_and_destination_paths=[],
+        threads=2,
+        mask=None,
+        destination=tmp_output_dir
+    )
+
+    # The renamed subtrees are not walked.
+    assert not tmp_input_dir.exists()
+    assert not [folder for folder in scanned_folders if tmp_output_dir in (folder, *folder.parents)]
+
+
+@pytest.mark.parametrize(
+    'tmp_input_dir, mask, threads',
+    [
+        (files_test_folder(), None, 3),
+        (files_and_subfolders_test_folder(), None, 2),
+        (files_and_subfolders_test_folder(), '*/*.exe', 2),
+        (files_folders_tree_test_folder(), None, 4),
+        (files_folders_tree_test_folder(), '*/*.json', 4),
+    ],
+    indirect=['tmp_input_dir']
+)
+def test_run_operation_in_threads_cross_device_move(
+        tmp_input_dir: Path,
+        mask: Optional[str],
+        tmp_output_dir: Path,
+        threads: int,
+        monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(main, 'is_same_device', lambda source, destination: False)
+
+    source_and_destination_paths: Dict[Path, Path] = \
+        get_source_and_destination_paths(
+            source=tmp_input_dir,
+            mask=mask,
+            destination=tmp_output_dir
+        )
+    elements_must_be_in_input_dir: int = \
+        get_elements_must_be_in_input_dir(
+            operation_name='move',
+            source=tmp_input_dir,
+            mask=mask,
+            source_and_destination_paths=source_and_destination_paths
+        )
+
+    main.setup_logging()
+    main.run_operation_in_threads(
+        source=tmp_input_dir,
+        operation_name='move',
+        source_and_destination_paths=source_and_destination_paths.items(),
+        threads=threads,
+        mask=mask,
+        destination=tmp_output_dir
+    )
+
+    assert get_number_of_all_elements_in_dir(source=tmp_input_dir) == \
+        elements_must_be_in_input_dir
+    assert all(path.is_file() for path in source_and_destination_paths.values())
+
+
+def test_source_remover(tmp_output_dir: Path):
+    files: List[Path] = [
+        tmp_output_dir / 'folder_1' / 'subfolder_1' / '1.txt',
+        tmp_output_dir / 'folder_1' / '2.txt',
+        tmp_output_dir / 'folder_2' / '3.txt',
+        tmp_output_dir / 'folder_2' / '4.txt',
     ]
+
+    for file in files:
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.touch()
+
+    remover: main.SourceRemover = \
+        main.SourceRemover(root=tmp_output_dir, remove_folders=True, batch_size=2)
+
+    for file in files[:3]:
+        remover.add(path=file)
+
+    remover.add(path=tmp_output_dir / 'not_exists')
+
+    errors = remover.close()
+
+    assert [path for path, _ in errors] == [tmp_output_dir / 'not_exists']
+    assert set(tmp_output_dir.glob('**/*')) == {files[3].parent, files[3]}
+
+
+@pytest.mark.parametrize(
+    'tmp_input_dir, small_file_size, threads',
+    [
+        (files_test_folder(), 0, 3),
+        (files_test_folder(), 2 ** 30, 1),
+        (files_test_folder(), 2 ** 30, 4),
+        (files_folders_tree_test_folder(), 4096, 2),
+        (files_folders_tree_test_folder(), 2 ** 30, 8),
+    ],
+    indirect=['tmp_input_dir']
 )
-def test_parse_args_valid(args: List[str], result: argparse.Namespace):
-    parsed_args: argparse.Namespace = main.parse_args(args=args)
-    assert result == parsed_args
+def test_run_operation_in_threads_small_files(
+        tmp_input_dir: Path,
+        tmp_output_dir: Path,
+        get_operation: str,
+        small_file_size: int,
+        threads: int,
+        monkeypatch: pytest.MonkeyPatch
+):
+    batches: List[List[Tuple[Path, Path]]] = []
+    run_batch: Callable = main.run_batch
+
+    def record_batch(source_and_destination_paths: List[Tuple[Path, Path]], **kwargs) -> List[object]:
+        batches.append(source_and_destination_paths)
+
+        return run_batch(source_and_destination_paths=source_and_destination_paths, **kwargs)
+
+    monkeypatch.setattr(main, 'run_batch', record_batch)
+    sizes: Dict[Path, int] = {path: path.stat().st_size for path in tmp_input_dir.glob('**/*') if path.is_file()}
+
+    run_operation_and_check(
+        source=tmp_input_dir,
+        output_dir=tmp_output_dir,
+        operation_name=get_operation,
+        threads=threads,
+        small_file_size=small_file_size
+    )
+
+    # Only the files smaller than small_file_size are batched, each file once.
+    # The sizes of the moved files are not collected, so they are all small.
+    batched_files: List[Path] = [source_path for batch in batches for source_path, _ in batch]
+
+    assert len(batched_files) == len(set(batched_files))
+    assert all(
+        (get_operation == 'move') or (sizes[source_path] < small_file_size)
+        for source_path in batched_files
+    )
+    assert all(1 < len(batch) <= main.SMALL_FILE_BATCH_SIZE for batch in batches)
 
 
 @pytest.mark.parametrize(
-    'args, result',
+    'tmp_input_dir, executor_name, threads, processes, chunk_threshold',
     [
-        (['--operation=not_exist',
-          '--from=/home/user/projects/',
-          '--to=/root/',
-          '--threads=5'],
-         SystemExit
-         ),
-        (['--operation=copy',
-          '--from=/home/user/projects/',
-          '--to=/root/some_folder',
-          '--threads=not_int'],
-         SystemExit
-         ),
-        (['--from=/home/user/projects/',
-          '--to=/root/some_folder'],
-         SystemExit
-         ),
-        (['--operation=copy',
-          '--to=/root/some_folder'],
-         SystemExit
-         ),
-        (['--operation=copy',
-          '--from=/home/user/projects/'],
-         SystemExit
+        (files_test_folder(), 'process', 1, 2, main.DEFAULT_CHUNK_THRESHOLD),
+        (files_test_folder(), 'process', 1, 3, 1000),
+        (files_folders_tree_test_folder(), 'hybrid', 2, 2, main.DEFAULT_CHUNK_THRESHOLD),
+        (files_folders_tree_test_folder(), 'hybrid', 3, 2, 1000),
+    ],
+    indirect=['tmp_input_dir']
+)
+def test_run_operation_in_threads_executors(
+        tmp_input_dir: Path,
+        tmp_output_dir: Path,
+        get_operation: str,
+        executor_name: str,
+        threads: int,
+        processes: int,
+        chunk_threshold: int
+):
+    stats_path: Path = tmp_output_dir.parent / f'{tmp_output_dir.name}.json'
+
+    try:
+        run_operation_and_check(
+            source=tmp_input_dir,
+            output_dir=tmp_output_dir,
+            operation_name=get_operation,
+            threads=threads,
+            chunk_threshold=chunk_threshold,
+            chunk_size=4096,
+            executor_name=executor_name,
+            processes=processes,
+            stats=stats_path
+        )
+        workers: List[str] = list(json.loads(stats_path.read_text())['worker_busy_seconds'].keys())
+    finally:
+        stats_path.unlink(missing_ok=True)
+
+    # The operations are run by the worker processes, each running its own threads.
+    worker_processes: Set[str] = {worker.split('/')[0] for worker in workers}
+
+    assert str(os.getpid()) not in worker_processes
+    assert len(worker_processes) <= processes
+    assert len(workers) <= processes * threads
+
+
+@pytest.mark.parametrize(
+    'tmp_input_dir, threads, device_threads',
+    [
+        (files_test_folder(), 4, {}),
+        (files_folders_tree_test_folder(), 4, {'source': 1}),
+        (files_folders_tree_test_folder(), 1, {'source': 3, 'destination': 2}),
+    ],
+    indirect=['tmp_input_dir']
+)
+def test_run_operation_in_threads_device_pools(
+        tmp_input_dir: Path,
+        tmp_output_dir: Path,
+        get_operation: str,
+        threads: int,
+        device_threads: Dict[str, int],
+        monkeypatch: pytest.MonkeyPatch
+):
+    paths: Dict[str, Path] = {'source': tmp_input_dir, 'destination': tmp_output_dir}
+    limits: Dict[int, int] = {paths[name].stat().st_dev: limit for name, limit in device_threads.items()}
+    lock: threading.Lock = threading.Lock()
+    running: List[int] = [0, 0]
+    operation: Callable = main.operations[get_operation]
+
+    def record_concurrency(**kwargs) -> None:
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+
+        try:
+            # Keep the operation running long enough to overlap with the others.
+            time.sleep(0.005)
+            operation(**kwargs)
+        finally:
+            with lock:
+                running[0] -= 1
+
+    monkeypatch.setitem(main.operations, get_operation, record_concurrency)
+
+    run_operation_and_check(
+        source=tmp_input_dir,
+        output_dir=tmp_output_dir,
+        operation_name=get_operation,
+        threads=threads,
+        small_file_size=0,
+        device_threads=limits
+    )
+
+    # The source and destination share a device, so its pool runs at most its limit at once.
+    assert 1 <= running[1] <= limits.get(tmp_output_dir.stat().st_dev, threads)
+
+
+@pytest.mark.parametrize(
+    'rate, threads',
+    [
+        # The disk starts thrashing with more than 3 threads.
+        (lambda threads: 100 - 10 * max(threads - 3, 0), 3),
+        # The other load of the device goes away, more threads pay off.
+        (lambda threads: 200 - (threads - 12) ** 2, 12),
+    ]
+)
+def test_thread_tuner_adapts(monkeypatch: pytest.MonkeyPatch, rate: Callable[[int], int], threads: int):
+    clock = itertools.count()
+    monkeypatch.setattr(main.time, 'monotonic', lambda: next(clock))
+
+    tuner = main.ThreadTuner(max_threads=64, window=1.0, tolerance=0.0)
+
+    while not tuner.settled:
+        tuner.add(files=100 - (tuner.threads - 6) ** 2, size=0)
+
+    assert tuner.threads == 6
+
+    # The settled number of threads keeps being measured.
+    changed: bool = tuner.add(files=rate(tuner.threads), size=0)
+
+    assert changed == (threads < 6)
+    assert not tuner.settled
+
+    for _ in range(100):
+        if tuner.settled:
+            break
+
+        tuner.add(files=rate(tuner.threads), size=0)
+
+    assert tuner.settled
+    assert tuner.threads == threads
+
+
+def test_operation_runner_device_pools_backlog():
+    released: threading.Event = threading.Event()
+    timed_out: threading.Event = threading.Event()
+
+    def operation(source: Path, destination: Path, engine: str) -> None:
+        if not released.wait(timeout=5):
+            timed_out.set()
+
+    runner = main.OperationRunner(
+        operation=operation,
+        copy_engine='auto',
+        threads=2,
+        processes=1,
+        executor_name='thread',
+        chunking=False,
+        chunk_threshold=0,
+        chunk_size=1,
+        small_file_size=0,
+        device_threads={},
+        remover=None
+    )
+    # Each pool is left with one free slot in its backlog while its operations are held up.
+    files_per_pool: int = runner.get_max_in_flight(threads=2) + runner.get_max_backlog(threads=2) - 1
+
+    for devices in ((1, 1), (2, 2)):
+        for index in range(files_per_pool):
+            runner.submit_file(file=main.SourceFile(Path(str(index)), Path('out'), 0, devices))
+
+    # The submissions to one device do not wait for the backlog of the other one.
+    assert not timed_out.is_set()
+    assert [len(pool.backlog) for pool in runner.pools.values()] == [runner.get_max_backlog(threads=2) - 1] * 2
+
+    released.set()
+    runner.run(files=[])
+
+    assert (runner.results.success_count, runner.results.error_count) == (files_per_pool * 2, 0)
+
+
+@pytest.mark.parametrize(
+    'max_threads, tolerance, rate, threads',
+    [
+        (64, 0.0, lambda threads: 100 - (threads - 6) ** 2, 6),
+        (64, 0.05, lambda threads: 100 - (threads - 6) ** 2, 4),
+        (64, 0.05, lambda threads: min(threads, 8), 8),
+        (5, 0.05, lambda threads: threads, 5),
+        (1, 0.05, lambda threads: threads, 1),
+    ]
+)
+def test_thread_tuner(
+        monkeypatch: pytest.MonkeyPatch,
+        max_threads: int,
+        tolerance: float,
+        rate: Callable[[int], int],
+        threads: int
+):
+    # Every window lasts 1 second.
+    clock = itertools.count()
+    monkeypatch.setattr(main.time, 'monotonic', lambda: next(clock))
+
+    tuner = main.ThreadTuner(max_threads=max_threads, window=1.0, tolerance=tolerance)
+
+    for _ in range(100):
+        if tuner.settled:
+            break
+
+        tuner.add(files=rate(tuner.threads), size=0)
+
+    assert tuner.settled
+    assert tuner.threads == threads
+
+
+@pytest.mark.parametrize(
+    'value, size',
+    [('0', 0), ('1024', 1024), ('50M', 50 * 2 ** 20), ('1.5k', 1536), ('2GiB', 2 * 2 ** 30)]
+)
+def test_parse_size(value: str, size: int):
+    assert main.parse_size(value=value) == size
+
+
+def test_token_bucket():
+    bucket = main.TokenBucket(rate=10.0)
+    bucket.updated = 0.0
+
+    assert bucket.get_delay(now=0.0) == 0.0
+
+    # A take larger than the burst goes into debt.
+    bucket.take(tokens=30)
+
+    assert bucket.get_delay(now=0.0) == pytest.approx(2.0)
+    assert bucket.get_delay(now=1.5) == pytest.approx(0.5)
+    assert bucket.get_delay(now=2.0) == 0.0
+
+    bucket.set_rate(rate=None, now=2.0)
+    bucket.take(tokens=1000)
+
+    assert bucket.get_delay(now=2.0) == 0.0
+
+
+def test_throttle_file(monkeypatch: pytest.MonkeyPatch, tmp_output_dir: Path):
+    clock = itertools.count(step=main.THROTTLE_RELOAD_INTERVAL)
+    monkeypatch.setattr(main.time, 'monotonic', lambda: next(clock))
+    path: Path = tmp_output_dir / 'limits'
+    throttle = main.Throttle(max_files_per_sec=100.0, path=path)
+
+    throttle.get_delay()
+
+    assert throttle.limits == {'max-bandwidth': None, 'max-files-per-sec': 100.0}
+
+    path.write_text('# business hours\nmax-bandwidth=10M\nmax-files-per-sec=0\n')
+    throttle.get_delay()
+
+    assert throttle.limits == {'max-bandwidth': 10 * 2 ** 20, 'max-files-per-sec': None}
+    assert (throttle.bytes.rate, throttle.files.rate) == (10 * 2 ** 20, None)
+
+    # An invalid file does not change the limits.
+    path.write_text('max-bandwidth=fast\n')
+    os.utime(path, ns=(0, 0))
+    throttle.get_delay()
+
+    assert throttle.limits == {'max-bandwidth': 10 * 2 ** 20, 'max-files-per-sec': None}
+
+    # The limits of the command line are restored without the file.
+    path.unlink()
+    throttle.get_delay()
+
+    assert throttle.limits == {'max-bandwidth': None, 'max-files-per-sec': 100.0}
+
+
+def test_token_bucket_acquire(monkeypatch: pytest.MonkeyPatch):
+    clock: List[float] = [0.0]
+    monkeypatch.setattr(main.time, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(main.time, 'sleep', lambda seconds: clock.__setitem__(0, clock[0] + seconds))
+    # The steps of the clock are exact.
+    monkeypatch.setattr(main, 'THROTTLE_WAIT_STEP', 0.5)
+    bucket = main.TokenBucket(rate=10.0)
+
+    # The burst is taken at once, the next take waits for the debt to be paid back.
+    bucket.acquire(tokens=30)
+
+    assert clock[0] == 0.0
+
+    bucket.acquire(tokens=5)
+
+    assert clock[0] == pytest.approx(2.0)
+    assert bucket.tokens == pytest.approx(-5.0)
+
+
+def test_token_bucket_shared():
+    bucket = main.TokenBucket(rate=1.0, shared=True)
+    process = main.get_process_context().Process(target=bucket.acquire, kwargs={'tokens': 1000})
+    process.start()
+    process.join()
+
+    # The tokens taken by the worker process are missing from the bucket of the main process.
+    assert process.exitcode == 0
+    assert bucket.get_delay(now=main.time.monotonic()) > 900
+
+
+@pytest.mark.parametrize(
+    'tmp_input_dir, executor_name',
+    [
+        (files_test_folder(), 'thread'),
+        (files_test_folder(), 'hybrid'),
+    ],
+    indirect=['tmp_input_dir']
+)
+def test_run_operation_in_threads_throttled(
+        tmp_input_dir: Path,
+        tmp_output_dir: Path,
+        monkeypatch: pytest.MonkeyPatch,
+        executor_name: str
+):
+    acquired: List[float] = []
+    taken_files: List[int] = []
+    acquire: Callable = main.TokenBucket.acquire
+    take: Callable = main.Throttle.take
+
+    def record_acquire(bucket: main.TokenBucket, tokens: float) -> None:
+        acquired.append(tokens)
+        acquire(bucket, tokens=tokens)
+
+    def record_take(throttle: main.Throttle, files: int) -> None:
+        taken_files.append(files)
+        take(throttle, files=files)
+
+    monkeypatch.setattr(main.TokenBucket, 'acquire', record_acquire)
+    monkeypatch.setattr(main.Throttle, 'take', record_take)
+
+    source_and_destination_paths: Dict[Path, Path] = run_operation_and_check(
+        source=tmp_input_dir,
+        output_dir=tmp_output_dir,
+        threads=4,
+        destination=tmp_output_dir,
+        executor_name=executor_name,
+        processes=2,
+        copy_engine='sendfile',
+        chunk_threshold=2 ** 18,
+        chunk_size=2 ** 16,
+        small_file_size=0,
+        max_bandwidth=2 ** 40,
+        max_files_per_sec=10.0 ** 6
+    )
+
+    assert main.worker_bandwidth is None
+
+    # The worker processes take the bytes from the shared bucket.
+    if executor_name != 'thread':
+        return
+
+    # The bytes are taken by the copies as they go, the chunked files are counted once.
+    assert sum(acquired) == sum(path.stat().st_size for path in source_and_destination_paths.keys())
+    assert max(acquired) <= main.THROTTLED_COPY_SIZE
+    assert sum(taken_files) == len(source_and_destination_paths)
+
+
+@pytest.mark.parametrize(
+    'tmp_input_dir',
+    [
+        files_test_folder(),
+        files_folders_tree_test_folder(),
+    ],
+    indirect=['tmp_input_dir']
+)
+def test_run_operation_in_threads_autotune(
+        tmp_input_dir: Path,
+        tmp_output_dir: Path,
+        get_operation: str,
+        caplog: pytest.LogCaptureFixture
+):
+    caplog.set_level(logging.INFO)
+
+    run_operation_and_check(
+        source=tmp_input_dir,
+        output_dir=tmp_output_dir,
+        operation_name=get_operation,
+        threads=main.AUTOTUNE_MAX_THREADS,
+        autotune=True
+    )
+
+    # The tuned number of threads is logged even if the run ends before settling.
+    assert 'Autotuned threads' in caplog.text
+
+
+@pytest.mark.parametrize(
+    'tmp_input_dir',
+    [
+        files_test_folder(),
+        files_folders_tree_test_folder(),
+    ],
+    indirect=['tmp_input_dir']
+)
+def test_run_operation_in_threads_sync(tmp_input_dir: Path, tmp_output_dir: Path):
+    def sync() -> Dict[Path, Path]:
+        source_and_destination_paths: Dict[Path, Path] = \
+            get_source_and_destination_paths(
+                source=tmp_input_dir,
+                mask=None,
+                destination=tmp_output_dir
+            )
+
+        main.run_operation_in_threads(
+            source=tmp_input_dir,
+            operation_name='sync',
+            source_and_destination_paths=source_and_destination_paths.items(),
+            threads=2,
+            mask=None,
+            destination=tmp_output_dir
+        )
+
+        return source_and_destination_paths
+
+    main.setup_logging()
+    source_and_destination_paths: Dict[Path, Path] = sync()
+    changed_path, unchanged_path = sorted(source_and_destination_paths.keys())[:2]
+
+    assert (tmp_output_dir / main.SYNC_INDEX_NAME).exists()
+
+    # Unchanged files are skipped without reading the destination.
+    source_and_destination_paths[unchanged_path].write_bytes(b'not synced')
+    changed_path.write_bytes(b'changed')
+    sync()
+
+    assert source_and_destination_paths[unchanged_path].read_bytes() == b'not synced'
+
+    for source_path, destination_path in source_and_destination_paths.items():
+        if source_path != unchanged_path:
+            assert source_path.read_bytes() == destination_path.read_bytes()
+
+
+def test_sync_index(tmp_output_dir: Path):
+    source_folder: Path = files_test_folder()
+    files: List[main.SourceFile] = list(main.add_file_stats(
+        source_and_destination_paths=[
+            (source_folder / '1.json', tmp_output_dir / '1.json'),
+            (source_folder / '2.md', tmp_output_dir / '2.md'),
+            (source_folder / '1MiB.bin', tmp_output_dir / '1MiB.bin'),
+        ],
+        with_stats=True
+    ))
+    # A destination file left by a copy is indexed on the first sync.
+    main.copy(source=source_folder / '2.md', destination=tmp_output_dir / '2.md')
+
+    index = main.SyncIndex(destination=tmp_output_dir)
+    changed: List[main.SourceFile] = list(index.filter(files=files))
+
+    assert [file.source.name for file in changed] == ['1.json', '1MiB.bin']
+    assert index.skipped_count == 1
+
+    index.record(path=source_folder / '1.json', success=True)
+    index.record(path=source_folder / '1MiB.bin', success=False)
+    index.close()
+
+    index = main.SyncIndex(destination=tmp_output_dir)
+
+    assert [file.source.name for file in index.filter(files=files)] == ['1MiB.bin']
+    assert index.skipped_count == 2
+
+    index.close()
+
+
+def test_journal(tmp_output_dir: Path):
+    source_folder: Path = files_test_folder()
+    files: List[main.SourceFile] = list(main.add_file_stats(
+        source_and_destination_paths=[
+            (source_folder / '1.json', tmp_output_dir / '1.json'),
+            (source_folder / '2.md', tmp_output_dir / '2.md'),
+            (source_folder / '1MiB.bin', tmp_output_dir / '1MiB.bin'),
+        ],
+        with_stats=True
+    ))
+    journal_path: Path = tmp_output_dir / main.JOURNAL_NAME
+
+    journal = main.Journal(path=journal_path, resume=False, batch_size=2)
+
+    journal.record(files[0])
+    journal.record(files[2], 0, 1000)
+    journal.close(remove=False)
+
+    # A record torn by a crash.
+    with open(journal_path, 'a') as journal_file:
+        journal_file.write(f'["{files[1].source}", ')
+
+    journal = main.Journal(path=journal_path, resume=True)
+
+    assert [journal.is_copied(file=file) for file in files] == [True, False, False]
+    assert journal.get_copied_chunks(file=files[2]) == {(0, 1000)}
+    assert journal.get_copied_chunks(file=files[1]) == set()
+
+    journal.record(files[1])
+    journal.close(remove=False)
+
+    journal = main.Journal(path=journal_path, resume=True)
+
+    assert [journal.is_copied(file=file) for file in files] == [True, True, False]
+    assert journal.resumed_count == 2
+
+    journal.close(remove=True)
+
+    assert not journal_path.exists()
+
+
+def test_result_log(tmp_output_dir: Path, monkeypatch: pytest.MonkeyPatch, caplog: pytest.LogCaptureFixture):
+    monkeypatch.setattr(main, 'REPORT_BATCH_SIZE', 2)
+    report_path: Path = tmp_output_dir / 'report.tsv'
+    caplog.set_level(logging.INFO)
+
+    results = main.ResultLog(report_path=report_path, interval=0)
+    results.success(file=Path('a'))
+    results.success(file=Path('b'), status='resumed')
+    results.error(file=Path('c'), exception=OSError('failed'))
+    results.close()
+
+    assert (results.success_count, results.error_count) == (2, 1)
+    assert report_path.read_text(encoding='utf-8') == 'success\ta\nresumed\tb\nerror\tc\tfailed\n'
+    # The successes are only summarized at the INFO level.
+    assert 'success: a' not in caplog.text
+    assert 'error: c - failed' in caplog.text
+    assert '2 success, 1 error files' in caplog.text
+
+
+def test_setup_logging():
+    main.setup_logging()
+
+    try:
+        assert main.log_listener is not None
+        assert [type(handler) for handler in logging.getLogger().handlers] == [logging.handlers.QueueHandler]
+        assert {handler.name for handler in main.log_listener.handlers} == {'file', 'console'}
+    finally:
+        main.stop_logging()
+
+    assert main.log_listener is None
+
+
+@pytest.mark.parametrize(
+    'tmp_input_dir',
+    [
+        files_test_folder(),
+    ],
+    indirect=['tmp_input_dir']
+)
+def test_run_operation_in_threads_resume(tmp_input_dir: Path, tmp_output_dir: Path):
+    source_and_destination_paths: Dict[Path, Path] = \
+        get_source_and_destination_paths(
+            source=tmp_input_dir,
+            mask=None,
+            destination=tmp_output_dir
+        )
+    files: Dict[Path, main.SourceFile] = {
+        file.source: file
+        for file in main.add_file_stats(
+            source_and_destination_paths=source_and_destination_paths.items(),
+            with_stats=True
+        )
+    }
+    copied_path: Path = tmp_input_dir / '1.json'
+    chunked_path: Path = tmp_input_dir / '1MiB.bin'
+
+    # The interrupted run copied a file and the first chunk of a large file.
+    source_and_destination_paths[copied_path].write_bytes(b'copied')
+    source_and_destination_paths[chunked_path].write_bytes(
+        b'c' * 1000 + bytes(chunked_path.stat().st_size - 1000)
+    )
+
+    journal = main.Journal(path=tmp_output_dir / main.JOURNAL_NAME, resume=False)
+
+    journal.record(files[copied_path])
+    journal.record(files[chunked_path], 0, 1000)
+    journal.close(remove=False)
+
+    main.setup_logging()
+    main.run_operation_in_threads(
+        source=tmp_input_dir,
+        operation_name='copy',
+        source_and_destination_paths=source_and_destination_paths.items(),
+        threads=2,
+        mask=None,
+        chunk_threshold=1000,
+        chunk_size=1000,
+        destination=tmp_output_dir,
+        resume=True
+    )
+
+    assert source_and_destination_paths[copied_path].read_bytes() == b'copied'
+    assert source_and_destination_paths[chunked_path].read_bytes() == \
+        b'c' * 1000 + chunked_path.read_bytes()[1000:]
+    assert not (tmp_output_dir / main.JOURNAL_NAME).exists()
+
+    for source_path, destination_path in source_and_destination_paths.items():
+        if source_path not in (copied_path, chunked_path):
+            assert source_path.read_bytes() == destination_path.read_bytes()
+
+
+@pytest.mark.parametrize(
+    'tmp_input_dir, journaled',
+    [
+        (files_test_folder(), False),
+        (files_test_folder(), True),
+    ],
+    indirect=['tmp_input_dir']
+)
+def test_run_operation_in_threads_journal(
+        tmp_input_dir: Path,
+        tmp_output_dir: Path,
+        monkeypatch: pytest.MonkeyPatch,
+        journaled: bool
+):
+    chunked_path: Path = tmp_input_dir / '1MiB.bin'
+    destination_path: Path = tmp_output_dir / chunked_path.name
+    copy_chunk: Callable = main.copy_chunk
+
+    def fail_chunk(source: Path, destination: Path, offset: int, length: int, engine: str) -> None:
+        if offset == 1000:
+            raise OSError(errno.EIO, 'Input/output error')
+
+        copy_chunk(source=source, destination=destination, offset=offset, length=length, engine=engine)
+
+    monkeypatch.setattr(main, 'copy_chunk', fail_chunk)
+
+    kwargs: Dict[str, Any] = dict(
+        threads=2,
+        chunk_threshold=1000,
+        chunk_size=1000,
+        small_file_size=0,
+        destination=tmp_output_dir
+    )
+    main.run_operation_in_threads(
+        source=tmp_input_dir,
+        operation_name='copy',
+        source_and_destination_paths=get_source_and_destination_paths(
+            source=tmp_input_dir,
+            mask=None,
+            destination=tmp_output_dir
+        ).items(),
+        mask=None,
+        journaled=journaled,
+        **kwargs
+    )
+
+    # The journal is written only on request and keeps the copied chunks of the failed file.
+    assert (tmp_output_dir / main.JOURNAL_NAME).exists() == journaled
+    assert destination_path.exists() == journaled
+
+    if not journaled:
+        return
+
+    assert destination_path.read_bytes()[:1000] == chunked_path.read_bytes()[:1000]
+
+    monkeypatch.setattr(main, 'copy_chunk', copy_chunk)
+    run_operation_and_check(source=tmp_input_dir, output_dir=tmp_output_dir, resume=True, **kwargs)
+
+    assert not (tmp_output_dir / main.JOURNAL_NAME).exists()
+
+
+@pytest.mark.parametrize(
+    'algorithm',
+    main.hash_algorithms.keys()
+)
+def test_copy_verified(tmp_output_dir: Path, algorithm: str):
+    source: Path = files_test_folder() / '1MiB.bin'
+
+    digest: str = main.copy_verified(source=source, destination=tmp_output_dir, engine='auto', algorithm=algorithm)
+
+    assert digest == main.hash_file(path=source, algorithm=algorithm)
+    assert filecmp.cmp(source, tmp_output_dir / source.name, shallow=False)
+
+
+def test_copy_verified_mismatch(tmp_output_dir: Path, monkeypatch: pytest.MonkeyPatch):
+    # The destination data is corrupted by the copy.
+    monkeypatch.setattr(
+        main,
+        'copy_file_data',
+        lambda source, destination, engine, hasher: destination.write_bytes(b'corrupted') and 'sendfile'
+    )
+
+    with pytest.raises(main.VerificationError):
+        main.copy_verified(
+            source=files_test_folder() / '1.json',
+            destination=tmp_output_dir,
+            engine='auto',
+            algorithm='sha256'
+        )
+
+
+@pytest.mark.parametrize(
+    'engine, source_reads',
+    [
+        # The source data is hashed while it is copied.
+        ('buffered', 1),
+        # The data copied inside the kernel is read again.
+        ('sendfile', 2),
+    ]
+)
+def test_copy_verified_source_reads(
+        tmp_output_dir: Path,
+        monkeypatch: pytest.MonkeyPatch,
+        engine: str,
+        source_reads: int
+):
+    source: Path = files_test_folder() / '1MiB.bin'
+    opened_paths: List[Path] = []
+
+    def record_open(file: Path, mode: str = 'r', *args, **kwargs) -> IO:
+        opened_paths.append(Path(file))
+
+        return open(file, mode, *args, **kwargs)
+
+    # The engines cached by the other tests are not used.
+    monkeypatch.setattr(main, 'device_copy_engines', {})
+    monkeypatch.setattr(main, 'open', record_open, raising=False)
+    main.copy_verified(source=source, destination=tmp_output_dir, engine=engine, algorithm='sha256')
+
+    assert opened_paths.count(source) == source_reads
+
+
+@pytest.mark.parametrize(
+    'kernel_copy, source_reads',
+    [
+        # Preallocated, then read once by the chunks.
+        (False, 1 + 16),
+        # The chunks copied inside the kernel are read again by the verification.
+        (True, 1 + 16 + 1),
+    ]
+)
+def test_run_operation_in_threads_verify_source_reads(
+        tmp_output_dir: Path,
+        monkeypatch: pytest.MonkeyPatch,
+        kernel_copy: bool,
+        source_reads: int
+):
+    source: Path = files_test_folder() / '1MiB.bin'
+    opened_paths: List[Path] = []
+    copy_chunk: Callable = main.copy_chunk
+
+    def copy_chunk_in_kernel(
+            source: Path,
+            destination: Path,
+            offset: int,
+            length: int,
+            engine: str,
+            algorithm: Optional[str] = None
+    ) -> Optional[str]:
+        # No digest is computed by copy_file_range.
+        return copy_chunk(source=source, destination=destination, offset=offset, length=length, engine=engine)
+
+    if kernel_copy:
+        monkeypatch.setattr(main, 'copy_chunk', copy_chunk_in_kernel)
+
+    def record_open(file: Path, mode: str = 'r', *args, **kwargs) -> IO:
+        opened_paths.append(Path(file))
+
+        return open(file, mode, *args, **kwargs)
+
+    monkeypatch.setattr(main, 'open', record_open, raising=False)
+    main.run_operation_in_threads(
+        source=source.parent,
+        operation_name='copy',
+        source_and_destination_paths=[(source, tmp_output_dir / source.name)],
+        mask=None,
+        destination=tmp_output_dir,
+        threads=2,
+        chunk_threshold=2 ** 18,
+        chunk_size=2 ** 16,
+        copy_engine='buffered',
+        verify='sha256'
+    )
+
+    assert filecmp.cmp(source, tmp_output_dir / source.name, shallow=False)
+    assert opened_paths.count(source) == source_reads
+
+
+def test_verify_chunks_mismatch(tmp_output_dir: Path):
+    source: Path = files_test_folder() / '1MiB.bin'
+    destination: Path = tmp_output_dir / source.name
+    data: bytearray = bytearray(source.read_bytes())
+    data[2 ** 17] ^= 0xFF
+    destination.write_bytes(data)
+
+    # Only the chunk without a digest is hashed from the source.
+    with pytest.raises(main.VerificationError, match='chunk at 131072'):
+        main.verify_chunks(
+            source=source,
+            destination=destination,
+            algorithm='sha256',
+            chunk_size=2 ** 16,
+            chunk_digests={
+                offset: hashlib.sha256(data[offset:offset + 2 ** 16]).hexdigest()
+                for offset in range(0, len(data), 2 ** 16)
+                if offset != 2 ** 17
+            }
+        )
+
+
+@pytest.mark.parametrize(
+    'tmp_input_dir, executor_name, threads',
+    [
+        (files_test_folder(), 'thread', 4),
+        (files_folders_tree_test_folder(), 'thread', 2),
+        (files_folders_tree_test_folder(), 'process', 1),
+        (files_test_folder(), 'process', 2),
+    ],
+    indirect=['tmp_input_dir']
+)
+def test_run_operation_in_threads_verify(
+        tmp_input_dir: Path,
+        tmp_output_dir: Path,
+        monkeypatch: pytest.MonkeyPatch,
+        executor_name: str,
+        threads: int
+):
+    chunked_files: Set[Path] = set()
+    copy_chunk: Callable = main.copy_chunk
+
+    def record_chunk(
+            source: Path,
+            destination: Path,
+            offset: int,
+            length: int,
+            engine: str,
+            algorithm: Optional[str] = None
+    ) -> Optional[str]:
+        chunked_files.add(source)
+
+        return copy_chunk(
+            source=source,
+            destination=destination,
+            offset=offset,
+            length=length,
+            engine=engine,
+            algorithm=algorithm
+        )
+
+    if executor_name == 'thread':
+        monkeypatch.setattr(main, 'copy_chunk', record_chunk)
+
+    source_and_destination_paths: Dict[Path, Path] = run_operation_and_check(
+        source=tmp_input_dir,
+        output_dir=tmp_output_dir,
+        threads=threads,
+        destination=tmp_output_dir,
+        executor_name=executor_name,
+        processes=2,
+        chunk_threshold=2 ** 18,
+        chunk_size=2 ** 16,
+        verify='sha256'
+    )
+
+    # Verified large files are still copied by chunks.
+    if (executor_name == 'thread') and (tmp_input_dir / '1MiB.bin').exists():
+        assert tmp_input_dir / '1MiB.bin' in chunked_files
+
+    manifest: Dict[str, str] = {}
+
+    for line in (tmp_output_dir / main.MANIFEST_NAME_FORMAT.format(algorithm='sha256')).read_text().splitlines():
+        digest, path = line.split('  ', 1)
+        manifest[path] = digest
+
+    assert manifest == {
+        destination_path.relative_to(tmp_output_dir).as_posix(): main.hash_file(path=source_path, algorithm='sha256')
+        for source_path, destination_path in source_and_destination_paths.items()
+    }
+
+
+def test_manifest(tmp_output_dir: Path):
+    files: List[main.SourceFile] = [
+        main.SourceFile(source=Path(f'/source/{name}'), destination=tmp_output_dir / name, size=1, devices=(0, 0))
+        for name in ('a', 'b', 'c')
+    ]
+    manifest_path: Path = tmp_output_dir / main.MANIFEST_NAME_FORMAT.format(algorithm='sha256')
+
+    manifest = main.Manifest(destination=tmp_output_dir, algorithm='sha256')
+    manifest.record(file=files[0], digest='1')
+    manifest.record(file=files[1], digest='2')
+
+    # The digests are written as the files are copied, before the run is interrupted.
+    assert manifest_path.read_text(encoding='utf-8') == '1  a\n2  b\n'
+
+    with open(manifest_path, 'a', encoding='utf-8') as manifest_file:
+        manifest_file.write('3  ')
+
+    manifest = main.Manifest(destination=tmp_output_dir, algorithm='sha256')
+    manifest.record(file=files[0], digest='4')
+    manifest.record(file=files[2], digest='3')
+    manifest.close()
+
+    assert manifest_path.read_text(encoding='utf-8') == '4  a\n2  b\n3  c\n'
+
+
+def test_metrics():
+    results = main.ResultLog()
+    metrics = main.Metrics(results=results)
+
+    metrics.found_files, metrics.found_bytes, metrics.enumerated = 3, 2 ** 20 + 100, True
+    metrics.observe(task=main.TaskResult(worker='1/a', busy=0.0005, result=None, exception=None), size=100)
+    metrics.observe(task=main.TaskResult(worker='1/b', busy=0.5, result=None, exception=None), size=2 ** 20)
+    results.success_count = 2
+
+    stats: Dict[str, object] = metrics.get_stats()
+
+    assert stats['done_bytes'] == 2 ** 20 + 100
+    assert stats['eta_seconds'] == 0
+    assert stats['worker_busy_seconds'] == {'1/a': 0.0005, '1/b': 0.5}
+    assert stats['latency_seconds']['4096']['buckets']['0.001'] == 1
+    assert stats['latency_seconds']['1048576']['buckets']['1.0'] == 1
+    assert stats['latency_seconds']['+Inf']['count'] == 0
+
+    prometheus: List[str] = main.Metrics.format_prometheus(stats=stats).splitlines()
+
+    assert 'files_operations_files_total{result="success"} 2' in prometheus
+    assert 'files_operations_latency_seconds_bucket{size="1048576",le="0.1"} 0' in prometheus
+    assert 'files_operations_latency_seconds_bucket{size="1048576",le="+Inf"} 1' in prometheus
+    assert 'files_operations_latency_seconds_count{size="1048576"} 1' in prometheus
+
+
+@pytest.mark.parametrize(
+    'tmp_input_dir, executor_name',
+    [
+        (files_folders_tree_test_folder(), 'thread'),
+        (files_folders_tree_test_folder(), 'hybrid'),
+    ],
+    indirect=['tmp_input_dir']
+)
+def test_run_operation_in_threads_metrics(tmp_input_dir: Path, tmp_output_dir: Path, executor_name: str):
+    stats_path: Path = tmp_output_dir / 'stats.json'
+    prometheus_path: Path = tmp_output_dir / 'stats.prom'
+    files: int = len(run_operation_and_check(
+        source=tmp_input_dir,
+        output_dir=tmp_output_dir,
+        threads=2,
+        destination=tmp_output_dir,
+        executor_name=executor_name,
+        processes=2,
+        stats=stats_path,
+        prometheus=prometheus_path
+    ))
+
+    stats: Dict[str, object] = json.loads(stats_path.read_text())
+
+    assert (stats['success_files'], stats['error_files']) == (files, 0)
+    assert stats['found_files'] == files
+    assert stats['done_bytes'] == stats['found_bytes']
+    assert (stats['queued'], stats['in_flight']) == (0, 0)
+    assert sum(histogram['count'] for histogram in stats['latency_seconds'].values()) > 0
+    assert f'files_operations_files_total{{result="success"}} {files}' in prometheus_path.read_text().splitlines()
+
+
+def test_profiler_phases(tmp_output_dir: Path):
+    profile_path: Path = tmp_output_dir / 'profile.json'
+
+    with main.Profiler(path=profile_path) as profiler:
+        with profiler.phase(name='outer'):
+            with profiler.phase(name='inner'):
+                time.sleep(0.02)
+
+        assert list(profiler.time_iterator(name='items', items=range(3))) == [0, 1, 2]
+
+    phases: Dict[str, Dict[str, float]] = json.loads(profile_path.read_text())['phases']
+
+    assert {name: phase['count'] for name, phase in phases.items()} == {'inner': 1, 'outer': 1, 'items': 4}
+    # The time of the nested phase is excluded.
+    assert phases['inner']['wall_seconds'] >= 0.02 > phases['outer']['wall_seconds']
+
+
+@pytest.mark.parametrize(
+    'tmp_input_dir, profiler_name, profile_suffix',
+    [
+        (files_folders_tree_test_folder(), None, None),
+        (files_folders_tree_test_folder(), 'sample', '.folded'),
+        (files_folders_tree_test_folder(), 'cprofile', '.pstats'),
+        (files_folders_tree_test_folder(), 'tracemalloc', '.folded'),
+    ],
+    indirect=['tmp_input_dir']
+)
+def test_run_operation_in_threads_profile(
+        tmp_input_dir: Path,
+        tmp_output_dir: Path,
+        profiler_name: Optional[str],
+        profile_suffix: Optional[str]
+):
+    profile_path: Path = tmp_input_dir.parent / 'profile.json'
+
+    try:
+        with main.Profiler(path=profile_path, profiler_name=profiler_name) as profiler:
+            run_operation_and_check(
+                source=tmp_input_dir,
+                output_dir=tmp_output_dir,
+                threads=2,
+                destination=tmp_output_dir,
+                profiler=profiler
+            )
+
+        phases: Dict[str, Dict[str, float]] = json.loads(profile_path.read_text())['phases']
+
+        assert {'schedule', 'file stats', 'wait for files', 'output'} <= phases.keys()
+        assert sum(phase['count'] for name, phase in phases.items() if name.startswith('operation ')) > 0
+
+        if profile_suffix is not None:
+            # A short run can end before the first sample.
+            assert profile_path.with_name(f'{profile_path.name}{profile_suffix}').exists()
+    finally:
+        for path in profile_path.parent.glob(f'{profile_path.name}*'):
+            path.unlink()
+
+
+def test_deduplicator(tmp_output_dir: Path, monkeypatch: pytest.MonkeyPatch):
+    data: Dict[str, bytes] = {
+        'a': b'a' * 100000,
+        'unique': b'unique',
+        'b': b'a' * 100000,
+        'c': b'a' * 99999 + b'c',
+        'd': b'a' * 99999 + b'c',
+        'e': b'text',
+        'f': b'text',
+        'empty': b'',
+    }
+    files: List[main.SourceFile] = []
+
+    for name, content in data.items():
+        (tmp_output_dir / name).write_bytes(content)
+        files.append(
+            main.SourceFile(source=tmp_output_dir / name, destination=Path(name), size=len(content), devices=(0, 0))
+        )
+
+    hashed_paths: List[Path] = []
+    hash_file: Callable = main.Deduplicator.hash
+
+    def record_hash(path: Path, size: int) -> Optional[bytes]:
+        hashed_paths.append(path)
+
+        return hash_file(path=path, size=size)
+
+    # The originals are found in the windows before.
+    monkeypatch.setattr(main, 'DEDUPE_WINDOW_SIZE', 2)
+    monkeypatch.setattr(main.Deduplicator, 'hash', staticmethod(record_hash))
+
+    deduplicator = main.Deduplicator(threads=2)
+    originals: Dict[str, Optional[str]] = {
+        file.destination.name: file.original.destination.name if file.original is not None else None
+        for file in deduplicator.filter(files=files)
+    }
+
+    assert originals == {
+        'a': None, 'unique': None, 'b': 'a', 'c': None, 'd': 'c', 'e': None, 'f': 'e', 'empty': None
+    }
+    assert deduplicator.duplicate_count == 3
+    # The only file of its size is not hashed, the others are hashed once by head and by data.
+    assert tmp_output_dir / 'unique' not in hashed_paths
+    assert sorted(hashed_paths).count(tmp_output_dir / 'a') == 2
+
+
+@pytest.mark.parametrize(
+    'tmp_input_dir, method',
+    [
+        (files_test_folder(), 'hardlink'),
+        (files_test_folder(), 'reflink'),
+    ],
+    indirect=['tmp_input_dir']
+)
+def test_run_operation_in_threads_dedupe(tmp_input_dir: Path, tmp_output_dir: Path, method: str):
+    data: Dict[str, bytes] = {
+        'a.bin': b'a' * 100000,
+        'b.bin': b'a' * 100000,
+        'c.bin': b'a' * 99999 + b'c',
+        'd.txt': b'text',
+        'e.txt': b'text',
+        'f.txt': b'',
+        'g.txt': b'',
+    }
+
+    for name, content in data.items():
+        (tmp_input_dir / name).write_bytes(content)
+
+    (tmp_input_dir / 'subfolder').mkdir()
+    (tmp_input_dir / 'subfolder' / 'h.bin').write_bytes(b'a' * 100000)
+
+    run_operation_and_check(
+        source=tmp_input_dir,
+        output_dir=tmp_output_dir,
+        threads=3,
+        destination=tmp_output_dir,
+        dedupe=method
+    )
+
+    if method == 'hardlink':
+        assert (tmp_output_dir / 'a.bin').stat().st_ino == \
+            (tmp_output_dir / 'b.bin').stat().st_ino == \
+            (tmp_output_dir / 'subfolder' / 'h.bin').stat().st_ino
+        assert (tmp_output_dir / 'a.bin').stat().st_ino != (tmp_output_dir / 'c.bin').stat().st_ino
+        assert (tmp_output_dir / 'd.txt').stat().st_ino == (tmp_output_dir / 'e.txt').stat().st_ino
+        assert (tmp_output_dir / 'f.txt').stat().st_ino != (tmp_output_dir / 'g.txt').stat().st_ino
+
+
+@pytest.mark.parametrize(
+    'tmp_input_dir, archive_name, threads',
+    [
+        (files_test_folder(), 'out.tar', 1),
+        (files_folders_tree_test_folder(), 'out.tar', 4),
+        (files_folders_tree_test_folder(), 'out.tar.gz', 3),
+        pytest.param(
+            files_folders_tree_test_folder(), 'out.tar.zst', 2,
+            marks=pytest.mark.skipif(main.zstandard is None, reason='zstandard is not installed')
+        ),
+    ],
+    indirect=['tmp_input_dir']
+)
+def test_write_and_extract_archive(
+        tmp_input_dir: Path,
+        tmp_output_dir: Path,
+        archive_name: str,
+        threads: int
+):
+    archive: Path = tmp_output_dir / archive_name
+    extracted: Path = tmp_output_dir / 'extracted'
+    write_report: Path = tmp_output_dir / 'write.tsv'
+    extract_report: Path = tmp_output_dir / 'extract.tsv'
+    (tmp_input_dir / 'empty_folder').mkdir()
+    source_paths: List[Path] = list(main.create_source_paths(source=tmp_input_dir, mask=None, with_folders=True))
+
+    main.setup_logging()
+    main.write_archive(
+        source_and_destination_paths=main.create_source_and_destination_paths(
+            source=tmp_input_dir,
+            source_paths=source_paths,
+            destination=Path(),
+            create_folders=False
+        ),
+        destination=archive,
+        threads=threads,
+        report=write_report
+    )
+
+    extracted.mkdir()
+    main.extract_archive(source=archive, destination=extracted, threads=threads, report=extract_report)
+
+    assert (extracted / 'empty_folder').is_dir()
+
+    # Both sides count the same files, the folders are not counted.
+    written_lines: List[str] = write_report.read_text(encoding='utf-8').splitlines()
+    extracted_lines: List[str] = extract_report.read_text(encoding='utf-8').splitlines()
+
+    assert all(line.startswith('success') for line in written_lines + extracted_lines)
+    assert len(written_lines) == len(extracted_lines) == len([path for path in source_paths if path.is_file()])
+
+    for source_path in source_paths:
+        extracted_path: Path = extracted / source_path.relative_to(tmp_input_dir)
+
+        if source_path.is_dir():
+            assert extracted_path.is_dir()
+
+            continue
+
+        assert source_path.read_bytes() == extracted_path.read_bytes()
+        assert int(source_path.stat().st_mtime) == extracted_path.stat().st_mtime
+
+
+@pytest.mark.parametrize(
+    'tmp_input_dir',
+    [
+        files_test_folder(),
+    ],
+    indirect=['tmp_input_dir']
+)
+def test_write_archive_shrunk_file(tmp_input_dir: Path, tmp_output_dir: Path, monkeypatch: pytest.MonkeyPatch):
+    archive: Path = tmp_output_dir / 'out.tar'
+    report: Path = tmp_output_dir / 'report.tsv'
+    shrunk_path: Path = tmp_input_dir / '1MiB.bin'
+    read_archive_member: Callable = main.read_archive_member
+
+    # The file shrinks by 1000 bytes after its size has been read.
+    def read_shrinking_member(source: Path, name: str) -> Tuple[tarfile.TarInfo, Optional[bytes]]:
+        member, data = read_archive_member(source, name)
+
+        if source == shrunk_path:
+            member.size += 1000
+
+        return member, data
+
+    monkeypatch.setattr(main, 'ARCHIVE_READ_SIZE', 0)
+    monkeypatch.setattr(main, 'read_archive_member', read_shrinking_member)
+
+    source_paths: List[Path] = list(main.create_source_paths(source=tmp_input_dir, mask=None))
+    main.write_archive(
+        source_and_destination_paths=main.create_source_and_destination_paths(
+            source=tmp_input_dir,
+            source_paths=source_paths,
+            destination=Path(),
+            create_folders=False
+        ),
+        destination=archive,
+        threads=2,
+        report=report
+    )
+
+    # The member is padded with zeros and the files after it are still archived.
+    with tarfile.open(archive) as archive_file:
+        assert archive_file.extractfile(shrunk_path.name).read() == shrunk_path.read_bytes() + bytes(1000)
+
+        for source_path in source_paths:
+            if source_path != shrunk_path:
+                assert archive_file.extractfile(source_path.name).read() == source_path.read_bytes()
+
+    assert [line.split('\t')[:2] for line in report.read_text(encoding='utf-8').splitlines()
+            if line.startswith('error')] == [['error', str(shrunk_path)]]
+
+
+def test_extract_archive_special_bits(tmp_output_dir: Path):
+    archive: Path = tmp_output_dir / 'out.tar'
+    member: tarfile.TarInfo = tarfile.TarInfo(name='setuid.sh')
+    member.size = 4
+    member.mode = 0o4755
+
+    with tarfile.open(archive, 'w') as archive_file:
+        archive_file.addfile(tarinfo=member, fileobj=io.BytesIO(b'data'))
+
+    (tmp_output_dir / 'extracted').mkdir()
+    main.extract_archive(source=archive, destination=tmp_output_dir / 'extracted', threads=2)
+
+    assert (tmp_output_dir / 'extracted' / 'setuid.sh').stat().st_mode & 0o7777 == 0o755
+
+
+def test_extract_archive_outside_destination(tmp_output_dir: Path):
+    archive: Path = tmp_output_dir / 'out.tar'
+    member: tarfile.TarInfo = tarfile.TarInfo(name='../outside.txt')
+    member.size = 4
+
+    with tarfile.open(archive, 'w') as archive_file:
+        archive_file.addfile(tarinfo=member, fileobj=io.BytesIO(b'data'))
+
+    (tmp_output_dir / 'extracted').mkdir()
+    main.extract_archive(source=archive, destination=tmp_output_dir / 'extracted', threads=2)
+
+    assert not (tmp_output_dir / 'outside.txt').exists()
+
+
+def test_add_file_stats(tmp_output_dir: Path):
+    source_and_destination_paths: List[Tuple[Path, Path]] = [
+        (files_test_folder() / '1.json', tmp_output_dir / '1.json'),
+        (files_test_folder() / 'not_exists_file', tmp_output_dir / 'not_exists_file'),
+    ]
+
+    files = list(main.add_file_stats(
+        source_and_destination_paths=source_and_destination_paths,
+        with_stats=True
+    ))
+
+    assert files[0].size == (files_test_folder() / '1.json').stat().st_size
+    assert files[0].devices == (files_test_folder().stat().st_dev, tmp_output_dir.stat().st_dev)
+    assert files[1].size == 0
+    assert files[1].devices == (0, 0)
+    assert all(file.size == 0 for file in main.add_file_stats(
+        source_and_destination_paths=source_and_destination_paths,
+        with_stats=False
+    ))
+
+
+def test_run_batch(tmp_output_dir: Path):
+    batch: List[Tuple[Path, Path]] = [
+        (files_test_folder() / '1.json', tmp_output_dir / '1.json'),
+        (files_test_folder() / 'not_exists_file', tmp_output_dir / 'not_exists_file'),
+        (files_test_folder() / '2.md', tmp_output_dir / '2.md'),
+    ]
+
+    errors = main.run_batch(operation=main.copy, source_and_destination_paths=batch, engine='auto')
+
+    assert [error is None for error in errors] == [True, False, True]
+    assert isinstance(errors[1], FileNotFoundError)
+
+
+@pytest.mark.parametrize(
+    'tmp_input_dir, chunk_threshold, chunk_size, threads',
+    [
+        (files_test_folder(), 1000, 4096, 4),
+        (files_test_folder(), 1000, 1000, 3),
+        (files_test_folder() / '1MiB.bin', 1, 100000, 5),
+        (files_and_subfolders_test_folder(), 1, 1024, 2),
+    ],
+    indirect=['tmp_input_dir']
+)
+def test_run_operation_in_threads_chunked(
+        tmp_input_dir: Path,
+        tmp_output_dir: Path,
+        chunk_threshold: int,
+        chunk_size: int,
+        threads: int,
+        monkeypatch: pytest.MonkeyPatch
+):
+    chunks: List[Tuple[Path, int, int]] = []
+    copy_chunk: Callable = main.copy_chunk
+
+    def record_chunk(source: Path, destination: Path, offset: int, length: int, engine: str) -> None:
+        chunks.append((source, offset, length))
+        copy_chunk(source=source, destination=destination, offset=offset, length=length, engine=engine)
+
+    monkeypatch.setattr(main, 'copy_chunk', record_chunk)
+
+    source_and_destination_paths: Dict[Path, Path] = run_operation_and_check(
+        source=tmp_input_dir,
+        output_dir=tmp_output_dir,
+        threads=threads,
+        chunk_threshold=chunk_threshold,
+        chunk_size=chunk_size,
+        small_file_size=0
+    )
+
+    # The files of at least chunk_threshold bytes are copied by chunk_size ranges covering them.
+    for source_path, destination_path in source_and_destination_paths.items():
+        size: int = source_path.stat().st_size
+        ranges: List[Tuple[int, int]] = \
+            sorted((offset, length) for path, offset, length in chunks if path == source_path)
+
+        assert source_path.stat().st_mtime == destination_path.stat().st_mtime
+        assert ranges == (
+            [(offset, min(chunk_size, size - offset)) for offset in range(0, size, chunk_size)]
+            if size >= chunk_threshold else []
+        )
+
+
+@pytest.mark.parametrize(
+    'args, result',
+    [
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--threads=5'],
+         argparse.Namespace(
+             operation='copy',
+             source=Path('/home/user/projects/'),
+             destination=Path('/root/'),
+             threads=5,
+             copy_engine='auto',
+             chunk_threshold=main.DEFAULT_CHUNK_THRESHOLD,
+             chunk_size=main.DEFAULT_CHUNK_SIZE,
+             small_file_size=main.DEFAULT_SMALL_FILE_SIZE,
+             executor='thread',
+             processes=main.DEFAULT_PROCESSES,
+             include=[],
+             exclude=[],
+             min_size=None,
+             max_size=None,
+             modified_after=None,
+             modified_before=None,
+             walkers=1,
+             files_from=None,
+             null=False,
+             sizes=False,
+             max_bandwidth=None,
+             max_files_per_sec=None,
+             throttle_file=None,
+             device_threads=[],
+             verify=None,
+             dedupe=None,
+             log_level='INFO',
+             quiet=False,
+             report=None,
+             progress=False,
+             stats=None,
+             prometheus=None,
+             profile=None,
+             profiler=None,
+             journal=False,
+             resume=False)
+         ),
+        (['--operation=move',
+          '--from=/home/user/projects/*.md',
+          '--to=/root/some_folder'],
+         argparse.Namespace(
+             operation='move',
+             source=Path('/home/user/projects/*.md'),
+             destination=Path('/root/some_folder'),
+             threads=1,
+             copy_engine='auto',
+             chunk_threshold=main.DEFAULT_CHUNK_THRESHOLD,
+             chunk_size=main.DEFAULT_CHUNK_SIZE,
+             small_file_size=main.DEFAULT_SMALL_FILE_SIZE,
+             executor='thread',
+             processes=main.DEFAULT_PROCESSES,
+             include=[],
+             exclude=[],
+             min_size=None,
+             max_size=None,
+             modified_after=None,
+             modified_before=None,
+             walkers=1,
+             files_from=None,
+             null=False,
+             sizes=False,
+             max_bandwidth=None,
+             max_files_per_sec=None,
+             throttle_file=None,
+             device_threads=[],
+             verify=None,
+             dedupe=None,
+             log_level='INFO',
+             quiet=False,
+             report=None,
+             progress=False,
+             stats=None,
+             prometheus=None,
+             profile=None,
+             profiler=None,
+             journal=False,
+             resume=False)
+         ),
+        (['--operation=move',
+          '--from=sadsd',
+          '--to=123'],
+         argparse.Namespace(
+             operation='move',
+             source=Path('sadsd'),
+             destination=Path('123'),
+             threads=1,
+             copy_engine='auto',
+             chunk_threshold=main.DEFAULT_CHUNK_THRESHOLD,
+             chunk_size=main.DEFAULT_CHUNK_SIZE,
+             small_file_size=main.DEFAULT_SMALL_FILE_SIZE,
+             executor='thread',
+             processes=main.DEFAULT_PROCESSES,
+             include=[],
+             exclude=[],
+             min_size=None,
+             max_size=None,
+             modified_after=None,
+             modified_before=None,
+             walkers=1,
+             files_from=None,
+             null=False,
+             sizes=False,
+             max_bandwidth=None,
+             max_files_per_sec=None,
+             throttle_file=None,
+             device_threads=[],
+             verify=None,
+             dedupe=None,
+             log_level='INFO',
+             quiet=False,
+             report=None,
+             progress=False,
+             stats=None,
+             prometheus=None,
+             profile=None,
+             profiler=None,
+             journal=False,
+             resume=False)
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/mnt/usb',
+          '--device-threads=/mnt/usb=2',
+          '--device-threads=/mnt/a=b=16'],
+         argparse.Namespace(
+             operation='copy',
+             source=Path('/home/user/projects/'),
+             destination=Path('/mnt/usb'),
+             threads=1,
+             copy_engine='auto',
+             chunk_threshold=main.DEFAULT_CHUNK_THRESHOLD,
+             chunk_size=main.DEFAULT_CHUNK_SIZE,
+             small_file_size=main.DEFAULT_SMALL_FILE_SIZE,
+             executor='thread',
+             processes=main.DEFAULT_PROCESSES,
+             include=[],
+             exclude=[],
+             min_size=None,
+             max_size=None,
+             modified_after=None,
+             modified_before=None,
+             walkers=1,
+             files_from=None,
+             null=False,
+             sizes=False,
+             max_bandwidth=None,
+             max_files_per_sec=None,
+             throttle_file=None,
+             device_threads=[(Path('/mnt/usb'), 2), (Path('/mnt/a=b'), 16)],
+             verify=None,
+             dedupe=None,
+             log_level='INFO',
+             quiet=False,
+             report=None,
+             progress=False,
+             stats=None,
+             prometheus=None,
+             profile=None,
+             profiler=None,
+             journal=False,
+             resume=False)
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--threads=auto'],
+         argparse.Namespace(
+             operation='copy',
+             source=Path('/home/user/projects/'),
+             destination=Path('/root/'),
+             threads='auto',
+             copy_engine='auto',
+             chunk_threshold=main.DEFAULT_CHUNK_THRESHOLD,
+             chunk_size=main.DEFAULT_CHUNK_SIZE,
+             small_file_size=main.DEFAULT_SMALL_FILE_SIZE,
+             executor='thread',
+             processes=main.DEFAULT_PROCESSES,
+             include=[],
+             exclude=[],
+             min_size=None,
+             max_size=None,
+             modified_after=None,
+             modified_before=None,
+             walkers=1,
+             files_from=None,
+             null=False,
+             sizes=False,
+             max_bandwidth=None,
+             max_files_per_sec=None,
+             throttle_file=None,
+             device_threads=[],
+             verify=None,
+             dedupe=None,
+             log_level='INFO',
+             quiet=False,
+             report=None,
+             progress=False,
+             stats=None,
+             prometheus=None,
+             profile=None,
+             profiler=None,
+             journal=False,
+             resume=False)
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--max-bandwidth=50M',
+          '--max-files-per-sec=200',
+          '--throttle-file=/root/limits'],
+         argparse.Namespace(
+             operation='copy',
+             source=Path('/home/user/projects/'),
+             destination=Path('/root/'),
+             threads=1,
+             copy_engine='auto',
+             chunk_threshold=main.DEFAULT_CHUNK_THRESHOLD,
+             chunk_size=main.DEFAULT_CHUNK_SIZE,
+             small_file_size=main.DEFAULT_SMALL_FILE_SIZE,
+             executor='thread',
+             processes=main.DEFAULT_PROCESSES,
+             include=[],
+             exclude=[],
+             min_size=None,
+             max_size=None,
+             modified_after=None,
+             modified_before=None,
+             walkers=1,
+             files_from=None,
+             null=False,
+             sizes=False,
+             max_bandwidth=50 * 2 ** 20,
+             max_files_per_sec=200.0,
+             throttle_file=Path('/root/limits'),
+             device_threads=[],
+             verify=None,
+             dedupe=None,
+             log_level='INFO',
+             quiet=False,
+             report=None,
+             progress=False,
+             stats=None,
+             prometheus=None,
+             profile=None,
+             profiler=None,
+             journal=False,
+             resume=False)
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--log-level=DEBUG',
+          '--quiet',
+          '--report=/root/report.tsv'],
+         argparse.Namespace(
+             operation='copy',
+             source=Path('/home/user/projects/'),
+             destination=Path('/root/'),
+             threads=1,
+             copy_engine='auto',
+             chunk_threshold=main.DEFAULT_CHUNK_THRESHOLD,
+             chunk_size=main.DEFAULT_CHUNK_SIZE,
+             small_file_size=main.DEFAULT_SMALL_FILE_SIZE,
+             executor='thread',
+             processes=main.DEFAULT_PROCESSES,
+             include=[],
+             exclude=[],
+             min_size=None,
+             max_size=None,
+             modified_after=None,
+             modified_before=None,
+             walkers=1,
+             files_from=None,
+             null=False,
+             sizes=False,
+             max_bandwidth=None,
+             max_files_per_sec=None,
+             throttle_file=None,
+             device_threads=[],
+             verify=None,
+             dedupe=None,
+             log_level='DEBUG',
+             quiet=True,
+             report=Path('/root/report.tsv'),
+             progress=False,
+             stats=None,
+             prometheus=None,
+             profile=None,
+             profiler=None,
+             journal=False,
+             resume=False)
+         ),
+    ]
+)
+def test_parse_args_valid(args: List[str], result: argparse.Namespace):
+    parsed_args: argparse.Namespace = main.parse_args(args=args)
+    assert result == parsed_args
+
+
+@pytest.mark.parametrize(
+    'args, result',
+    [
+        (['--operation=not_exist',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--threads=5'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/some_folder',
+          '--threads=not_int'],
+         SystemExit
+         ),
+        (['--from=/home/user/projects/',
+          '--to=/root/some_folder'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--to=/root/some_folder'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/'],
+         SystemExit
          ),
         (['--operation=copy',
           '--from=/home/user/projects/',
@@ -587,6 +2787,146 @@ def test_parse_args_valid(args: List[str], result: argparse.Namespace):
           '--threads=-20'],
          SystemExit
          ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--chunk-threshold=-1'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--chunk-size=0'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--small-file-size=-1'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--executor=not_exist'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--processes=0'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--dedupe=symlink'],
+         SystemExit
+         ),
+        (['--operation=move',
+          '--from=/home/user/projects/',
+          '--to=/root/out.tar'],
+         SystemExit
+         ),
+        (['--operation=extract',
+          '--from=/home/user/projects/',
+          '--to=/root/'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--device-threads=/mnt/usb'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--device-threads=/mnt/usb=0'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--device-threads==2'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--threads=auto',
+          '--executor=process'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--log-level=TRACE'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--walkers=0'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--min-size=-1'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--modified-after=yesterday'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--profiler=cprofile'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--null'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--files-from=-',
+          '--include=*.py'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/projects.tar',
+          '--files-from=-',
+          '--sizes'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--max-bandwidth=fast'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/root/',
+          '--max-files-per-sec=-1'],
+         SystemExit
+         ),
+        (['--operation=copy',
+          '--from=/home/user/projects/',
+          '--to=/mnt/usb/',
+          '--executor=process',
+          '--device-threads=/mnt/usb=2'],
+         SystemExit
+         ),
     ]
 )
 def test_parse_args_invalid(args: List[str], result: SystemExit):